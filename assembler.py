@@ -1,125 +1,481 @@
 #!/usr/bin/python
+import hashlib
+import json
+import optparse
+import os
 import re
-import sys
+import shutil
 import struct
+import sys
+import tempfile
+from array import array
+from bisect import bisect_left
 
-basic_pattern = re.compile('(:\w+){0,1}\s*(\w{3})\s(.+?), (\S+)')
-nonbasic_pattern = re.compile('(:\w+){0,1}\s*(\w{3})\s(\S+)')
-register_pattern = re.compile('(A|B|C|X|Y|Z|I|J)')
-addr_of_register_pattern = re.compile('\[(A|B|C|X|Y|Z|I|J)\]')
-next_word_add_register_pattern = re.compile('\[(\S+)\+(A|B|C|X|Y|Z|I|J)\]')
-addr_of_next_word_pattern = re.compile('\[(\S+)\]')
-label_pattern = re.compile('([a-z]+)')
+# One token per match: a label definition, a number, a name or
+# punctuation. Anything else ends up in the last group.
+token_pattern = re.compile(r'\s*(?::(\w+)|(0x[0-9a-fA-F]+|\d+)\b|(\w+)|'
+                           r'([\[\]+,])|(\S))')
 
 
 op_map = { "SET": 0x1, "ADD": 0x2, "SUB": 0x3, "MUL": 0x4, "DIV": 0x5, "MOD": 0x6, "SHL": 0x7, "SHR": 0x8, "AND": 0x9, "BOR": 0xa, "XOR": 0xb, "IFE": 0xc, "IFN": 0xd, "IFG": 0xe, "IFB": 0xf }
 reg_map = { 'A': 0x0, 'B': 0x1, 'C': 0x2, 'X': 0x3, 'Y': 0x4, 'Z': 0x5, 'I': 0x6, 'J': 0x7 }
+special_map = { 'POP': 0x18, 'PEEK': 0x19, 'PUSH': 0x1a, 'SP': 0x1b, 'PC': 0x1c, 'O': 0x1d }
+
+# Part of the cache key of object files, bump when their format or the
+# encoding changes
+OBJECT_VERSION = 1
+
+
+class AssemblerError(Exception):
+    def __init__(self, msg, lineno=None, filename=None):
+        self.msg = msg
+        self.lineno = lineno
+        self.filename = filename
+        if lineno is not None:
+            msg = 'Error at line %d: %s' % (lineno, msg)
+        if filename is not None:
+            msg = '%s: %s' % (filename, msg)
+        Exception.__init__(self, msg)
+
+
+def tokenize(line):
+    """ Returns (label, [(kind, text)]) of a line, without the comment """
+    label = None
+    tokens = []
+    for defined, number, name, punct, bad in \
+            token_pattern.findall(line.partition(';')[0].rstrip()):
+        if defined:
+            if label is not None or tokens:
+                raise AssemblerError("Unexpected label ':%s'" % defined)
+            label = defined
+        elif number:
+            tokens.append(('number', int(number, 0)))
+        elif name:
+            tokens.append(('name', name))
+        elif punct:
+            tokens.append((punct, punct))
+        elif bad:
+            raise AssemblerError("Unexpected '%s'" % bad)
+    return label, tokens
+
+
+def split_operands(tokens):
+    """ Splits the tokens after the op at commas """
+    operands = [[]]
+    for token in tokens:
+        if token[0] == ',':
+            operands.append([])
+        else:
+            operands[-1].append(token)
+    return operands
+
+
+def encode_value(tokens):
+    """ Returns (value, next word) of an operand.
+
+    The next word is None, a number or the name of a label.
+    """
+    kinds = [kind for kind, text in tokens]
+    if kinds == ['name']:
+        name = tokens[0][1]
+        if name in reg_map:
+            return (reg_map[name], None)
+        if name in special_map:
+            return (special_map[name], None)
+        return (0x1f, name)
+    if kinds == ['number']:
+        literal = tokens[0][1]
+        if literal <= 0x1f:
+            return (literal + 0x20, None)
+        return (0x1f, literal)
+    if kinds[:1] == ['['] and kinds[-1:] == [']']:
+        inner = tokens[1:-1]
+        if len(inner) == 1:
+            kind, text = inner[0]
+            if kind == 'name' and text in reg_map:
+                return (0x08 + reg_map[text], None)
+            return (0x1e, text)
+        if len(inner) == 3 and inner[1][0] == '+':
+            first, second = inner[0], inner[2]
+            if first[1] in reg_map:
+                first, second = second, first
+            if second[1] in reg_map and first[1] not in reg_map:
+                return (0x10 + reg_map[second[1]], first[1])
+    raise AssemblerError('Invalid operand %s' %
+                         ''.join(str(text) for kind, text in tokens))
+
+
+class Assembler(object):
+    """ Assembles a program fed a line at a time.
+
+    Each line is encoded as soon as it's read. A label that is already
+    defined is resolved right away, a reference to one that isn't gets a
+    placeholder word added to the label's fixup list, patched when the
+    label is defined. Labels are local to one Assembler.
 
-labels = {}
-
-def encode_value(value):
-    match = re.match(register_pattern, value)
-    if match:
-        return (reg_map[match.groups()[0]], None)
-
-    match = re.match(addr_of_register_pattern, value) 
-    if match:
-        return (0x08 + reg_map[match.groups()[0]], None)
-
-    match = re.match(next_word_add_register_pattern, value) 
-    if match:
-        literal, register = match.groups()
-        return (0x10 + reg_map[register], int(literal, 0))
-
-    match = re.match(addr_of_next_word_pattern, value)
-    if match:
-        return (0x1e, int(match.groups()[0], 0))
-
-    if value == 'POP':
-        return (0x18, None)
-    if value == 'PEEK':
-        return (0x19, None)
-    if value == 'PUSH':
-        return (0x1a, None)
-    if value == 'SP':
-        return (0x1b, None)
-    if value == 'PC':
-        return (0x1c, None)
-    if value == 'O':
-        return (0x1d, None)
-
-    match = re.match(label_pattern, value)
-    if match:
-        return (0x1f, match.groups()[0])
-
-    literal = int(value, 0)
-    if literal <= 0x1f:
-        return (literal + 0x20, None)
-    return (0x1f, literal)
-
-def encode_basic(op, a, b):
-    if not op in op_map:
-        raise Exception('Unrecognized instruction')
-    opcode = op_map[op]
-    value1, next_word1 = encode_value(a)
-    value2, next_word2 = encode_value(b)
-    instruction = [opcode + (value1 << 4) + (value2 << 10)]
-    if next_word1:
-        instruction.append(next_word1)
-    if next_word2:
-        instruction.append(next_word2)
-    return instruction
-
-def encode_non_basic(op, a):
-    if op != "JSR":
-        raise Exception('Unrecognized instruction')
-
-    value, next_word = encode_value(a)
-    instruction = [(0x1 << 4) + (value << 10)]
-    if next_word:
-        instruction.append(next_word)
-    return instruction
-
-def assemble(prog):
-    compiled_code = []
-    PC = 0
-    lines = prog.split("\n")
-    for line, lineno in zip(lines, range(1, len(lines)+1)):
-        stripped = line.strip()
-
-        basic_match = re.match(basic_pattern, stripped)
-        non_basic_match = re.match(nonbasic_pattern, stripped)
+    With relax, finish() turns references to labels that end up at
+    addresses 0x00-0x1f into short literals, saving their next word.
+    """
+    def __init__(self, relax=True):
+        self.relax = relax
+        self.words = []
+        self.symbols = {}
+        # label -> [(index of placeholder word, lineno)]
+        self.fixups = {}
+        # (index of instruction, shift of value, index of next word,
+        #  label) of every label in a next word, None to not keep them
+        self.references = []
+        self.lineno = 0
+
+    def feed(self, line):
+        self.lineno += 1
         try:
-            if basic_match != None:
-                label, op, a, b = basic_match.groups()
-                if label != None:
-                    labels[label[1:]] = PC
-                instruction = encode_basic(op, a, b)
-            elif non_basic_match != None:
-                label, op, a = non_basic_match.groups()
-                if label != None:
-                    labels[label[1:]] = PC
-                instruction = encode_non_basic(op, a)
+            label, tokens = tokenize(line)
+            if label is not None:
+                self.define(label)
+            if tokens:
+                self.instruction(tokens)
+        except AssemblerError, e:
+            if e.lineno is not None:
+                raise
+            raise AssemblerError(e.msg, self.lineno)
+
+    def define(self, label):
+        if label in self.symbols:
+            raise AssemblerError("Label '%s' already defined" % label)
+        address = self.address
+        self.symbols[label] = address
+        for index, lineno in self.fixups.pop(label, ()):
+            self.patch(index, address & 0xffff)
+
+    def instruction(self, tokens):
+        kind, op = tokens[0]
+        if kind != 'name':
+            raise AssemblerError('Expected an instruction')
+        operands = split_operands(tokens[1:])
+        if op in op_map:
+            if len(operands) != 2:
+                raise AssemblerError('%s takes two operands' % op)
+            value1, next_word1 = encode_value(operands[0])
+            value2, next_word2 = encode_value(operands[1])
+            start = self.address
+            self.emit(op_map[op] + (value1 << 4) + (value2 << 10))
+            self.next_word(next_word1, start, 4)
+            self.next_word(next_word2, start, 10)
+        elif op == 'JSR':
+            if len(operands) != 1:
+                raise AssemblerError('%s takes one operand' % op)
+            value, next_word = encode_value(operands[0])
+            start = self.address
+            self.emit((0x1 << 4) + (value << 10))
+            self.next_word(next_word, start, 10)
+        else:
+            raise AssemblerError('Unrecognized instruction')
+
+    def next_word(self, word, start, shift):
+        """ Adds the next word of the value at shift of instruction start """
+        if word is None:
+            return
+        if isinstance(word, str):
+            if self.references is not None:
+                self.references.append((start, shift, self.address, word))
+            address = self.symbols.get(word)
+            if address is None:
+                self.fixups.setdefault(word, []).append((self.address,
+                                                         self.lineno))
+                address = 0
+            word = address
+        self.emit(word & 0xffff)
+
+    @property
+    def address(self):
+        """ Address of the next word """
+        return len(self.words)
+
+    def emit(self, word):
+        self.words.append(word)
+
+    def patch(self, index, word):
+        self.words[index] = word
+
+    def finish(self):
+        """ Returns the program as big endian words """
+        self.check_labels()
+        if self.relax:
+            self.relax_references()
+        words = array('H', self.words)
+        if sys.byteorder == 'little':
+            words.byteswap()
+        return words.tostring()
+
+    def check_labels(self):
+        """ Raises an AssemblerError if a label was never defined """
+        if self.fixups:
+            lineno, label = min((lineno, label)
+                                for label, fixups in self.fixups.iteritems()
+                                for index, lineno in fixups)
+            raise AssemblerError("Undefined label '%s'" % label, lineno)
+
+    def object(self, name=None):
+        """ Returns an ObjectFile of what was fed so far.
+
+        Labels that aren't defined are left for link() to resolve.
+        """
+        imports = dict((label, min(lineno for index, lineno in fixups))
+                       for label, fixups in self.fixups.iteritems())
+        return ObjectFile(self.words, self.symbols, self.references,
+                          imports, name)
+
+    def relax_references(self):
+        """ Shortens label references as far as possible.
+
+        Dropping a next word moves every label after it closer to 0, which
+        can bring more of them into short literal range, so this repeats
+        until no more references shrink. Then every label reference is
+        rewritten for the new addresses and the dropped words removed.
+        """
+        removed = []
+        short = set()
+        addresses = self.symbols
+        while True:
+            shrunk = False
+            for reference in self.references:
+                start, shift, index, label = reference
+                if (reference not in short and addresses[label] <= 0x1f and
+                        (self.words[start] >> shift) & 0x3f == 0x1f):
+                    short.add(reference)
+                    removed.append(index)
+                    shrunk = True
+            if not shrunk:
+                break
+            removed.sort()
+            addresses = dict((label, address - bisect_left(removed, address))
+                             for label, address in self.symbols.iteritems())
+
+        if not removed:
+            return
+        words = self.words
+        for reference in self.references:
+            start, shift, index, label = reference
+            if reference in short:
+                words[start] += (0x20 + addresses[label] - 0x1f) << shift
             else:
-                continue
-        except Exception, e:
-            print 'Error at line %d: %s' % (lineno, str(e))
-            exit(1)
-        PC += len(instruction)
-        compiled_code += instruction
+                words[index] = addresses[label] & 0xffff
+        removed = set(removed)
+        self.words = [word for index, word in enumerate(words)
+                      if index not in removed]
+        self.symbols = addresses
+
+
+class StreamingAssembler(Assembler):
+    """ Assembles into a seekable file as lines are fed.
+
+    Words are written out every chunk_words words, so memory only holds
+    the labels and the forward references still waiting for theirs.
+    Those are patched by seeking back to them when the label is
+    defined. Label references aren't recorded nor relaxed.
+    """
+    chunk_words = 0x1000
+
+    def __init__(self, out):
+        Assembler.__init__(self, relax=False)
+        self.references = None
+        self.out = out
+        self.start = out.tell()
+        self.pending = array('H')
+        # Words already written to out
+        self.written = 0
+
+    @property
+    def address(self):
+        return self.written + len(self.pending)
+
+    def emit(self, word):
+        self.pending.append(word)
+        if len(self.pending) >= self.chunk_words:
+            self.flush()
+
+    def patch(self, index, word):
+        if index >= self.written:
+            self.pending[index - self.written] = word
+            return
+        self.out.seek(self.start + (index << 1))
+        self.out.write(struct.pack('>H', word))
+        self.out.seek(self.start + (self.written << 1))
+
+    def flush(self):
+        if sys.byteorder == 'little':
+            self.pending.byteswap()
+        self.out.write(self.pending.tostring())
+        self.written += len(self.pending)
+        self.pending = array('H')
+
+    def finish(self):
+        """ Writes out the rest of the program """
+        self.check_labels()
+        self.flush()
+
+    def object(self, name=None):
+        """ Raises AssemblerError, words are written out rather than kept """
+        raise AssemblerError('A streamed program has no object file, '
+                             'assemble it with Assembler to link it',
+                             filename=name)
+
+
+class ObjectFile(object):
+    """ The words of one assembled source and its labels.
+
+    symbols are the labels it defines, by address relative to its first
+    word. references lists every label reference like
+    Assembler.references, imports the labels it references without
+    defining them, with the first line doing so.
+    """
+    def __init__(self, words, symbols, references, imports, name=None):
+        self.words = words
+        self.symbols = symbols
+        self.references = references
+        self.imports = imports
+        self.name = name
+
+    def dumps(self):
+        return json.dumps({
+            'version': OBJECT_VERSION,
+            'words': self.words,
+            'symbols': self.symbols,
+            'references': self.references,
+            'imports': self.imports,
+        }, separators=(',', ':'))
 
-    # Evaluate labels
-    for idx in range(len(compiled_code)):
-        if compiled_code[idx].__class__ == str:
-            compiled_code[idx] = labels[compiled_code[idx]]
-    return struct.pack(">%dH" % len(compiled_code), *compiled_code)
+    @staticmethod
+    def loads(data, name=None):
+        obj = json.loads(data)
+        return ObjectFile(obj['words'],
+                          dict((str(label), address) for label, address
+                               in obj['symbols'].iteritems()),
+                          [(start, shift, index, str(label)) for
+                           start, shift, index, label in obj['references']],
+                          dict((str(label), lineno) for label, lineno
+                               in obj['imports'].iteritems()),
+                          name)
+
+
+def link(objects, relax=True):
+    """ Returns the program of object files placed one after another """
+    linker = Assembler(relax)
+    imports = {}
+    for obj in objects:
+        base = len(linker.words)
+        for label, address in obj.symbols.iteritems():
+            if label in linker.symbols:
+                raise AssemblerError("Label '%s' already defined" % label,
+                                     filename=obj.name)
+            linker.symbols[label] = base + address
+        linker.words.extend(obj.words)
+        linker.references.extend((base + start, shift, base + index, label)
+                                 for start, shift, index, label
+                                 in obj.references)
+        for label, lineno in obj.imports.iteritems():
+            imports.setdefault(label, (lineno, obj.name))
+    for label, (lineno, name) in imports.iteritems():
+        if label not in linker.symbols:
+            raise AssemblerError("Undefined label '%s'" % label, lineno,
+                                 name)
+    words = linker.words
+    for start, shift, index, label in linker.references:
+        words[index] = linker.symbols[label] & 0xffff
+    return linker.finish()
+
+
+def assemble_file(filename, cache_dir=None):
+    """ Returns the ObjectFile of a source file.
+
+    With a cache_dir, objects are stored there by a hash of the source
+    and only sources not seen before are assembled.
+    """
+    f = open(filename, 'r')
+    source = f.read()
+    f.close()
+    if cache_dir is not None:
+        key = hashlib.sha1('%d\0%s' % (OBJECT_VERSION, source)).hexdigest()
+        path = os.path.join(cache_dir, key + '.obj')
+        if os.path.exists(path):
+            f = open(path, 'r')
+            data = f.read()
+            f.close()
+            return ObjectFile.loads(data, filename)
+
+    assembler = Assembler()
+    try:
+        for line in source.split("\n"):
+            assembler.feed(line)
+    except AssemblerError, e:
+        raise AssemblerError(e.msg, e.lineno, filename)
+    obj = assembler.object(filename)
+
+    if cache_dir is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Written aside and renamed, so a cached object is always whole
+        fd, temp = tempfile.mkstemp(dir=cache_dir)
+        os.write(fd, obj.dumps())
+        os.close(fd)
+        os.rename(temp, path)
+    return obj
+
+
+def assemble(prog, relax=True):
+    assembler = Assembler(relax)
+    for line in prog.split("\n"):
+        assembler.feed(line)
+    return assembler.finish()
+
+def assemble_stream(lines, out):
+    """ Assembles an iterable of lines, like a file, into out.
+
+    out has to be seekable, see StreamingAssembler.
+    """
+    assembler = StreamingAssembler(out)
+    for line in lines:
+        assembler.feed(line.rstrip('\n'))
+    assembler.finish()
 
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print "Usage: ./assembler.py file binary"
+    optparser = optparse.OptionParser(
+        usage='%prog [options] file [file ...] binary')
+    optparser.add_option('-c', '--cache', dest="cache",
+                         help="Directory to keep object files in")
+    optparser.add_option('-n', '--no-relax', action="store_false",
+                         dest="relax", default=True,
+                         help="Keep labels in next words")
+    optparser.add_option('-s', '--stream', action="store_true",
+                         dest="stream",
+                         help="Assemble one file as it's read, - for "
+                         "stdin and stdout. Implies -n")
+    (options, args) = optparser.parse_args(sys.argv[1:])
+    if len(args) < 2 or (options.stream and len(args) != 2):
+        optparser.print_help()
+        exit(1)
+    if options.stream:
+        fi = sys.stdin if args[0] == '-' else open(args[0], 'r')
+        # A pipe can't be seeked back into, go through a temporary file
+        fo = tempfile.TemporaryFile() if args[1] == '-' else \
+            open(args[1], 'wb')
+        try:
+            assemble_stream(fi, fo)
+        except AssemblerError, e:
+            print >> sys.stderr, str(e)
+            exit(1)
+        if args[1] == '-':
+            fo.seek(0)
+            shutil.copyfileobj(fo, sys.stdout)
+        fo.close()
+        exit(0)
+    try:
+        binary = link([assemble_file(filename, options.cache)
+                       for filename in args[:-1]], options.relax)
+    except AssemblerError, e:
+        print str(e)
         exit(1)
-    fi = open(sys.argv[1], 'r')
-    fo = open(sys.argv[2], 'w')
-    fo.write(assemble(fi.read()))
-    fi.close()
+    fo = open(args[-1], 'w')
+    fo.write(binary)
     fo.close()
@@ -0,0 +1,152 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from assembler import (assemble, assemble_file, assemble_stream, link,
+                       AssemblerError, StreamingAssembler)
+
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'sample.asm')
+
+def words(binary):
+    return list(struct.unpack('>%dH' % (len(binary) / 2), binary))
+
+class TestAssembler(unittest.TestCase):
+
+    def test_sample(self):
+        """ Assembles to the words in the comments of sample.asm """
+        expected = []
+        for line in open(SAMPLE):
+            if ';' in line and not line.strip().startswith(';'):
+                comment = line.split(';')[1].replace('[*]', '')
+                expected += [int(word, 16) for word in comment.split()]
+        self.assertEqual(words(assemble(open(SAMPLE).read(), relax=False)),
+                         expected)
+
+    def test_labels(self):
+        program = '\n'.join([
+            'SET PC, end',
+            ':start',
+            ':middle SET A, [start]',
+            ':end SET PC, middle',
+        ])
+        self.assertEqual(words(assemble(program, relax=False)),
+                         [0x7dc1, 0x4, 0x7801, 0x2, 0x7dc1, 0x2])
+
+    def test_relax(self):
+        program = '\n'.join([
+            'SET PC, far',
+            'SET PC, near',
+            ':near SET X, [near]',
+        ] + ['SET A, 1'] * 26 + [
+            ':far SET [far+I], far',
+        ])
+        # far only fits after near shrunk, [near] and [far+I] can't
+        self.assertEqual(words(assemble(program)),
+                         [0xf9c1, 0x89c1, 0x7831, 0x2] + [0x8401] * 26 +
+                         [0xf961, 0x1e])
+
+    def test_labels_are_per_call(self):
+        assemble(':start SET PC, start')
+        self.assertRaises(AssemblerError, assemble, 'SET PC, start')
+
+    def test_operands(self):
+        self.assertEqual(words(assemble('SET [0x10 + I], [0]')),
+                         [0x7961, 0x10, 0])
+        self.assertEqual(words(assemble('SET [I+0x10], PUSH')),
+                         [0x6961, 0x10])
+
+    def test_stream(self):
+        source = open(SAMPLE).read()
+        out = StringIO()
+        out.write('header')
+        assembler = StreamingAssembler(out)
+        # Small chunks so that forward references are seeked back to
+        assembler.chunk_words = 3
+        for line in source.split('\n'):
+            assembler.feed(line)
+        assembler.finish()
+        self.assertEqual(out.getvalue(),
+                         'header' + assemble(source, relax=False))
+
+        out = StringIO()
+        assemble_stream(open(SAMPLE), out)
+        self.assertEqual(out.getvalue(), assemble(source, relax=False))
+        self.assertRaises(AssemblerError, assemble_stream,
+                          ['SET PC, nowhere'], StringIO())
+        try:
+            StreamingAssembler(StringIO()).object('main.asm')
+            self.fail('No AssemblerError')
+        except AssemblerError, e:
+            self.assertEqual(e.filename, 'main.asm')
+            self.assertTrue('no object file' in str(e))
+
+    def test_errors(self):
+        for program, lineno in (('SET A, 1\nFOO A, 1', 2),
+                                ('SET A', 1),
+                                ('SET A, [B+C]', 1),
+                                ('SET A, 1 $', 1),
+                                ('\n:a SET A, 1\n:a SET A, 2', 3),
+                                ('SET PC, a\nSET PC, b\n:b', 1)):
+            try:
+                assemble(program)
+            except AssemblerError, e:
+                self.assertEqual(e.lineno, lineno)
+            else:
+                self.fail('No error for %r' % program)
+
+class TestLinker(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = os.path.join(self.directory, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, source):
+        path = os.path.join(self.directory, name)
+        f = open(path, 'w')
+        f.write(source)
+        f.close()
+        return path
+
+    def test_link(self):
+        main = self.write('main.asm', 'JSR sub\n:crash SET PC, crash')
+        sub = self.write('sub.asm', ':sub SET A, [data]\nSET PC, POP\n'
+                         ':data SET PC, crash')
+        objects = [assemble_file(main), assemble_file(sub)]
+        self.assertEqual(objects[0].imports, {'sub': 1})
+        source = open(main).read() + '\n' + open(sub).read()
+        for relax in (True, False):
+            self.assertEqual(link(objects, relax), assemble(source, relax))
+
+    def test_cache(self):
+        path = self.write('a.asm', ':a SET PC, a')
+        first = assemble_file(path, self.cache)
+        self.assertEqual(len(os.listdir(self.cache)), 1)
+        cached = assemble_file(path, self.cache)
+        self.assertEqual(cached.dumps(), first.dumps())
+        self.assertEqual(cached.name, path)
+        self.assertEqual(link([cached]), link([first]))
+
+        self.write('a.asm', ':a SET PC, b\n:b SET PC, a')
+        assemble_file(path, self.cache)
+        self.assertEqual(len(os.listdir(self.cache)), 2)
+
+    def test_errors(self):
+        a = assemble_file(self.write('a.asm', ':x SET PC, y'))
+        b = assemble_file(self.write('b.asm', ':x SET PC, x'))
+        self.assertRaises(AssemblerError, link, [a, b])
+        try:
+            link([a])
+        except AssemblerError, e:
+            self.assertEqual((e.filename, e.lineno), (a.name, 1))
+        else:
+            self.fail('No error for undefined label')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+""" Runs many DCPU-16 binaries on a pool of worker processes.
+
+Jobs are the files in a directory or the lines of a manifest, a JSON
+object per line like {"file": "a.bin", "limit": 1000, "cycles": 5000}.
+Each result is written as a line of JSON as soon as it's done.
+"""
+import json
+import multiprocessing
+import optparse
+import os
+import sys
+import time
+
+from cpu import ArrayCPU
+from emulator import Emulator, EmulatorError
+from translator import TranslatingEmulator
+from utils import load_program
+
+# One machine per worker process, reused for every job it runs
+worker = None
+
+
+def init_worker(translate):
+    global worker
+    cpu = ArrayCPU()
+    if translate:
+        worker = TranslatingEmulator(cpu)
+    else:
+        worker = Emulator(cpu)
+
+
+def run_job(job):
+    """ Runs a job on this process' machine, returns its result """
+    emulator = worker
+    cpu = emulator.cpu
+    started = time.time()
+    cpu.reset()
+    try:
+        load_program(cpu, job['file'])
+        reason = emulator.execute(0, job.get('limit'),
+                                  job.get('cycles')).reason
+    except EmulatorError, e:
+        reason = str(e)
+    except Exception, e:
+        reason = 'Error: %s: %s' % (e.__class__.__name__, e)
+
+    result = emulator.halt(reason).as_dict()
+    result['file'] = job['file']
+    result['wall_time'] = time.time() - started
+    return result
+
+
+def directory_jobs(path, limit, cycles):
+    return [{'file': os.path.join(path, name), 'limit': limit,
+             'cycles': cycles}
+            for name in sorted(os.listdir(path))
+            if os.path.isfile(os.path.join(path, name))]
+
+
+def manifest_jobs(path, limit, cycles):
+    """ Reads a manifest, files are relative to its directory """
+    jobs = []
+    f = open(path)
+    for line in f:
+        if not line.strip():
+            continue
+        job = json.loads(line)
+        job['file'] = os.path.join(os.path.dirname(path), job['file'])
+        job.setdefault('limit', limit)
+        job.setdefault('cycles', cycles)
+        jobs.append(job)
+    f.close()
+    return jobs
+
+
+def run_batch(jobs, out, processes=None, translate=False):
+    """ Runs jobs on a process pool, writing results to out """
+    pool = multiprocessing.Pool(processes, init_worker, (translate,))
+    try:
+        for result in pool.imap_unordered(run_job, jobs):
+            out.write(json.dumps(result, sort_keys=True) + '\n')
+            out.flush()
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    optparser = optparse.OptionParser(
+        usage='%prog [options] directory|manifest')
+    optparser.add_option('-l', '--limit', dest="limit",
+                         help="Max number of instructions per job")
+    optparser.add_option('-c', '--cycles', dest="cycles",
+                         help="Max number of cycles per job")
+    optparser.add_option('-j', '--jobs', dest="processes", type="int",
+                         help="Number of worker processes")
+    optparser.add_option('-o', '--output', dest="output",
+                         help="File to write results to, default stdout")
+    optparser.add_option('-t', '--translate', action="store_true",
+                         dest="translate",
+                         help="Compile basic blocks to Python functions")
+    (options, args) = optparser.parse_args(sys.argv[1:])
+
+    if len(args) != 1:
+        optparser.print_help()
+        exit(1)
+
+    limit = cycles = None
+    if options.limit:
+        limit = int(options.limit, 0)
+    if options.cycles:
+        cycles = int(options.cycles, 0)
+
+    if os.path.isdir(args[0]):
+        jobs = directory_jobs(args[0], limit, cycles)
+    else:
+        jobs = manifest_jobs(args[0], limit, cycles)
+    for job in jobs:
+        if job['limit'] is None and job['cycles'] is None:
+            print 'No instruction or cycle limit for %s' % job['file']
+            exit(1)
+
+    if options.output:
+        out = open(options.output, 'w')
+        run_batch(jobs, out, options.processes, options.translate)
+        out.close()
+    else:
+        run_batch(jobs, sys.stdout, options.processes, options.translate)
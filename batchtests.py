@@ -0,0 +1,64 @@
+import json
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from StringIO import StringIO
+
+import batch
+from constants import REG, OPCODE
+from utils import pack_instruction, Value
+
+# :loop ADD A, 1
+#       SET PC, loop
+LOOP = [pack_instruction(OPCODE.ADD, Value.reg(REG.A), Value.literal(1)),
+        pack_instruction(OPCODE.SET, Value.pc(), Value.literal(0))]
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name in ('a.bin', 'b.bin'):
+            f = open(os.path.join(self.directory, name), 'wb')
+            f.write(struct.pack('>%dH' % len(LOOP), *LOOP))
+            f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_run_job(self):
+        for translate in (False, True):
+            batch.init_worker(translate)
+            for i in range(2):
+                result = batch.run_job({
+                    'file': os.path.join(self.directory, 'a.bin'),
+                    'limit': 10, 'cycles': None})
+                self.assertEqual(result['registers']['A'], 5)
+                self.assertEqual(result['instructions'], 10)
+                self.assertEqual(result['cycles'], 15)
+                self.assertEqual(result['halt'], 'Instruction limit reached')
+
+    def test_run_job_both_limits(self):
+        batch.init_worker(False)
+        result = batch.run_job({'file': os.path.join(self.directory, 'a.bin'),
+                                'limit': 5000, 'cycles': 3000})
+        self.assertEqual(result['halt'], 'Cycle limit reached')
+        self.assertTrue(result['cycles'] >= 3000)
+
+    def test_run_batch(self):
+        manifest = os.path.join(self.directory, 'manifest')
+        f = open(manifest, 'w')
+        f.write('{"file": "a.bin", "limit": 4}\n{"file": "b.bin"}\n')
+        f.close()
+        out = StringIO()
+        batch.run_batch(batch.manifest_jobs(manifest, None, 7), out, 2)
+
+        results = dict((os.path.basename(result['file']), result) for result
+                       in map(json.loads, out.getvalue().splitlines()))
+        self.assertEqual(results['a.bin']['instructions'], 4)
+        self.assertEqual(results['b.bin']['halt'], 'Cycle limit reached')
+        self.assertEqual(results['b.bin']['cycles'], 8)
+
+if __name__ == '__main__':
+    unittest.main()
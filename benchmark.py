@@ -0,0 +1,280 @@
+#!/usr/bin/python
+""" Measures emulator, loader and assembler throughput.
+
+Every benchmark reports a rate, higher is better, as the best of a few
+repeats to keep the numbers stable. Results are written as JSON and can
+be compared against a baseline written earlier, exiting with 1 when
+anything got slower than the tolerance allows.
+"""
+import gc
+import json
+import optparse
+import os
+import sys
+import tempfile
+import timeit
+
+from assembler import assemble
+from constants import REG, OPCODE
+from cpu import CPU, ArrayCPU
+from emulator import Emulator
+from translator import TranslatingEmulator
+from utils import (load_program, pack_instruction, pack_special_instruction,
+                   Value)
+from values import value_lookup
+
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'sample.asm')
+RESULTS_VERSION = 1
+REPEAT = 7
+# Slowdown tolerated by compare
+TOLERANCE = 0.1
+
+def op(opcode, b, a):
+    return pack_instruction(opcode, b, a)
+
+def reg(register):
+    return Value.reg(register)
+
+def lit(value):
+    return Value.literal(value)
+
+# The workloads run forever, the benchmark runs a number of instructions
+
+# :loop ADD A, 7 ; MUL B, A ; XOR C, B ; SHR C, 1 ; AND X, C ; BOR Y, A
+#       SUB Z, 1 ; SET PC, loop
+ARITHMETIC = [
+    op(OPCODE.ADD, reg(REG.A), lit(7)),
+    op(OPCODE.MUL, reg(REG.B), reg(REG.A)),
+    op(OPCODE.XOR, reg(REG.C), reg(REG.B)),
+    op(OPCODE.SHR, reg(REG.C), lit(1)),
+    op(OPCODE.AND, reg(REG.X), reg(REG.C)),
+    op(OPCODE.BOR, reg(REG.Y), reg(REG.A)),
+    op(OPCODE.SUB, reg(REG.Z), lit(1)),
+    op(OPCODE.SET, Value.pc(), lit(0)),
+]
+
+# :start SET I, 0x1000 ; SET J, 0x8000
+# :copy STI [J], [I] (x4) ; IFN I, 0x2000 ; SET PC, copy ; SET PC, start
+COPY = [
+    op(OPCODE.SET, reg(REG.I), Value.next_word_literal()), 0x1000,
+    op(OPCODE.SET, reg(REG.J), Value.next_word_literal()), 0x8000,
+] + [op(OPCODE.STI, Value.addr_reg(REG.J), Value.addr_reg(REG.I))] * 4 + [
+    op(OPCODE.IFN, reg(REG.I), Value.next_word_literal()), 0x2000,
+    op(OPCODE.SET, Value.pc(), lit(4)),
+    op(OPCODE.SET, Value.pc(), lit(0)),
+]
+
+# :start SET A, 200 ; JSR down ; SET PC, start
+# :down IFN A, 0 ; SET PC, deeper ; SET PC, POP
+# :deeper SUB A, 1 ; JSR down ; SET PC, POP
+RECURSION = [
+    op(OPCODE.SET, reg(REG.A), Value.next_word_literal()), 200,
+    pack_special_instruction(OPCODE.JSR, lit(5)),
+    op(OPCODE.SET, Value.pc(), lit(0)),
+    0,
+    op(OPCODE.IFN, reg(REG.A), lit(0)),
+    op(OPCODE.SET, Value.pc(), lit(8)),
+    op(OPCODE.SET, Value.pc(), Value.push_pop()),
+    op(OPCODE.SUB, reg(REG.A), lit(1)),
+    pack_special_instruction(OPCODE.JSR, lit(5)),
+    op(OPCODE.SET, Value.pc(), Value.push_pop()),
+]
+
+# :loop SET PUSH, A ; SET PUSH, B ; ADD A, PEEK ; SET B, POP ; SET C, POP
+#       ADD B, 3 ; SET PC, loop
+STACK = [
+    op(OPCODE.SET, Value.push_pop(), reg(REG.A)),
+    op(OPCODE.SET, Value.push_pop(), reg(REG.B)),
+    op(OPCODE.ADD, reg(REG.A), Value.peek()),
+    op(OPCODE.SET, reg(REG.B), Value.push_pop()),
+    op(OPCODE.SET, reg(REG.C), Value.push_pop()),
+    op(OPCODE.ADD, reg(REG.B), lit(3)),
+    op(OPCODE.SET, Value.pc(), lit(0)),
+]
+
+WORKLOADS = [
+    ('arithmetic', ARITHMETIC),
+    ('copy', COPY),
+    ('recursion', RECURSION),
+    ('stack', STACK),
+]
+EMULATORS = [
+    ('interpreted', Emulator),
+    ('translated', TranslatingEmulator),
+]
+
+
+def best_rate(function, repeat):
+    """ Returns the highest count / seconds of repeat calls to function,
+    which returns the count of what it did.
+    """
+    best = 0
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in range(repeat):
+            started = timeit.default_timer()
+            count = function()
+            elapsed = timeit.default_timer() - started
+            best = max(best, count / max(elapsed, 1e-9))
+    finally:
+        if enabled:
+            gc.enable()
+    return best
+
+
+def emulator_benchmark(emulator_class, program, instructions):
+    cpu = ArrayCPU()
+    cpu.load(program)
+    emulator = emulator_class(cpu)
+    # Warm decode caches and translated blocks
+    emulator.run(instructions // 10)
+    def run():
+        emulator.run(instructions)
+        return instructions
+    return run
+
+
+def construction_benchmark(cpu_class, count):
+    def construct():
+        for i in range(count):
+            cpu_class()
+        return count
+    return construct
+
+
+def load_benchmark(path, count):
+    cpu = ArrayCPU()
+    def load():
+        for i in range(count):
+            load_program(cpu, path)
+        return count
+    return load
+
+
+def assembler_benchmark(source, count):
+    lines = source.count('\n') + 1
+    def run():
+        for i in range(count):
+            assemble(source)
+        return count * lines
+    return run
+
+
+def value_lookup_benchmark(count):
+    cpu = ArrayCPU()
+    # Every value that doesn't read a next word
+    values = [val for val in range(0x40)
+              if val not in (0x10, 0x11, 0x12, 0x13, 0x14, 0x15, 0x16, 0x17,
+                             0x1a, 0x1e, 0x1f)]
+    def run():
+        for i in range(count):
+            for val in values:
+                value_lookup(cpu, val, True)
+        return count * len(values)
+    return run
+
+
+def benchmarks(scale=1.0):
+    """ Returns (name, unit, setup, args) of every benchmark, setup(*args)
+    returns the function to time.
+    """
+    def scaled(count):
+        return max(1, int(count * scale))
+    suite = []
+    for name, emulator_class in EMULATORS:
+        for workload, program in WORKLOADS:
+            suite.append(('%s.%s' % (name, workload), 'instructions/s',
+                          emulator_benchmark,
+                          (emulator_class, program, scaled(50000))))
+    suite.append(('construct.CPU', 'cpus/s', construction_benchmark,
+                  (CPU, scaled(10))))
+    suite.append(('construct.ArrayCPU', 'cpus/s', construction_benchmark,
+                  (ArrayCPU, scaled(1000))))
+    suite.append(('assembler.sample', 'lines/s', assembler_benchmark,
+                  (open(SAMPLE).read(), scaled(200))))
+    suite.append(('values.value_lookup', 'lookups/s',
+                  value_lookup_benchmark, (scaled(2000),)))
+    return suite
+
+
+def run_benchmarks(scale=1.0, repeat=REPEAT, only=None):
+    """ Runs the benchmarks whose names start with one of only, or all,
+    returns results ready for JSON.
+    """
+    fd, path = tempfile.mkstemp()
+    try:
+        os.write(fd, '\xaa\x55' * 0x10000)
+        os.close(fd)
+        suite = benchmarks(scale)
+        suite.append(('load.ram_image', 'loads/s', load_benchmark,
+                      (path, max(1, int(1000 * scale)))))
+        results = {}
+        for name, unit, setup, args in suite:
+            if only and not any(name.startswith(prefix) for prefix in only):
+                continue
+            results[name] = {'value': best_rate(setup(*args), repeat),
+                             'unit': unit}
+    finally:
+        os.remove(path)
+    return {
+        'version': RESULTS_VERSION,
+        'python': sys.version.split()[0],
+        'results': results,
+    }
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """ Returns (name, baseline value, value, change) of every benchmark
+    slower than baseline by more than tolerance.
+    """
+    regressions = []
+    for name, result in sorted(results['results'].iteritems()):
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        change = result['value'] / base['value'] - 1
+        if change < -tolerance:
+            regressions.append((name, base['value'], result['value'],
+                                change))
+    return regressions
+
+
+if __name__ == '__main__':
+    optparser = optparse.OptionParser(usage='%prog [options] [prefix...]')
+    optparser.add_option('-o', '--output', dest="output",
+                         help="File to write the results to as JSON")
+    optparser.add_option('-b', '--baseline', dest="baseline",
+                         help="Results to compare against")
+    optparser.add_option('-t', '--tolerance', dest="tolerance",
+                         type="float", default=TOLERANCE,
+                         help="Slowdown allowed against the baseline, "
+                              "default %default")
+    optparser.add_option('-s', '--scale', dest="scale", type="float",
+                         default=1.0, help="Multiplies the work done")
+    (options, args) = optparser.parse_args(sys.argv[1:])
+
+    results = run_benchmarks(options.scale, only=args)
+    baseline = None
+    if options.baseline:
+        baseline = json.load(open(options.baseline))
+    for name, result in sorted(results['results'].iteritems()):
+        line = '%-28s %14.0f %s' % (name, result['value'], result['unit'])
+        base = baseline and baseline['results'].get(name)
+        if base:
+            line += ' (%+.1f%%)' % (100.0 * (result['value'] / base['value']
+                                             - 1))
+        print line
+    if options.output:
+        f = open(options.output, 'w')
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
+        f.close()
+    if baseline:
+        regressions = compare(results, baseline, options.tolerance)
+        for name, before, after, change in regressions:
+            print 'Regression: %s %.0f -> %.0f (%.1f%%)' % (
+                name, before, after, 100 * change)
+        if regressions:
+            exit(1)
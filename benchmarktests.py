@@ -0,0 +1,36 @@
+import json
+import unittest
+
+from benchmark import run_benchmarks, compare
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_run(self):
+        results = run_benchmarks(scale=0.01, repeat=1)
+        self.assertTrue(json.loads(json.dumps(results)) == results)
+        names = results['results'].keys()
+        for name in ('interpreted.recursion', 'translated.copy',
+                     'construct.ArrayCPU', 'load.ram_image',
+                     'assembler.sample', 'values.value_lookup'):
+            self.assertTrue(name in names, name)
+        for result in results['results'].itervalues():
+            self.assertTrue(result['value'] > 0)
+
+        only = run_benchmarks(scale=0.01, repeat=1, only=['assembler'])
+        self.assertEqual(only['results'].keys(), ['assembler.sample'])
+
+    def test_compare(self):
+        def results(**values):
+            return {'results': dict((name, {'value': value, 'unit': 'x/s'})
+                                    for name, value in values.iteritems())}
+        baseline = results(a=100.0, b=100.0, c=100.0)
+        self.assertEqual(compare(results(a=95.0, b=150.0, d=1.0), baseline),
+                         [])
+        regressions = compare(results(a=80.0, b=150.0), baseline)
+        self.assertEqual([regression[:3] for regression in regressions],
+                         [('a', 100.0, 80.0)])
+        self.assertAlmostEqual(regressions[0][3], -0.2)
+        self.assertEqual(compare(results(a=80.0), baseline, 0.25), [])
+
+if __name__ == '__main__':
+    unittest.main()
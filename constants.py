@@ -43,6 +43,62 @@ class OPCODE(object):
 
     # Special opcodes
     JSR = 0x01
+    INT = 0x08
+    IAG = 0x09
+    IAS = 0x0a
+    RFI = 0x0b
+    IAQ = 0x0c
+    HWN = 0x10
+    HWQ = 0x11
+    HWI = 0x12
+
+# Cycles to perform an opcode
+BASIC_CYCLES = {
+    OPCODE.SET: 1,
+    OPCODE.ADD: 2,
+    OPCODE.SUB: 2,
+    OPCODE.MUL: 2,
+    OPCODE.MLI: 2,
+    OPCODE.DIV: 3,
+    OPCODE.DVI: 3,
+    OPCODE.MOD: 3,
+    OPCODE.MDI: 3,
+    OPCODE.AND: 1,
+    OPCODE.BOR: 1,
+    OPCODE.XOR: 1,
+    OPCODE.SHR: 1,
+    OPCODE.ASR: 1,
+    OPCODE.SHL: 1,
+    OPCODE.IFB: 2,
+    OPCODE.IFC: 2,
+    OPCODE.IFE: 2,
+    OPCODE.IFN: 2,
+    OPCODE.IFG: 2,
+    OPCODE.IFA: 2,
+    OPCODE.IFL: 2,
+    OPCODE.IFU: 2,
+    OPCODE.ADX: 3,
+    OPCODE.SBX: 3,
+    OPCODE.STI: 2,
+    OPCODE.STD: 2,
+}
+
+SPECIAL_CYCLES = {
+    OPCODE.JSR: 3,
+    OPCODE.INT: 4,
+    OPCODE.IAG: 1,
+    OPCODE.IAS: 1,
+    OPCODE.RFI: 3,
+    OPCODE.IAQ: 2,
+    OPCODE.HWN: 2,
+    OPCODE.HWQ: 4,
+    OPCODE.HWI: 4,
+}
+
+# Cycles to look up a value, indexed by value. Only the ones reading the
+# next word cost anything.
+VALUE_CYCLES = [1 if 0x10 <= val <= 0x17 or val in (0x1a, 0x1e, 0x1f) else 0
+                for val in range(0x40)]
 
 
 opcode_to_instruction = {
@@ -0,0 +1,245 @@
+""" Runs many emulators as cooperative tasks of one event loop.
+
+Python 2 has no asyncio, so this is a small loop of its own: callbacks
+run in the order they were scheduled, and coroutines are generators
+yielding the Futures they wait on, e.g.
+
+    def session(machine):
+        message = yield machine.wait_interrupt()
+        result = yield machine.halted
+
+    loop.spawn(session(machine))
+
+An AsyncEmulator runs a slice of instructions per turn and schedules
+its next slice behind everything else that is ready, so machines are
+run round robin and none waits longer than one slice of every other.
+"""
+import time
+from collections import deque
+
+from emulator import EmulatorError
+
+# Instructions run per turn of a machine
+SLICE = 1000
+
+
+class Future(object):
+    """ A result that isn't there yet """
+    def __init__(self, loop):
+        self.loop = loop
+        self.callbacks = []
+        self.finished = False
+        self.result = None
+        self.exception = None
+
+    def done(self):
+        return self.finished
+
+    def get(self):
+        """ Returns the result, or raises the exception it was set to """
+        if not self.finished:
+            raise RuntimeError('Future is not done')
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def add_done_callback(self, callback):
+        """ Schedules callback(future) once done """
+        if self.finished:
+            self.loop.call_soon(callback, self)
+        else:
+            self.callbacks.append(callback)
+
+    def set_result(self, result):
+        self.finish(result, None)
+
+    def set_exception(self, exception):
+        self.finish(None, exception)
+
+    def finish(self, result, exception):
+        if self.finished:
+            raise RuntimeError('Future is already done')
+        self.finished = True
+        self.result = result
+        self.exception = exception
+        for callback in self.callbacks:
+            self.loop.call_soon(callback, self)
+        self.callbacks = []
+
+
+class Task(Future):
+    """ Runs a generator, resuming it with what its Futures resolve to.
+
+    The task's result is the value of the StopIteration ending it.
+    """
+    def __init__(self, loop, generator):
+        Future.__init__(self, loop)
+        self.generator = generator
+        loop.call_soon(self.resume, None)
+
+    def resume(self, future):
+        try:
+            if future is None:
+                waiting = self.generator.next()
+            elif future.exception is not None:
+                waiting = self.generator.throw(future.exception)
+            else:
+                waiting = self.generator.send(future.result)
+        except StopIteration, e:
+            self.set_result(e.args[0] if e.args else None)
+            return
+        except Exception, e:
+            self.set_exception(e)
+            return
+        if not isinstance(waiting, Future):
+            self.set_exception(TypeError('Tasks can only wait for Futures, '
+                                         'not %r' % (waiting,)))
+            return
+        waiting.add_done_callback(self.resume)
+
+
+class Loop(object):
+    """ Runs callbacks first in first out """
+    def __init__(self):
+        self.ready = deque()
+
+    def call_soon(self, callback, *args):
+        self.ready.append((callback, args))
+
+    def spawn(self, generator):
+        """ Runs generator as a Task, returns the Task """
+        return Task(self, generator)
+
+    def run_once(self):
+        """ Runs the callbacks that were ready, returns how many ran.
+
+        Callbacks they schedule wait for the next call, so a host with
+        its own loop can call this from it without being starved.
+        """
+        ready = self.ready
+        count = len(ready)
+        for i in range(count):
+            callback, args = ready.popleft()
+            callback(*args)
+        return count
+
+    def run_until_complete(self, future):
+        """ Runs until future is done, returns its result """
+        while not future.done():
+            if not self.run_once():
+                raise RuntimeError('Nothing left to run')
+        return future.get()
+
+    def run_for(self, seconds):
+        """ Runs until nothing is ready or seconds passed """
+        end = time.time() + seconds
+        while time.time() < end and self.run_once():
+            pass
+
+
+class AsyncEmulator(object):
+    """ Runs emulator on loop in slices of SLICE instructions.
+
+    halted is a Future of the ExecutionResult, or of the EmulatorError
+    the program stopped with. Any other exception raised while running
+    a slice, by a device say, halts only this machine the same way.
+    """
+    def __init__(self, emulator, loop, slice=SLICE):
+        self.emulator = emulator
+        self.cpu = emulator.cpu
+        self.loop = loop
+        self.slice = slice
+        self.halted = Future(loop)
+        self.paused = False
+        self.scheduled = False
+        self.stopping = False
+        self.waiting = []
+        emulator.on_interrupt = self.interrupted
+
+    def start(self, limit=None, cycles=None):
+        """ Runs until limit instructions or cycles cycles, returns halted """
+        cpu = self.cpu
+        self.instructions, self.cycles = cpu.instructions, cpu.cycles
+        self.last = None if limit is None else cpu.instructions + limit
+        self.end = None if cycles is None else cpu.cycles + cycles
+        self.schedule()
+        return self.halted
+
+    def schedule(self):
+        if not self.scheduled and not self.paused:
+            self.scheduled = True
+            self.loop.call_soon(self.turn)
+
+    def turn(self):
+        self.scheduled = False
+        if self.paused:
+            return
+        cpu, emulator = self.cpu, self.emulator
+        if self.stopping:
+            self.halt('Stopped')
+            return
+        count = self.slice
+        if self.last is not None:
+            count = min(count, self.last - cpu.instructions)
+        try:
+            if self.end is None:
+                emulator.run(count)
+            else:
+                emulator.run_cycles(self.end - cpu.cycles, count)
+        except Exception, e:
+            self.halted.set_exception(e)
+            self.fail_waiting(e)
+            return
+        if self.last is not None and cpu.instructions >= self.last:
+            self.halt('Instruction limit reached')
+        elif self.end is not None and cpu.cycles >= self.end:
+            self.halt('Cycle limit reached')
+        else:
+            self.schedule()
+
+    def halt(self, reason):
+        self.halted.set_result(self.emulator.halt(reason, self.instructions,
+                                                  self.cycles))
+        self.fail_waiting(EmulatorError(reason))
+
+    def fail_waiting(self, error):
+        for future in self.waiting:
+            future.set_exception(error)
+        self.waiting = []
+
+    def stop(self):
+        """ Halts with 'Stopped' at the end of the current slice """
+        self.stopping = True
+        self.resume()
+
+    def pause(self):
+        """ Stops running slices until resume() """
+        self.paused = True
+
+    def resume(self):
+        if self.halted.done():
+            return
+        self.paused = False
+        self.schedule()
+
+    def interrupt(self, message):
+        """ Raises a hardware interrupt and resumes the machine if paused """
+        self.cpu.bus.interrupt(message)
+        self.resume()
+
+    def wait_interrupt(self):
+        """ Returns a Future of the next interrupt message triggered.
+
+        Set to an EmulatorError if the machine halts first.
+        """
+        future = Future(self.loop)
+        if self.halted.done():
+            future.set_exception(EmulatorError('Halted'))
+        else:
+            self.waiting.append(future)
+        return future
+
+    def interrupted(self, message):
+        waiting, self.waiting = self.waiting, []
+        for future in waiting:
+            future.set_result(message)
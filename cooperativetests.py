@@ -0,0 +1,106 @@
+import unittest
+
+from cpu import ArrayCPU
+from constants import REG, OPCODE
+from cooperative import Loop, AsyncEmulator
+from emulator import Emulator, EmulatorError, InvalidOpcode
+from hardware import Device
+from utils import pack_instruction, pack_special_instruction, Value
+
+# :loop ADD A, 1 ; INT 5 ; SET PC, loop
+PROGRAM = [
+    pack_instruction(OPCODE.ADD, Value.reg(REG.A), Value.literal(1)),
+    pack_special_instruction(OPCODE.INT, Value.literal(5)),
+    pack_instruction(OPCODE.SET, Value.pc(), Value.literal(0)),
+]
+
+class TestCooperative(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = Loop()
+
+    def machine(self, program=PROGRAM, slice=30):
+        cpu = ArrayCPU()
+        cpu.load(program)
+        return AsyncEmulator(Emulator(cpu), self.loop, slice)
+
+    def test_round_robin(self):
+        machines = [self.machine() for i in range(100)]
+        halted = [machine.start(limit=300) for machine in machines]
+        for i in range(3):
+            self.loop.run_once()
+            self.assertEqual(set(machine.cpu.instructions
+                                 for machine in machines),
+                             set([30 * (i + 1)]))
+        for machine, future in zip(machines, halted):
+            result = self.loop.run_until_complete(future)
+            self.assertEqual(result.reason, 'Instruction limit reached')
+            self.assertEqual(result.instructions, 300)
+            self.assertEqual(machine.cpu.registers[REG.A].value, 100)
+
+    def test_cycles(self):
+        machine = self.machine()
+        result = self.loop.run_until_complete(machine.start(cycles=100))
+        self.assertEqual(result.reason, 'Cycle limit reached')
+        self.assertTrue(0 <= result.cycles - 100 < 5)
+
+    def test_coroutine(self):
+        machine = self.machine()
+        machine.start(limit=1000)
+        def session():
+            messages = []
+            for i in range(3):
+                message = yield machine.wait_interrupt()
+                messages.append(message)
+            machine.stop()
+            result = yield machine.halted
+            raise StopIteration((messages, result.reason))
+        messages, reason = self.loop.run_until_complete(
+            self.loop.spawn(session()))
+        self.assertEqual(messages, [5, 5, 5])
+        self.assertEqual(reason, 'Stopped')
+        self.assertRaises(EmulatorError, self.loop.run_until_complete,
+                          machine.wait_interrupt())
+
+    def test_errors(self):
+        machine = self.machine([0x18])
+        def session():
+            try:
+                yield machine.start()
+            except InvalidOpcode:
+                raise StopIteration('caught')
+        self.assertEqual(self.loop.run_until_complete(
+            self.loop.spawn(session())), 'caught')
+
+    def test_faulting_neighbour(self):
+        class Broken(Device):
+            def interrupt(self):
+                raise ValueError('Broken')
+        faulting = self.machine([
+            # HWI 0
+            pack_special_instruction(OPCODE.HWI, Value.literal(0)),
+        ])
+        faulting.cpu.bus.attach(Broken())
+        machines = [self.machine(), faulting, self.machine()]
+        halted = [machine.start(limit=300) for machine in machines]
+        waiting = faulting.wait_interrupt()
+        self.loop.run_until_complete(halted[0])
+        self.loop.run_until_complete(halted[2])
+        self.assertRaises(ValueError, halted[1].get)
+        self.assertRaises(ValueError, waiting.get)
+        for machine in machines[::2]:
+            self.assertEqual(machine.cpu.instructions, 300)
+
+    def test_pause(self):
+        machine = self.machine()
+        machine.start(limit=100)
+        machine.pause()
+        self.assertEqual(self.loop.run_once(), 1)
+        self.assertEqual(self.loop.run_once(), 0)
+        self.assertEqual(machine.cpu.instructions, 0)
+        machine.interrupt(1)
+        self.loop.run_until_complete(machine.halted)
+        self.assertEqual(machine.cpu.instructions, 100)
+
+if __name__ == '__main__':
+    unittest.main()
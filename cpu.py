@@ -1,5 +1,52 @@
-from ctypes import c_uint16
+import mmap
+import struct
+import sys
+import zlib
+from array import array
+from ctypes import (Array, addressof, c_uint16, memmove, memset, sizeof,
+                    string_at)
 from constants import REG, regidx_to_name
+from hardware import Bus
+
+RAM_WORDS = 0x10000
+# Snapshots keep ram in pages of this many words
+PAGE_SHIFT = 8
+PAGE_WORDS = 1 << PAGE_SHIFT
+PAGE_BYTES = PAGE_WORDS * 2
+PAGES = RAM_WORDS // PAGE_WORDS
+# Values of a CPU's dirty pages
+CLEAN = bytearray(PAGES)
+DIRTY = bytearray('\x01' * PAGES)
+
+# Snapshot.dumps header: registers, SP, PC, EX, IA, queueing,
+# skip_instruction, cycles, instructions and the queued interrupt count
+SNAPSHOT_HEADER = struct.Struct('<12H2?2QH')
+
+# Layout of the ArrayCPU register file
+REGFILE_SP = 0x8
+REGFILE_PC = 0x9
+REGFILE_EX = 0xa
+REGFILE_WORDS = 0xb
+
+# Layout of a shared machine file: the register file, then ram
+SHARED_RAM_OFFSET = 0x40
+SHARED_BYTES = SHARED_RAM_OFFSET + RAM_WORDS * 2
+
+
+def big_endian_words(data, limit=RAM_WORDS):
+    """ Returns an array of the first limit big endian words of data """
+    words = array('H')
+    words.fromstring(data[:min(len(data) >> 1, limit) << 1])
+    if sys.byteorder == 'little':
+        words.byteswap()
+    return words
+
+
+def mark_dirty(dirty, start, end):
+    """ Marks the pages of the words from start up to end as dirty """
+    if start < end:
+        first, last = start >> PAGE_SHIFT, ((end - 1) >> PAGE_SHIFT) + 1
+        dirty[first:last] = DIRTY[first:last]
 
 
 class MemoryCell(object):
@@ -11,6 +58,87 @@ class MemoryCell(object):
     def __repr__(self):
         return '<%s> %d' % (self.hint, self.value)
 
+class CellWords(object):
+    """ Word level (int) access to a list of cells """
+    def __init__(self, cells):
+        self.cells = cells
+
+    def __getitem__(self, addr):
+        # Reading doesn't dirty the page
+        return list.__getitem__(self.cells, addr).value
+
+    def __setitem__(self, addr, word):
+        self.cells[addr].value = word
+
+    def __len__(self):
+        return len(self.cells)
+
+
+class CellList(list):
+    """ The cells of CPU ram, marking the page of every cell handed out
+    as dirty, as it may be written.
+    """
+    def __init__(self, cells, dirty):
+        list.__init__(self, cells)
+        self.dirty = dirty
+
+    def __getitem__(self, addr):
+        self.dirty[addr >> PAGE_SHIFT] = 1
+        return list.__getitem__(self, addr)
+
+
+class Snapshot(object):
+    """ The state of a CPU, see CPU.snapshot.
+
+    pages holds ram as native endian strings of PAGE_WORDS words each.
+    """
+    __slots__ = ('registers', 'SP', 'PC', 'EX', 'IA', 'queueing',
+                 'interrupts', 'skip_instruction', 'cycles', 'instructions',
+                 'pages')
+
+    def __init__(self, cpu, pages):
+        self.registers = tuple(cpu.registers[reg].value
+                               for reg in sorted(cpu.registers))
+        self.SP = cpu.SP.value
+        self.PC = cpu.PC.value
+        self.EX = cpu.EX.value
+        self.IA = cpu.IA.value
+        self.queueing = cpu.queueing
+        self.interrupts = tuple(cpu.bus.interrupts.pending())
+        self.skip_instruction = cpu.skip_instruction
+        self.cycles = cpu.cycles
+        self.instructions = cpu.instructions
+        self.pages = pages
+
+    def dumps(self):
+        """ Returns the snapshot as a compact string, see loads """
+        header = SNAPSHOT_HEADER.pack(*(
+            self.registers + (self.SP, self.PC, self.EX, self.IA,
+                              self.queueing, self.skip_instruction,
+                              self.cycles, self.instructions,
+                              len(self.interrupts))))
+        return (header + array('H', self.interrupts).tostring() +
+                zlib.compress(''.join(self.pages), 1))
+
+    @classmethod
+    def loads(cls, data):
+        """ Returns the Snapshot dumped to data """
+        fields = SNAPSHOT_HEADER.unpack_from(data)
+        snapshot = cls.__new__(cls)
+        snapshot.registers = fields[:8]
+        (snapshot.SP, snapshot.PC, snapshot.EX, snapshot.IA,
+         snapshot.queueing, snapshot.skip_instruction, snapshot.cycles,
+         snapshot.instructions, count) = fields[8:]
+        start = SNAPSHOT_HEADER.size
+        interrupts = array('H')
+        interrupts.fromstring(data[start:start + count * 2])
+        image = zlib.decompress(data[start + count * 2:])
+        snapshot.interrupts = tuple(interrupts)
+        snapshot.pages = tuple(image[start:start + PAGE_BYTES]
+                               for start in range(0, len(image), PAGE_BYTES))
+        return snapshot
+
+
 class CPU(object):
     def __init__(self, memory_type=c_uint16):
         self.registers = {
@@ -23,13 +151,310 @@ class CPU(object):
             REG.I: memory_type(0),
             REG.J: memory_type(0)
         }
-        self.ram = [memory_type(0) for x in range(0x10000)]
+        # Pages of ram written since the last snapshot taken or restored
+        self.dirty = bytearray(DIRTY)
+        self.ram = CellList([memory_type(0) for x in range(RAM_WORDS)],
+                            self.dirty)
+        self.memory = CellWords(self.ram)
         self.SP = memory_type(0xffff)
         self.PC = memory_type(0)
         self.EX = memory_type(0)
+        # Interrupt address, and whether interrupts are queued
+        self.IA = memory_type(0)
+        self.queueing = False
+        self.skip_instruction = False
+        self.cycles = 0
+        self.instructions = 0
+        # Pages of the last snapshot taken or restored
+        self.snapshot_pages = None
+        # Whether ram is written without marking dirty pages
+        self.untracked = False
+        self.bus = Bus(self)
+
+    def load(self, words, offset=0):
+        """ Copies a sequence of words into ram starting at offset """
+        for idx, word in enumerate(words):
+            self.memory[offset + idx] = word
+
+    def reset(self):
+        """ Clears ram and registers for running another program """
+        for cell in self.registers.itervalues():
+            cell.value = 0
+        for cell in self.ram:
+            cell.value = 0
+        self.dirty[:] = DIRTY
+        self.reset_state()
+
+    def reset_state(self):
+        self.SP.value = 0xffff
+        self.PC.value = 0
+        self.EX.value = 0
+        self.IA.value = 0
+        self.queueing = False
         self.skip_instruction = False
+        self.cycles = 0
+        self.instructions = 0
+        self.bus.reset()
+
+    def load_binary(self, data, offset=0):
+        """ Copies a big endian binary or ram image into ram at offset.
+
+        data is a string or anything sliceable into one, like an mmap.
+        Words that don't fit in ram are ignored.
+        """
+        self.load(big_endian_words(data, RAM_WORDS - offset), offset)
+
+    def dump_binary(self):
+        """ Returns ram as a big endian image, see load_binary """
+        words = array('H')
+        words.fromstring(self.ram_image())
+        if sys.byteorder == 'little':
+            words.byteswap()
+        return words.tostring()
+
+    def snapshot(self):
+        """ Returns a Snapshot of the machine to restore later.
+
+        Pages of ram that weren't written since the previous snapshot,
+        or the one restored last, are shared with it as they are. Only
+        the dirty pages are read, and still shared when unchanged, so a
+        snapshot costs about the pages written in between.
+        """
+        base, dirty = self.snapshot_pages, self.dirty
+        if base is None or self.untracked:
+            dirty[:] = DIRTY
+        pages = [None] * PAGES if base is None else list(base)
+        changed = False
+        page = dirty.find('\x01')
+        while page >= 0:
+            words = self.page_image(page)
+            if base is None or words != base[page]:
+                pages[page] = words
+                changed = True
+            page = dirty.find('\x01', page + 1)
+        pages = tuple(pages) if changed else base
+        dirty[:] = CLEAN
+        self.snapshot_pages = pages
+        return Snapshot(self, pages)
+
+    def restore(self, snapshot):
+        """ Returns the machine to the state of a snapshot """
+        for reg, value in zip(sorted(self.registers), snapshot.registers):
+            self.registers[reg].value = value
+        self.SP.value = snapshot.SP
+        self.PC.value = snapshot.PC
+        self.EX.value = snapshot.EX
+        self.IA.value = snapshot.IA
+        self.queueing = snapshot.queueing
+        interrupts = self.bus.interrupts
+        interrupts.clear()
+        for message in snapshot.interrupts:
+            interrupts.push(message)
+        if interrupts:
+            self.bus.wake()
+        self.skip_instruction = snapshot.skip_instruction
+        self.cycles = snapshot.cycles
+        self.instructions = snapshot.instructions
+        # Pages still holding what they did in the last snapshot are
+        # only written when that snapshot's page differs
+        base, dirty = self.snapshot_pages, self.dirty
+        if base is None or self.untracked:
+            dirty[:] = DIRTY
+        for page, words in enumerate(snapshot.pages):
+            if dirty[page] or base[page] is not words:
+                self.load_page(page, words)
+        dirty[:] = CLEAN
+        self.snapshot_pages = snapshot.pages
+
+    def page_image(self, page):
+        """ Returns page of ram as a native endian string """
+        start = page * PAGE_WORDS
+        return array('H', [cell.value for cell in
+                           self.ram[start:start + PAGE_WORDS]]).tostring()
+
+    def load_page(self, page, image):
+        words = array('H')
+        words.fromstring(image)
+        start = page * PAGE_WORDS
+        for cell, word in zip(self.ram[start:start + PAGE_WORDS], words):
+            cell.value = word
+
+    def ram_image(self):
+        """ Returns ram as a native endian string """
+        return array('H', [cell.value for cell in self.ram]).tostring()
+
+    def load_ram_image(self, image):
+        words = array('H')
+        words.fromstring(image)
+        for cell, word in zip(self.ram, words):
+            cell.value = word
+        self.dirty[:] = DIRTY
 
     def dump_registers(self):
         print "REGISTERS:"
-        print ", ".join(["%s: %d" % (regidx_to_name[k], self.registers[k])
+        print ", ".join(["%s: %d" % (regidx_to_name[k], self.registers[k].value)
                         for k in self.registers.iterkeys()])
+
+
+class RAM(Array):
+    """ The words of ArrayCPU ram, marking the pages written in dirty.
+
+    Reading is as fast as from a plain array, writing costs about a
+    function call more.
+    """
+    _type_ = c_uint16
+    _length_ = RAM_WORDS
+
+    def __setitem__(self, addr, word, setitem=Array.__setitem__):
+        setitem(self, addr, word)
+        try:
+            self.dirty[addr >> PAGE_SHIFT] = 1
+        except TypeError:
+            # An extended slice
+            self.dirty[:] = DIRTY
+
+    def __setslice__(self, start, end, words):
+        Array.__setslice__(self, start, end, words)
+        mark_dirty(self.dirty, start, min(end, RAM_WORDS))
+
+
+class RAMCells(object):
+    """ Lazily created c_uint16 views into a flat word buffer.
+
+    Indexing returns a cell with a .value attribute just like the list
+    used by CPU, but a cell is only allocated the first time an address
+    is touched, into a fixed slot per word of the buffer. Addresses wrap
+    around at 0x10000, and the page of a cell handed out is marked in
+    dirty as it may be written. Prefer reading and writing plain words
+    through the buffer itself where no cell is needed, it is several
+    times cheaper.
+    """
+    __slots__ = ('words', 'cells', 'dirty')
+
+    def __init__(self, words, dirty):
+        self.words = words
+        self.cells = [None] * len(words)
+        self.dirty = dirty
+
+    def __getitem__(self, addr):
+        addr &= 0xffff
+        self.dirty[addr >> PAGE_SHIFT] = 1
+        cell = self.cells[addr]
+        if cell is None:
+            cell = self.cells[addr] = c_uint16.from_buffer(self.words,
+                                                           addr << 1)
+        return cell
+
+    def __setitem__(self, addr, word):
+        self.words[addr & 0xffff] = word
+
+    def __len__(self):
+        return len(self.cells)
+
+
+class ArrayCPU(CPU):
+    """ CPU backed by two flat ctypes buffers instead of 65536 objects.
+
+    memory holds the 0x10000 words of ram and regfile the registers
+    followed by SP, PC and EX. registers, ram, SP, PC and EX are views
+    into those buffers, so code written against CPU works unchanged
+    while bulk operations can use memory and regfile directly.
+
+    memory and regfile can be given as existing word arrays, e.g. views
+    into shared memory, see create_shared. Their contents are kept, and
+    as others may write to them every page counts as dirty.
+    """
+    def __init__(self, memory=None, regfile=None):
+        fresh = regfile is None
+        self.dirty = bytearray(DIRTY)
+        self.untracked = memory is not None
+        if memory is None:
+            memory = RAM()
+        elif not isinstance(memory, RAM):
+            memory = RAM.from_buffer(memory)
+        if regfile is None:
+            regfile = (c_uint16 * REGFILE_WORDS)()
+        self.memory = memory
+        self.memory.dirty = self.dirty
+        self.regfile = regfile
+        self.registers = dict(
+            (reg, c_uint16.from_buffer(self.regfile, reg << 1))
+            for reg in regidx_to_name)
+        self.ram = RAMCells(self.memory, self.dirty)
+        self.SP = c_uint16.from_buffer(self.regfile, REGFILE_SP << 1)
+        self.PC = c_uint16.from_buffer(self.regfile, REGFILE_PC << 1)
+        self.EX = c_uint16.from_buffer(self.regfile, REGFILE_EX << 1)
+        if fresh:
+            self.SP.value = 0xffff
+        self.IA = c_uint16(0)
+        self.queueing = False
+        self.skip_instruction = False
+        self.cycles = 0
+        self.instructions = 0
+        self.snapshot_pages = None
+        self.bus = Bus(self)
+
+    @classmethod
+    def create_shared(cls, path):
+        """ Returns a fresh machine keeping registers and ram in the file at
+        path, e.g. under /dev/shm, for other processes to attach_shared.
+        """
+        f = open(path, 'w+b')
+        f.truncate(SHARED_BYTES)
+        cpu = cls.attach_shared(path, f)
+        cpu.SP.value = 0xffff
+        return cpu
+
+    @classmethod
+    def attach_shared(cls, path, f=None):
+        """ Returns a machine sharing registers and ram with the one made
+        by create_shared(path), without copying or pausing it.
+
+        Everything else, cycles and instructions included, is this
+        process' own.
+        """
+        if f is None:
+            f = open(path, 'r+b')
+        shared = mmap.mmap(f.fileno(), SHARED_BYTES)
+        f.close()
+        return cls(RAM.from_buffer(shared, SHARED_RAM_OFFSET),
+                   (c_uint16 * REGFILE_WORDS).from_buffer(shared))
+
+    def load(self, words, offset=0):
+        """ Copies a sequence of words into ram starting at offset """
+        words = tuple(words)
+        self.memory[offset:offset + len(words)] = words
+
+    def load_binary(self, data, offset=0):
+        """ Copies a big endian binary or ram image into ram at offset.
+
+        data is a string or anything sliceable into one, like an mmap.
+        Words that don't fit in ram are ignored.
+        """
+        words = big_endian_words(data, RAM_WORDS - offset)
+        address, length = words.buffer_info()
+        memmove(addressof(self.memory) + (offset << 1), address, length << 1)
+        mark_dirty(self.dirty, offset, offset + length)
+
+    def reset(self):
+        """ Clears ram and registers for running another program """
+        memset(self.memory, 0, sizeof(self.memory))
+        memset(self.regfile, 0, sizeof(self.regfile))
+        self.dirty[:] = DIRTY
+        self.reset_state()
+
+    def ram_image(self):
+        """ Returns ram as a native endian string """
+        return string_at(self.memory, sizeof(self.memory))
+
+    def load_ram_image(self, image):
+        memmove(self.memory, image, sizeof(self.memory))
+        self.dirty[:] = DIRTY
+
+    def page_image(self, page):
+        return string_at(addressof(self.memory) + page * PAGE_BYTES,
+                         PAGE_BYTES)
+
+    def load_page(self, page, image):
+        memmove(addressof(self.memory) + page * PAGE_BYTES, image,
+                PAGE_BYTES)
@@ -0,0 +1,186 @@
+import multiprocessing
+import os
+import tempfile
+import unittest
+
+from cpu import CPU, ArrayCPU, PAGE_WORDS, REGFILE_PC, REGFILE_SP
+from constants import REG, OPCODE
+from translator import TranslatingEmulator
+from utils import load_program, save_image, pack_instruction, Value
+
+def read_shared(path, queue):
+    cpu = ArrayCPU.attach_shared(path)
+    queue.put((cpu.registers[REG.A].value, cpu.memory[0x100]))
+
+class TestArrayCPU(unittest.TestCase):
+
+    def setUp(self):
+        self.cpu = ArrayCPU()
+
+    def test_initial_state(self):
+        self.assertEqual(self.cpu.SP.value, 0xffff)
+        self.assertEqual(self.cpu.PC.value, 0)
+        self.assertEqual(self.cpu.regfile[REGFILE_SP], 0xffff)
+
+    def test_cells_share_buffer(self):
+        self.cpu.ram[0x1234].value = 0xbeef
+        self.cpu.registers[REG.J].value = 0x42
+        self.cpu.PC.value = 0x10
+
+        self.assertEqual(self.cpu.memory[0x1234], 0xbeef)
+        self.assertEqual(self.cpu.regfile[REG.J], 0x42)
+        self.assertEqual(self.cpu.regfile[REGFILE_PC], 0x10)
+
+    def test_cells_wrap(self):
+        self.cpu.ram[0x10001].value = 0x1111
+        self.cpu.ram[0].value += 0xffff
+
+        self.assertEqual(self.cpu.memory[1], 0x1111)
+        self.assertEqual(self.cpu.memory[0], 0xffff)
+        self.assertTrue(self.cpu.ram[0x10000] is self.cpu.ram[0])
+        self.assertTrue(self.cpu.ram[0x1ffff] is self.cpu.ram[0xffff])
+        self.assertEqual(len(self.cpu.ram), 0x10000)
+
+    def test_load(self):
+        for cpu in (CPU(), self.cpu):
+            cpu.load([1, 2, 3], offset=0x100)
+            self.assertEqual([cpu.ram[a].value for a in range(0x100, 0x104)],
+                             [1, 2, 3, 0])
+
+    def test_load_binary(self):
+        for cpu in (CPU(), self.cpu):
+            cpu.load_binary('\x12\x34\xab\xcd\xff', offset=0xfffe)
+            self.assertEqual(cpu.memory[0xfffe], 0x1234)
+            self.assertEqual(cpu.memory[0xffff], 0xabcd)
+            self.assertEqual(cpu.memory[0], 0)
+            image = cpu.dump_binary()
+            self.assertEqual(len(image), 0x20000)
+            self.assertEqual(image[-4:], '\x12\x34\xab\xcd')
+
+    def test_load_program(self):
+        self.cpu.load([1, 2, 0xffff])
+        self.cpu.memory[0x8000] = 0x8000
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            save_image(self.cpu, path)
+            cpu = ArrayCPU()
+            load_program(cpu, path)
+            self.assertTrue(list(cpu.memory) == list(self.cpu.memory))
+
+            open(path, 'wb').close()
+            load_program(cpu, path, 0)
+            self.assertEqual(cpu.memory[2], 0xffff)
+        finally:
+            os.remove(path)
+
+    def test_snapshot_restore(self):
+        for cpu in (CPU(), self.cpu):
+            cpu.load([1, 2, 3])
+            cpu.registers[REG.A].value = 0x42
+            cpu.cycles = 10
+            snapshot = cpu.snapshot()
+
+            cpu.memory[1] = 0xbeef
+            cpu.memory[0xffff] = 0x1234
+            cpu.registers[REG.A].value = 0
+            cpu.PC.value = 0x10
+            cpu.skip_instruction = True
+            cpu.cycles = 20
+            cpu.restore(snapshot)
+
+            self.assertEqual([cpu.memory[a] for a in range(4)], [1, 2, 3, 0])
+            self.assertEqual(cpu.memory[0xffff], 0)
+            self.assertEqual(cpu.registers[REG.A].value, 0x42)
+            self.assertEqual(cpu.PC.value, 0)
+            self.assertEqual(cpu.SP.value, 0xffff)
+            self.assertEqual(cpu.skip_instruction, False)
+            self.assertEqual(cpu.cycles, 10)
+
+    def test_snapshot_shares_pages(self):
+        first = self.cpu.snapshot()
+        self.cpu.memory[PAGE_WORDS * 3 + 5] = 7
+        second = self.cpu.snapshot()
+        self.assertTrue(second.pages[2] is first.pages[2])
+        self.assertFalse(second.pages[3] is first.pages[3])
+        self.assertTrue(self.cpu.snapshot().pages is second.pages)
+
+        # Forking from an older snapshot shares with it
+        self.cpu.restore(first)
+        self.assertEqual(self.cpu.memory[PAGE_WORDS * 3 + 5], 0)
+        self.cpu.memory[0] = 1
+        third = self.cpu.snapshot()
+        self.assertTrue(third.pages[3] is first.pages[3])
+        self.assertFalse(third.pages[0] is first.pages[0])
+
+    def test_snapshot_reads_dirty_pages(self):
+        for cpu in (CPU(), self.cpu):
+            first = cpu.snapshot()
+            read = []
+            page_image = cpu.page_image
+            cpu.page_image = lambda page: read.append(page) or page_image(page)
+            cpu.ram[PAGE_WORDS * 5].value = 1
+            cpu.memory[PAGE_WORDS * 7 + 1] = 2
+            cpu.load([3], PAGE_WORDS * 9)
+            second = cpu.snapshot()
+            self.assertEqual(read, [5, 7, 9])
+            self.assertTrue(second.pages[6] is first.pages[6])
+            self.assertEqual(cpu.memory[PAGE_WORDS * 7 + 1], 2)
+
+            del read[:]
+            self.assertTrue(cpu.snapshot().pages is second.pages)
+            self.assertEqual(read, [])
+            cpu.restore(first)
+            self.assertEqual(cpu.memory[PAGE_WORDS * 9], 0)
+            self.assertTrue(cpu.snapshot().pages is first.pages)
+            self.assertEqual(read, [])
+
+    def test_snapshot_translated_writes(self):
+        self.cpu.load([
+            # SET [0x4321], 5
+            pack_instruction(OPCODE.SET, Value.next_word_addr(),
+                             Value.literal(5)), 0x4321,
+            # SET PC, 0
+            pack_instruction(OPCODE.SET, Value.pc(), Value.literal(0)),
+        ])
+        first = self.cpu.snapshot()
+        TranslatingEmulator(self.cpu).run(64)
+        second = self.cpu.snapshot()
+        self.assertFalse(second.pages[0x43] is first.pages[0x43])
+        self.cpu.restore(first)
+        self.assertEqual(self.cpu.memory[0x4321], 0)
+        self.cpu.restore(second)
+        self.assertEqual(self.cpu.memory[0x4321], 5)
+
+    def test_shared(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            cpu = ArrayCPU.create_shared(path)
+            self.assertEqual(cpu.SP.value, 0xffff)
+            cpu.load([
+                # ADD A, 1
+                pack_instruction(OPCODE.ADD, Value.reg(REG.A),
+                                 Value.literal(1)),
+                # SET [0x100], A
+                pack_instruction(OPCODE.SET, Value.next_word_addr(),
+                                 Value.reg(REG.A)),
+                0x100,
+            ])
+            observer = ArrayCPU.attach_shared(path)
+            self.assertEqual(observer.SP.value, 0xffff)
+            TranslatingEmulator(cpu).run(2)
+            self.assertEqual(observer.registers[REG.A].value, 1)
+            self.assertEqual(observer.memory[0x100], 1)
+
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=read_shared,
+                                              args=(path, queue))
+            process.start()
+            self.assertEqual(queue.get(), (1, 1))
+            process.join()
+        finally:
+            os.remove(path)
+
+if __name__ == '__main__':
+    unittest.main()
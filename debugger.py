@@ -0,0 +1,319 @@
+""" Breakpoints and watchpoints for an Emulator.
+
+Nothing is hooked into the emulator while no breakpoint or watchpoint
+is set, so it runs exactly the code it always did.
+
+A breakpoint address is kept out of the decode cache, so only reaching
+it misses the cache and goes through Debugger.decode, which raises a
+Breakpoint before the instruction runs. Everywhere else the cache hits
+as before.
+
+Watchpoints rebuild the operand accessors over a view of ram that only
+looks up the page of the memory operands in a bitmap of the watched
+ones, and wraps the cells of watched pages to see their reads and
+writes, as do the stack pushes and pops of JSR, RFI and interrupts. A
+Watchpoint is raised once the instruction that hit it has finished.
+Devices writing to ram aren't seen.
+
+A TranslatingEmulator is interpreted while a breakpoint is set. With
+only watchpoints it keeps running the blocks that can't reach a watched
+page, the ones whose memory operands are all at constant addresses
+elsewhere, and interprets the rest.
+"""
+from cpu import PAGES, PAGE_SHIFT
+from emulator import Emulator, EmulatorError
+from translator import Block, TranslatingEmulator, operand_words
+from utils import unpack_instruction
+from values import operand_table
+
+READ = 'read'
+WRITE = 'write'
+
+
+class Breakpoint(EmulatorError):
+    def __init__(self, pc=None):
+        EmulatorError.__init__(self, 'Breakpoint', pc)
+
+
+class Watchpoint(EmulatorError):
+    """ hits are the (access, address, old, new) seen, new is old for
+    reads.
+    """
+    def __init__(self, hits, pc=None):
+        access, address, old, new = hits[0]
+        EmulatorError.__init__(self, 'Watchpoint %s of [0x%04x] 0x%04x -> '
+                               '0x%04x' % (access, address, old, new), pc)
+        self.hits = hits
+
+
+class TrapCache(dict):
+    """ A decode cache that never holds the breakpoints' addresses """
+    def __init__(self, entries, breakpoints):
+        dict.__init__(self, entries)
+        self.breakpoints = breakpoints
+
+    def __setitem__(self, pc, decoded):
+        if pc not in self.breakpoints:
+            dict.__setitem__(self, pc, decoded)
+
+
+class WatchedCPU(object):
+    """ cpu as operand accessors see it, with watched ram """
+    def __init__(self, cpu, ram):
+        self.cpu = cpu
+        self.ram = ram
+
+    def __getattr__(self, name):
+        return getattr(self.cpu, name)
+
+
+class WatchedRAM(object):
+    def __init__(self, ram, debugger):
+        self.ram = ram
+        self.debugger = debugger
+        self.pages = debugger.pages
+
+    def __getitem__(self, address):
+        cell = self.ram[address]
+        address &= 0xffff
+        if self.pages[address >> PAGE_SHIFT]:
+            return WatchedCell(cell, address, self.debugger)
+        return cell
+
+
+class WatchedCell(object):
+    __slots__ = ('cell', 'address', 'debugger')
+
+    def __init__(self, cell, address, debugger):
+        self.cell = cell
+        self.address = address
+        self.debugger = debugger
+
+    def get(self):
+        value = self.cell.value
+        self.debugger.accessed(READ, self.address, value, value)
+        return value
+
+    def set(self, value):
+        old = self.cell.value
+        self.cell.value = value
+        self.debugger.accessed(WRITE, self.address, old, self.cell.value)
+
+    value = property(get, set)
+
+
+def operand_pages(memory, val, pc):
+    """ Returns the pages of ram value val, with its next word at pc,
+    uses, or None if they depend on the registers.
+    """
+    if val == 0x1e:
+        return [memory[pc] >> PAGE_SHIFT]
+    if val == 0x1f:
+        # The interpreter reads the literal from its cell
+        return [pc >> PAGE_SHIFT]
+    if 0x08 <= val <= 0x1a:
+        return None
+    return []
+
+
+def block_pages(memory, block):
+    """ Returns the pages of ram the instructions of block use, or None
+    if they depend on the registers.
+    """
+    pages = []
+    pc = block.start
+    while pc < block.end:
+        op_code, b_val, a_val = unpack_instruction(memory[pc])
+        # b, resolved first, uses the first next word
+        b_pages = operand_pages(memory, b_val, pc + 1)
+        a_pages = operand_pages(memory, a_val,
+                                pc + 1 + operand_words(b_val))
+        if b_pages is None or a_pages is None:
+            return None
+        pages += b_pages + a_pages
+        pc += 1 + operand_words(b_val) + operand_words(a_val)
+    return pages
+
+
+class Debugger(object):
+    """ PC breakpoints, optionally conditional, and read and write
+    watchpoints on ranges of ram.
+    """
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.cpu = emulator.cpu
+        # pc -> condition(cpu), or None to always break
+        self.breakpoints = {}
+        # (start, end, read, write), end excluded
+        self.watches = []
+        # 1 for the pages holding a watched word
+        self.pages = bytearray(PAGES)
+        self.hits = []
+        # (pc, instructions) of the breakpoint last raised, run when
+        # resuming rather than raised again
+        self.resumed = None
+        self.operands = None
+        self.interpreting = False
+
+    def add_breakpoint(self, pc, condition=None):
+        """ Breaks before the instruction at pc, if condition(cpu) is true
+        when given.
+        """
+        emulator = self.emulator
+        if not self.breakpoints:
+            emulator.decode_cache = TrapCache(emulator.decode_cache,
+                                              self.breakpoints)
+            emulator.decode = self.decode
+            self.interpret()
+        self.breakpoints[pc] = condition
+        dict.pop(emulator.decode_cache, pc, None)
+
+    def remove_breakpoint(self, pc):
+        del self.breakpoints[pc]
+        if not self.breakpoints:
+            emulator = self.emulator
+            emulator.decode_cache = dict(emulator.decode_cache)
+            del emulator.decode
+            self.uninterpret()
+
+    def watch(self, start, end=None, read=False, write=True):
+        """ Watches the words from start up to, but not including, end """
+        if end is None:
+            end = start + 1
+        if not self.watches:
+            self.hook_memory()
+        self.watches.append((start, end, read, write))
+        self.update_pages()
+
+    def unwatch(self, start, end=None):
+        """ Removes the watchpoints on exactly start to end """
+        if end is None:
+            end = start + 1
+        self.watches = [watch for watch in self.watches
+                        if watch[:2] != (start, end)]
+        self.update_pages()
+        if not self.watches and self.operands is not None:
+            self.unhook_memory()
+
+    def update_pages(self):
+        pages = self.pages
+        pages[:] = bytearray(PAGES)
+        for start, end, read, write in self.watches:
+            for page in range(start >> PAGE_SHIFT,
+                              ((end - 1) >> PAGE_SHIFT) + 1):
+                pages[page] = 1
+        self.clear_blocks()
+
+    def hook_memory(self):
+        emulator, cpu = self.emulator, self.cpu
+        self.operands = emulator.b_operands, emulator.a_operands
+        watched = WatchedCPU(cpu, WatchedRAM(cpu.ram, self))
+        emulator.b_operands = operand_table(watched, as_a=False)
+        emulator.a_operands = operand_table(watched, as_a=True)
+        # Decoded instructions hold on to the accessors
+        emulator.decode_cache.clear()
+        emulator.decoded.clear()
+        emulator.push = self.push
+        emulator.pop = self.pop
+        emulator.service = self.service
+        if isinstance(emulator, TranslatingEmulator):
+            emulator.translate = self.translate
+
+    def unhook_memory(self):
+        emulator = self.emulator
+        emulator.b_operands, emulator.a_operands = self.operands
+        self.operands = None
+        emulator.decode_cache.clear()
+        emulator.decoded.clear()
+        for name in ('push', 'pop', 'service'):
+            del emulator.__dict__[name]
+        if isinstance(emulator, TranslatingEmulator):
+            del emulator.translate
+            self.clear_blocks()
+        self.hits = []
+
+    def interpret(self):
+        """ Has a TranslatingEmulator run instruction by instruction """
+        emulator = self.emulator
+        if isinstance(emulator, TranslatingEmulator) and \
+                not self.interpreting:
+            emulator.hook(self.dispatch)
+            self.interpreting = True
+
+    def uninterpret(self):
+        if self.breakpoints or not self.interpreting:
+            return
+        self.emulator.unhook(self.dispatch)
+        self.interpreting = False
+
+    def dispatch(self, inner):
+        inner()
+
+    def translate(self, start, max_instructions):
+        """ Translates the block at start, or leaves it to the interpreter
+        when it can reach a watched page.
+        """
+        emulator = self.emulator
+        block = TranslatingEmulator.translate(emulator, start,
+                                              max_instructions)
+        if block.run is None:
+            return block
+        pages = block_pages(self.cpu.memory, block)
+        if pages is not None and not any(self.pages[page]
+                                         for page in pages):
+            return block
+        end = start + 1
+        return Block(start, end, emulator.code[start << 1:end << 1], 0, 0,
+                     None, None)
+
+    def clear_blocks(self):
+        """ Has a TranslatingEmulator translate its blocks again """
+        emulator = self.emulator
+        if isinstance(emulator, TranslatingEmulator):
+            emulator.blocks.clear()
+            emulator.single_blocks.clear()
+
+    def decode(self, instruction, pc=None):
+        cpu = self.cpu
+        if pc in self.breakpoints and self.resumed != (pc, cpu.instructions):
+            # As before dispatch started on the instruction
+            cpu.PC.value = pc
+            cpu.instructions -= 1
+            condition = self.breakpoints[pc]
+            if condition is None or condition(cpu):
+                self.resumed = (pc, cpu.instructions + 1)
+                raise Breakpoint(pc)
+            cpu.PC.value = pc + 1
+            cpu.instructions += 1
+        return Emulator.decode(self.emulator, instruction, pc)
+
+    def accessed(self, access, address, old, new):
+        for start, end, read, write in self.watches:
+            if start <= address < end and (read if access == READ
+                                           else write):
+                if not self.hits:
+                    # Raised by service before the next instruction
+                    self.emulator.bus.wake()
+                self.hits.append((access, address, old, new))
+                return
+
+    def service(self):
+        if self.hits:
+            hits, self.hits = self.hits, []
+            raise Watchpoint(hits, self.cpu.PC.value)
+        Emulator.service(self.emulator)
+
+    def push(self, word, pc=None):
+        cpu = self.cpu
+        address = (cpu.SP.value - 1) & 0xffff
+        old = cpu.memory[address]
+        Emulator.push(self.emulator, word, pc)
+        if self.pages[address >> PAGE_SHIFT]:
+            self.accessed(WRITE, address, old, word)
+
+    def pop(self):
+        address = self.cpu.SP.value
+        word = Emulator.pop(self.emulator)
+        if self.pages[address >> PAGE_SHIFT]:
+            self.accessed(READ, address, word, word)
+        return word
@@ -0,0 +1,141 @@
+import unittest
+
+from cpu import ArrayCPU, CPU
+from constants import REG, OPCODE
+from debugger import Debugger, Breakpoint, Watchpoint, READ, WRITE
+from emulator import Emulator
+from translator import TranslatingEmulator
+from utils import pack_instruction, pack_special_instruction, Value
+
+# :loop ADD A, 1 ; SET [0x9000], A ; JSR sub ; SET PC, loop ; 0
+# :sub SET B, [0x9000] ; SET PC, POP
+PROGRAM = [
+    pack_instruction(OPCODE.ADD, Value.reg(REG.A), Value.literal(1)),
+    pack_instruction(OPCODE.SET, Value.next_word_addr(), Value.reg(REG.A)),
+    0x9000,
+    pack_special_instruction(OPCODE.JSR, Value.literal(6)),
+    pack_instruction(OPCODE.SET, Value.pc(), Value.literal(0)),
+    0,
+    pack_instruction(OPCODE.SET, Value.reg(REG.B), Value.next_word_addr()),
+    0x9000,
+    pack_instruction(OPCODE.SET, Value.pc(), Value.push_pop()),
+]
+SUB = 6
+
+class TestDebugger(unittest.TestCase):
+
+    def machine(self, emulator_class=Emulator, cpu_class=ArrayCPU):
+        cpu = cpu_class()
+        cpu.load(PROGRAM)
+        emulator = emulator_class(cpu)
+        return cpu, emulator, Debugger(emulator)
+
+    def assertUnhooked(self, emulator, operands):
+        self.assertEqual(emulator.__dict__.keys(),
+                         type(emulator)(emulator.cpu).__dict__.keys())
+        self.assertEqual(type(emulator.decode_cache), dict)
+        self.assertTrue(emulator.b_operands is operands[0])
+        self.assertTrue(emulator.a_operands is operands[1])
+
+    def test_breakpoint(self):
+        cpu, emulator, debugger = self.machine()
+        operands = emulator.b_operands, emulator.a_operands
+        emulator.run(10)
+        debugger.add_breakpoint(SUB)
+        self.assertFalse(SUB in emulator.decode_cache)
+        for a in (3, 4):
+            try:
+                emulator.run(100)
+                self.fail('No breakpoint')
+            except Breakpoint, e:
+                self.assertEqual(e.pc, SUB)
+            self.assertEqual(cpu.PC.value, SUB)
+            self.assertEqual(cpu.registers[REG.A].value, a)
+            self.assertEqual(cpu.instructions, (a - 1) * 6 + 3)
+            self.assertFalse(SUB in emulator.decode_cache)
+            self.assertTrue(0 in emulator.decode_cache)
+        debugger.remove_breakpoint(SUB)
+        emulator.run(100)
+        self.assertTrue(SUB in emulator.decode_cache)
+        self.assertUnhooked(emulator, operands)
+
+    def test_condition(self):
+        cpu, emulator, debugger = self.machine(TranslatingEmulator)
+        debugger.add_breakpoint(
+            0, lambda cpu: cpu.registers[REG.A].value == 30)
+        self.assertRaises(Breakpoint, emulator.run_cycles, 10000)
+        self.assertEqual(cpu.PC.value, 0)
+        self.assertEqual(cpu.registers[REG.A].value, 30)
+        self.assertEqual(cpu.instructions, 30 * 6)
+        debugger.remove_breakpoint(0)
+        self.assertFalse('run' in emulator.__dict__)
+
+    def test_watch(self):
+        for cpu_class in (ArrayCPU, CPU):
+            cpu, emulator, debugger = self.machine(cpu_class=cpu_class)
+            operands = emulator.b_operands, emulator.a_operands
+            emulator.run(7)
+            debugger.watch(0x9000)
+            try:
+                emulator.run(100)
+                self.fail('No watchpoint')
+            except Watchpoint, e:
+                self.assertEqual(e.hits, [(WRITE, 0x9000, 1, 2)])
+            # Stopped after the instruction
+            self.assertEqual(cpu.PC.value, 3)
+            self.assertEqual(cpu.memory[0x9000], 2)
+
+            debugger.unwatch(0x9000)
+            debugger.watch(0x8ff0, 0x9010, read=True, write=False)
+            try:
+                emulator.run(100)
+                self.fail('No watchpoint')
+            except Watchpoint, e:
+                self.assertEqual(e.hits, [(READ, 0x9000, 2, 2)])
+            self.assertEqual(cpu.PC.value, 8)
+            debugger.unwatch(0x8ff0, 0x9010)
+            self.assertUnhooked(emulator, operands)
+
+    def test_watch_translated(self):
+        cpu, emulator, debugger = self.machine(TranslatingEmulator)
+        operands = emulator.b_operands, emulator.a_operands
+        debugger.watch(0x5000, read=True)
+        emulator.run(100)
+        # The loop never reaches the watched page
+        self.assertTrue(emulator.blocks[0].run is not None)
+        self.assertEqual(emulator.hooks, [])
+
+        debugger.watch(0x9000)
+        try:
+            emulator.run(100)
+            self.fail('No watchpoint')
+        except Watchpoint, e:
+            self.assertEqual(e.hits[0][:2], (WRITE, 0x9000))
+        self.assertEqual(cpu.PC.value, 3)
+        self.assertTrue(emulator.blocks[0].run is None)
+        debugger.unwatch(0x9000)
+        debugger.unwatch(0x5000)
+        self.assertUnhooked(emulator, operands)
+        emulator.run(100)
+        self.assertTrue(emulator.blocks[0].run is not None)
+
+    def test_watch_stack(self):
+        cpu, emulator, debugger = self.machine()
+        debugger.watch(0xfff0, 0x10000, read=True)
+        emulator.run(2)
+        try:
+            emulator.run(1)
+            emulator.run(1)
+            self.fail('No watchpoint')
+        except Watchpoint, e:
+            self.assertEqual(e.hits, [(WRITE, 0xfffe, 0, 4)])
+        self.assertEqual(cpu.PC.value, SUB)
+        emulator.run(1)
+        try:
+            emulator.run(2)
+            self.fail('No watchpoint')
+        except Watchpoint, e:
+            self.assertEqual(e.hits, [(READ, 0xfffe, 4, 4)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,239 @@
+""" LEM1802 style display, rendered off the emulation thread.
+
+The display reads the 32x12 cells mapped with HWI straight from ram and a
+thread started with start() renders them at a fixed frame rate. Only the
+cells whose word changed since the last frame, or blinking ones when the
+blink phase flips, are passed to the renderer, so a mostly still screen
+costs a comparison of 384 words per frame and the emulator nothing.
+"""
+import sys
+import threading
+import time
+
+from constants import REG
+from hardware import Device
+
+COLUMNS = 32
+ROWS = 12
+CELLS = COLUMNS * ROWS
+# Pixels of a cell
+CELL_WIDTH = 4
+CELL_HEIGHT = 8
+WIDTH = COLUMNS * CELL_WIDTH
+HEIGHT = ROWS * CELL_HEIGHT
+FONT_WORDS = 256
+PALETTE_WORDS = 16
+# Blink phases per second
+BLINK_RATE = 2
+
+DEFAULT_PALETTE = (
+    0x000, 0x00a, 0x0a0, 0x0aa, 0xa00, 0xa0a, 0xa50, 0xaaa,
+    0x555, 0x55f, 0x5f5, 0x5ff, 0xf55, 0xf5f, 0xff5, 0xfff,
+)
+# The built in font, two words of four 8 pixel columns per character
+DEFAULT_FONT = (
+    0xb79e, 0x388e, 0x722c, 0x75f4, 0x19bb, 0x7f8f, 0x85f9, 0xb158,
+    0x242e, 0x2400, 0x082a, 0x0800, 0x0008, 0x0000, 0x0808, 0x0808,
+    0x00ff, 0x0000, 0x00f8, 0x0808, 0xf808, 0x0000, 0x080f, 0x0000,
+    0x0f08, 0x0000, 0x00ff, 0x0808, 0xf808, 0x0808, 0xff08, 0x0000,
+    0x0f08, 0x0808, 0xff08, 0x0808, 0x6633, 0x99cc, 0x9933, 0x66cc,
+    0xfef8, 0xe080, 0x7f1f, 0x0701, 0x0107, 0x1f7f, 0x80e0, 0xf8fe,
+    0x5500, 0xaa00, 0x55aa, 0x55aa, 0xffaa, 0xff55, 0x0f0f, 0x0f0f,
+    0xf0f0, 0xf0f0, 0x0000, 0xffff, 0xffff, 0x0000, 0xffff, 0xffff,
+    0x0000, 0x0000, 0x005f, 0x0000, 0x0300, 0x0300, 0x3e14, 0x3e00,
+    0x266b, 0x3200, 0x611c, 0x4300, 0x3629, 0x7650, 0x0002, 0x0100,
+    0x1c22, 0x4100, 0x4122, 0x1c00, 0x1408, 0x1400, 0x081c, 0x0800,
+    0x4020, 0x0000, 0x0808, 0x0800, 0x0040, 0x0000, 0x601c, 0x0300,
+    0x3e49, 0x3e00, 0x427f, 0x4000, 0x6259, 0x4600, 0x2249, 0x3600,
+    0x0f08, 0x7f00, 0x2745, 0x3900, 0x3e49, 0x3200, 0x6119, 0x0700,
+    0x3649, 0x3600, 0x2649, 0x3e00, 0x0024, 0x0000, 0x4024, 0x0000,
+    0x0814, 0x2200, 0x1414, 0x1400, 0x2214, 0x0800, 0x0259, 0x0600,
+    0x3e59, 0x5e00, 0x7e09, 0x7e00, 0x7f49, 0x3600, 0x3e41, 0x2200,
+    0x7f41, 0x3e00, 0x7f49, 0x4100, 0x7f09, 0x0100, 0x3e41, 0x7a00,
+    0x7f08, 0x7f00, 0x417f, 0x4100, 0x2040, 0x3f00, 0x7f08, 0x7700,
+    0x7f40, 0x4000, 0x7f06, 0x7f00, 0x7f01, 0x7e00, 0x3e41, 0x3e00,
+    0x7f09, 0x0600, 0x3e61, 0x7e00, 0x7f09, 0x7600, 0x2649, 0x3200,
+    0x017f, 0x0100, 0x3f40, 0x7f00, 0x1f60, 0x1f00, 0x7f30, 0x7f00,
+    0x7708, 0x7700, 0x0778, 0x0700, 0x7149, 0x4700, 0x007f, 0x4100,
+    0x031c, 0x6000, 0x417f, 0x0000, 0x0201, 0x0200, 0x8080, 0x8000,
+    0x0001, 0x0200, 0x2454, 0x7800, 0x7f44, 0x3800, 0x3844, 0x2800,
+    0x3844, 0x7f00, 0x3854, 0x5800, 0x087e, 0x0900, 0x4854, 0x3c00,
+    0x7f04, 0x7800, 0x047d, 0x0000, 0x2040, 0x3d00, 0x7f10, 0x6c00,
+    0x017f, 0x0000, 0x7c18, 0x7c00, 0x7c04, 0x7800, 0x3844, 0x3800,
+    0x7c14, 0x0800, 0x0814, 0x7c00, 0x7c04, 0x0800, 0x4854, 0x2400,
+    0x043e, 0x4400, 0x3c40, 0x7c00, 0x1c60, 0x1c00, 0x7c30, 0x7c00,
+    0x6c10, 0x6c00, 0x4c50, 0x3c00, 0x6454, 0x4c00, 0x0836, 0x4100,
+    0x0077, 0x0000, 0x4136, 0x0800, 0x0201, 0x0201, 0x0205, 0x0200,
+)
+
+
+def rgb(color):
+    """ Returns the (r, g, b) bytes of a 0x0RGB palette word """
+    return (((color >> 8) & 0xf) * 0x11, ((color >> 4) & 0xf) * 0x11,
+            (color & 0xf) * 0x11)
+
+
+class LEM1802(Device):
+    """ The display device, drawing through renderer.
+
+    renderer.draw(cells, font, palette, border, blink) gets the changed
+    (index, word) cells, font and palette as word tuples, the border
+    palette index and whether blinking cells show their foreground.
+    """
+    id = 0x7349f615
+    version = 0x1802
+    manufacturer = 0x1c6c8b36
+
+    def __init__(self, renderer):
+        Device.__init__(self)
+        self.renderer = renderer
+        self.thread = None
+        self.stopped = threading.Event()
+        self.reset()
+
+    def reset(self):
+        # ram addresses mapped with HWI, 0 when not
+        self.screen = 0
+        self.font = 0
+        self.palette = 0
+        self.border = 0
+        # What the renderer was last given
+        self.shown = None
+        self.style = None
+        self.blink = None
+
+    def interrupt(self):
+        registers = self.cpu.registers
+        command = registers[REG.A].value
+        b = registers[REG.B].value
+        if command == 0:
+            self.screen = b
+        elif command == 1:
+            self.font = b
+        elif command == 2:
+            self.palette = b
+        elif command == 3:
+            self.border = b & 0xf
+        elif command == 4:
+            self.write(b, DEFAULT_FONT)
+            return 256
+        elif command == 5:
+            self.write(b, DEFAULT_PALETTE)
+            return 16
+        return 0
+
+    def write(self, address, words):
+        """ Copies words to ram at address, wrapping around at its end """
+        memory = self.cpu.memory
+        for i, word in enumerate(words):
+            memory[(address + i) & 0xffff] = word
+
+    def read(self, address, count):
+        memory = self.cpu.memory
+        return tuple(memory[(address + i) & 0xffff] for i in range(count))
+
+    def frame(self, now=None):
+        """ Renders the cells changed since the last frame.
+
+        Returns the number of cells drawn.
+        """
+        screen = self.screen
+        if not screen:
+            self.shown = None
+            return 0
+        words = self.read(screen, CELLS)
+        font = self.read(self.font, FONT_WORDS) if self.font else DEFAULT_FONT
+        palette = (self.read(self.palette, PALETTE_WORDS) if self.palette
+                   else DEFAULT_PALETTE)
+        style = (font, palette, self.border)
+        if now is None:
+            now = time.time()
+        blink = not int(now * BLINK_RATE) & 1
+
+        shown = self.shown
+        if shown is None or style != self.style:
+            cells = list(enumerate(words))
+        else:
+            blinked = blink != self.blink
+            cells = [(index, word) for index, word in enumerate(words)
+                     if word != shown[index] or (blinked and word & 0x80)]
+        self.shown, self.style, self.blink = words, style, blink
+        if cells:
+            self.renderer.draw(cells, font, palette, self.border, blink)
+        return len(cells)
+
+    def start(self, fps=30):
+        """ Renders fps frames a second on a thread until stop() """
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.render_loop, args=(fps,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+    def render_loop(self, fps):
+        interval = 1.0 / fps
+        deadline = time.time()
+        while not self.stopped.is_set():
+            self.frame()
+            deadline += interval
+            self.stopped.wait(max(0, deadline - time.time()))
+
+
+class ImageRenderer(object):
+    """ Draws into pixels, WIDTH x HEIGHT rows of RGB bytes """
+    def __init__(self):
+        self.pixels = bytearray(WIDTH * HEIGHT * 3)
+        self.border = (0, 0, 0)
+
+    def draw(self, cells, font, palette, border, blink):
+        pixels = self.pixels
+        colors = [str(bytearray(rgb(color))) for color in palette]
+        self.border = rgb(palette[border])
+        for index, word in cells:
+            fg = colors[word >> 12]
+            bg = colors[(word >> 8) & 0xf]
+            if word & 0x80 and not blink:
+                fg = bg
+            char = word & 0x7f
+            # Column x is byte x of the two words, bit y is row y
+            glyph = (font[char * 2] << 16) | font[char * 2 + 1]
+            left = (index % COLUMNS) * CELL_WIDTH
+            top = (index // COLUMNS) * CELL_HEIGHT
+            for y in range(CELL_HEIGHT):
+                row = ''.join(
+                    fg if glyph >> (24 - 8 * x + y) & 1 else bg
+                    for x in range(CELL_WIDTH))
+                start = ((top + y) * WIDTH + left) * 3
+                pixels[start:start + CELL_WIDTH * 3] = row
+
+    def ppm(self):
+        """ Returns the image as a binary PPM """
+        return 'P6 %d %d 255\n' % (WIDTH, HEIGHT) + str(self.pixels)
+
+
+class TerminalRenderer(object):
+    """ Draws cells as characters with ANSI escapes, ignoring the font """
+    def __init__(self, out=sys.stdout):
+        self.out = out
+
+    def draw(self, cells, font, palette, border, blink):
+        colors = [rgb(color) for color in palette]
+        output = []
+        for index, word in cells:
+            fg = colors[word >> 12]
+            bg = colors[(word >> 8) & 0xf]
+            if word & 0x80 and not blink:
+                fg = bg
+            char = word & 0x7f
+            output.append('\x1b[%d;%dH\x1b[38;2;%d;%d;%dm\x1b[48;2;%d;%d;%dm%s'
+                          % ((index // COLUMNS + 1, index % COLUMNS + 1) +
+                             fg + bg +
+                             (chr(char) if 0x20 <= char < 0x7f else ' ',)))
+        output.append('\x1b[0m')
+        self.out.write(''.join(output))
+        self.out.flush()
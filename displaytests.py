@@ -0,0 +1,117 @@
+import time
+import unittest
+from StringIO import StringIO
+
+from cpu import ArrayCPU
+from constants import REG, OPCODE
+from display import (LEM1802, ImageRenderer, TerminalRenderer, CELLS,
+                     COLUMNS, WIDTH, DEFAULT_FONT, DEFAULT_PALETTE)
+from emulator import Emulator
+from utils import pack_special_instruction, Value
+
+class Recorder(object):
+    def __init__(self):
+        self.frames = []
+
+    def draw(self, cells, font, palette, border, blink):
+        self.frames.append(dict(cells))
+
+class TestDisplay(unittest.TestCase):
+
+    def setUp(self):
+        self.cpu = ArrayCPU()
+        self.renderer = Recorder()
+        self.display = LEM1802(self.renderer)
+        self.cpu.bus.attach(self.display)
+
+    def hwi(self, a, b):
+        self.cpu.registers[REG.A].value = a
+        self.cpu.registers[REG.B].value = b
+        self.cpu.PC.value = 0
+        self.cpu.load([pack_special_instruction(OPCODE.HWI, Value.literal(0))])
+        Emulator(self.cpu).dispatch()
+
+    def test_dirty_cells(self):
+        self.assertEqual(self.display.frame(), 0)
+        self.hwi(0, 0x8000)
+        self.assertEqual(self.display.frame(), CELLS)
+        self.assertEqual(self.display.frame(), 0)
+        self.cpu.memory[0x8000 + 33] = 0xf041
+        self.assertEqual(self.display.frame(), 1)
+        self.assertEqual(self.renderer.frames[-1], {33: 0xf041})
+
+        # A changed palette redraws everything
+        self.hwi(2, 0x1000)
+        self.assertEqual(self.display.frame(), CELLS)
+        self.cpu.memory[0x1000] = 0x123
+        self.assertEqual(self.display.frame(), CELLS)
+
+    def test_blink(self):
+        self.hwi(0, 0x8000)
+        self.cpu.memory[0x8005] = 0xf0c1
+        self.display.frame(now=0)
+        self.assertEqual(self.display.frame(now=0.1), 0)
+        self.assertEqual(self.display.frame(now=0.6), 1)
+        self.assertEqual(self.renderer.frames[-1], {5: 0xf0c1})
+
+    def test_dump_palette(self):
+        self.hwi(5, 0x100)
+        self.assertEqual(tuple(self.cpu.memory[0x100:0x110]),
+                         DEFAULT_PALETTE)
+        self.assertEqual(self.cpu.cycles, 4 + 16)
+
+    def test_dump_wraps(self):
+        self.hwi(4, 0xff80)
+        memory = self.cpu.memory
+        self.assertEqual(tuple(memory[0xff80:0x10000]) + tuple(memory[0:0x80]),
+                         DEFAULT_FONT)
+        self.hwi(5, 0xfff8)
+        self.assertEqual(tuple(memory[0xfff8:0x10000]) + tuple(memory[0:8]),
+                         DEFAULT_PALETTE)
+
+    def test_thread(self):
+        self.hwi(0, 0x8000)
+        self.display.start(fps=200)
+        try:
+            self.cpu.memory[0x8001] = 0x1234
+            for i in range(100):
+                if any(frame.get(1) == 0x1234
+                       for frame in self.renderer.frames):
+                    break
+                time.sleep(0.01)
+            else:
+                self.fail('Cell never drawn')
+        finally:
+            self.display.stop()
+        self.assertTrue(self.display.thread is None)
+
+    def test_image(self):
+        renderer = ImageRenderer()
+        font = [0] * 256
+        # Char 1 is a dot at the top left and the bottom right
+        font[2:4] = [0x0100, 0x0080]
+        renderer.draw([(COLUMNS + 1, 0xf101)], font, DEFAULT_PALETTE, 0,
+                      True)
+        def pixel(x, y):
+            start = (y * WIDTH + x) * 3
+            return tuple(renderer.pixels[start:start + 3])
+        self.assertEqual(pixel(4, 8), (0xff, 0xff, 0xff))
+        self.assertEqual(pixel(5, 8), (0, 0, 0xaa))
+        self.assertEqual(pixel(7, 15), (0xff, 0xff, 0xff))
+        self.assertEqual(pixel(7, 14), (0, 0, 0xaa))
+        self.assertEqual(pixel(0, 0), (0, 0, 0))
+        self.assertTrue(renderer.ppm().startswith('P6 128 96 255\n'))
+        # The built in A's left stroke
+        renderer.draw([(0, 0xf041)], DEFAULT_FONT, DEFAULT_PALETTE, 0, True)
+        self.assertEqual([pixel(0, y)[0] for y in range(8)],
+                         [0] + [0xff] * 6 + [0])
+
+    def test_terminal(self):
+        out = StringIO()
+        TerminalRenderer(out).draw([(COLUMNS * 2, 0xf041)], (),
+                                   DEFAULT_PALETTE, 0, True)
+        self.assertTrue('\x1b[3;1H' in out.getvalue())
+        self.assertTrue('A' in out.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,73 @@
+import time
 from ctypes import c_int16, c_uint16
-from values import value_lookup
-from constants import OPCODE, REG
+from functools import partial
+from values import Literal, operand_table
+from constants import (OPCODE, REG, BASIC_CYCLES, SPECIAL_CYCLES,
+                       VALUE_CYCLES, regidx_to_name)
 from utils import unpack_instruction, unpack_special_instruction
 
 
+# Seconds of emulated time run between checks against the wall clock
+TIME_SLICE = 0.01
+
+
+class EmulatorError(Exception):
+    """ The program can't continue """
+    def __init__(self, msg, pc=None):
+        if pc is not None:
+            msg = '%s at 0x%04x' % (msg, pc)
+        Exception.__init__(self, msg)
+        self.pc = pc
+
+
+class StackOverflow(EmulatorError):
+    def __init__(self, pc=None):
+        EmulatorError.__init__(self, 'Stack overflow', pc)
+
+
+class InvalidOpcode(EmulatorError):
+    def __init__(self, instruction, pc=None):
+        EmulatorError.__init__(self, 'Invalid instruction 0x%04x'
+                               % instruction, pc)
+        self.instruction = instruction
+
+
+class InterruptQueueOverflow(EmulatorError):
+    def __init__(self, pc=None):
+        EmulatorError.__init__(self, 'Interrupt queue overflow', pc)
+
+
+class ExecutionResult(object):
+    """ Why and where execute stopped.
+
+    instructions and cycles are the ones executed by that call.
+    """
+    def __init__(self, reason, cpu, instructions, cycles):
+        self.reason = reason
+        self.instructions = instructions
+        self.cycles = cycles
+        self.registers = dict((regidx_to_name[idx], cell.value)
+                              for idx, cell in cpu.registers.iteritems())
+        self.SP = cpu.SP.value
+        self.PC = cpu.PC.value
+        self.EX = cpu.EX.value
+
+    def as_dict(self):
+        return {
+            'halt': self.reason,
+            'instructions': self.instructions,
+            'cycles': self.cycles,
+            'registers': self.registers,
+            'SP': self.SP,
+            'PC': self.PC,
+            'EX': self.EX,
+        }
+
+    def __repr__(self):
+        return '<ExecutionResult %s after %d instructions>' % (
+            self.reason, self.instructions)
+
+
 class Emulator(object):
     def __init__(self, cpu):
         self.cpu = cpu
@@ -41,32 +105,252 @@ class Emulator(object):
             OPCODE.STD: self.STD,
         }
 
+        self.SPECIAL_INSTRUCTIONS = {
+            OPCODE.JSR: self.JSR,
+            OPCODE.INT: self.INT,
+            OPCODE.IAG: self.IAG,
+            OPCODE.IAS: self.IAS,
+            OPCODE.RFI: self.RFI,
+            OPCODE.IAQ: self.IAQ,
+            OPCODE.HWN: self.HWN,
+            OPCODE.HWQ: self.HWQ,
+            OPCODE.HWI: self.HWI,
+        }
 
-    def execute(self, start, limit=None):
-        self.cpu.PC = start
-        if limit:
-            for i in range(limit):
-                self.dispatch()
-            self.halt('Instruction limit reached')
+        self.bus = cpu.bus
+        # Called with the message of every interrupt triggered
+        self.on_interrupt = None
+        # The history.History recording, if any
+        self.history = None
+        # Dispatch hooks, the last one hooked runs first, see hook()
+        self.hooks = []
+        # Accessors for every value, see values.operand_table
+        self.b_operands = operand_table(cpu, as_a=False)
+        self.a_operands = operand_table(cpu, as_a=True)
+        # (instruction, handler, b accessor, a accessor, cycles) by pc
+        # and by instruction word
+        self.decode_cache = {}
+        self.decoded = {}
+
+
+    def execute(self, start, limit=None, cycles=None, rate=None):
+        """ Runs the program from start, returns an ExecutionResult.
+
+        Stops after limit instructions or after cycles cycles, whichever
+        comes first, and runs forever without either. rate throttles
+        execution to about that many cycles per second. Raises an
+        EmulatorError if the program can't continue.
+        """
+        cpu = self.cpu
+        cpu.PC.value = start
+        instructions, cycles_before = cpu.instructions, cpu.cycles
+        if cycles or rate:
+            self.run_timed(cycles, rate, limit)
+        elif limit:
+            self.run(limit)
         else:
             PEACE_ON_EARTH = False
             while not PEACE_ON_EARTH:
+                self.run(0x10000)
+
+        if limit and cpu.instructions - instructions >= limit:
+            return self.halt('Instruction limit reached', instructions,
+                             cycles_before)
+        return self.halt('Cycle limit reached', instructions, cycles_before)
+
+    def run(self, count):
+        """ Executes count instructions from PC """
+        for i in range(count):
+            self.dispatch()
+
+    def run_cycles(self, cycles, limit=None):
+        """ Executes instructions until at least cycles cycles passed.
+
+        Stops early after limit instructions.
+        """
+        cpu = self.cpu
+        end = cpu.cycles + cycles
+        if limit is None:
+            while cpu.cycles < end:
+                self.dispatch()
+        else:
+            last = cpu.instructions + limit
+            while cpu.cycles < end and cpu.instructions < last:
                 self.dispatch()
 
+    def run_timed(self, cycles=None, rate=None, limit=None):
+        """ Runs for cycles cycles, or forever if None.
+
+        With a rate, runs in slices of TIME_SLICE seconds worth of
+        cycles and sleeps whenever the emulation is ahead of the wall
+        clock. Stops early after limit instructions.
+        """
+        if not rate:
+            self.run_cycles(cycles, limit)
+            return
+        cpu = self.cpu
+        first = cpu.cycles
+        end = None if cycles is None else first + cycles
+        last = None if limit is None else cpu.instructions + limit
+        slice_cycles = max(1, int(rate * TIME_SLICE))
+        started = time.time()
+        while ((end is None or cpu.cycles < end) and
+               (last is None or cpu.instructions < last)):
+            budget = slice_cycles
+            if end is not None:
+                budget = min(budget, end - cpu.cycles)
+            self.run_cycles(budget,
+                            None if last is None else last - cpu.instructions)
+            ahead = (float(cpu.cycles - first) / rate -
+                     (time.time() - started))
+            if ahead > 0:
+                time.sleep(ahead)
+
+    def hook(self, dispatch):
+        """ Runs every instruction through dispatch(inner) until
+        unhook(dispatch), where inner() runs the instruction, through the
+        hooks installed before if any.
+
+        The emulator's loops go through dispatch while anything is
+        hooked, so a TranslatingEmulator is interpreted.
+        """
+        self.hooks.append(dispatch)
+        self.chain()
+
+    def unhook(self, dispatch):
+        self.hooks.remove(dispatch)
+        self.chain()
+
+    def chain(self):
+        if not self.hooks:
+            for name in ('dispatch', 'run', 'run_cycles'):
+                self.__dict__.pop(name, None)
+            return
+        dispatch = partial(Emulator.dispatch, self)
+        for hook in self.hooks:
+            dispatch = partial(hook, dispatch)
+        self.dispatch = dispatch
+        # Emulator's loops, which go through dispatch
+        self.run = partial(Emulator.run, self)
+        self.run_cycles = partial(Emulator.run_cycles, self)
+
+    def step_back(self, count=1):
+        """ Undoes the last count instructions, see history.History """
+        if self.history is None:
+            raise EmulatorError('No history is recorded')
+        self.history.step_back(count)
+
+    def run_back_until(self, predicate):
+        """ Steps back until predicate(cpu) is true, returns whether it
+        ever was in the history recorded.
+        """
+        if self.history is None:
+            raise EmulatorError('No history is recorded')
+        return self.history.run_back_until(predicate)
+
     def dispatch(self):
         """ Execute instruction at [PC] """
-        instruction = self.cpu.ram[self.cpu.PC.value].value
-        self.cpu.PC.value = self.cpu.PC.value + 1
-        op_code, b_val, a_val = unpack_instruction(instruction)
-        if op_code == 0x00:
-            self.non_basic(instruction)
+        cpu = self.cpu
+        if cpu.cycles >= self.bus.next_tick:
+            self.service()
+        pc = cpu.PC.value
+        instruction = cpu.memory[pc]
+        cpu.PC.value = pc + 1
+        cpu.instructions += 1
+        # The cached instruction word is compared on every hit, so any
+        # write to a decoded address, by the program itself or the
+        # host, invalidates the entry.
+        decoded = self.decode_cache.get(pc)
+        if decoded is None or decoded[0] != instruction:
+            decoded = self.decode_cache[pc] = self.decode(instruction, pc)
+        instruction, handler, b, a, cycles = decoded
+        if handler is None:
+            self.non_basic(instruction, pc)
         else:
-            b = value_lookup(self.cpu, b_val, as_a=False)
-            a = value_lookup(self.cpu, a_val, as_a=True)
-            if not self.cpu.skip_instruction:
-                self.BASIC_INSTRUCTIONS[op_code](b, a)
+            b = b()
+            a = a()
+            if not cpu.skip_instruction:
+                handler(b, a)
+                cpu.cycles += cycles
+                # A branch failed
+                if cpu.skip_instruction:
+                    cpu.cycles += 1
+            else:
+                self.skip(instruction)
+
+    def service(self):
+        """ Ticks the devices due and triggers a queued interrupt """
+        cpu, bus = self.cpu, self.bus
+        bus.tick(cpu.cycles)
+        # Checked after tick recomputed next_tick, so an interrupt queued
+        # by another thread meanwhile is either seen here or wakes again
+        interrupts = bus.interrupts
+        if interrupts.overflowed:
+            raise InterruptQueueOverflow(cpu.PC.value)
+        if interrupts and not cpu.queueing:
+            if cpu.skip_instruction:
+                # Not in the middle of a chain of IFs
+                bus.wake()
+            else:
+                self.trigger(interrupts.pop())
+
+    def trigger(self, message):
+        """ Jumps to the interrupt handler, a handler at 0 ignores it """
+        cpu = self.cpu
+        if self.on_interrupt is not None:
+            self.on_interrupt(message)
+        if cpu.IA.value == 0:
+            # The rest of the queue is dropped in turn rather than left
+            # waiting for a device tick that may never come
+            if self.bus.interrupts:
+                self.bus.wake()
+            return
+        cpu.queueing = True
+        self.push(cpu.PC.value, cpu.PC.value)
+        self.push(cpu.registers[REG.A].value, cpu.PC.value)
+        cpu.PC.value = cpu.IA.value
+        cpu.registers[REG.A].value = message
+
+    def push(self, word, pc=None):
+        # An empty stack has SP 0xffff
+        if self.cpu.SP.value == 0:
+            raise StackOverflow(pc)
+        self.cpu.SP.value -= 1
+        self.cpu.memory[self.cpu.SP.value] = word
+
+    def pop(self):
+        word = self.cpu.memory[self.cpu.SP.value]
+        self.cpu.SP.value += 1
+        return word
+
+    def skip(self, instruction):
+        """ Skips instruction, a skipped IF skips the next one too """
+        if OPCODE.IFB <= instruction & 0x1f <= OPCODE.IFU:
+            self.cpu.cycles += 1
+        else:
+            self.cpu.skip_instruction = False
+
+    def decode(self, instruction, pc=None):
+        """ Returns (instruction, handler, b accessor, a accessor, cycles)
+
+        Raises InvalidOpcode, reporting pc, for unknown basic opcodes.
+        """
+        decoded = self.decoded.get(instruction)
+        if decoded is None:
+            op_code, b_val, a_val = unpack_instruction(instruction)
+            if op_code != 0x00 and op_code not in self.BASIC_INSTRUCTIONS:
+                raise InvalidOpcode(instruction, pc)
+            if op_code == 0x00:
+                decoded = (instruction, None, None, None, 0)
             else:
-                self.cpu.skip_instruction = False
+                decoded = (instruction,
+                           self.BASIC_INSTRUCTIONS[op_code],
+                           self.b_operands[b_val],
+                           self.a_operands[a_val],
+                           BASIC_CYCLES[op_code] + VALUE_CYCLES[b_val] +
+                           VALUE_CYCLES[a_val])
+            self.decoded[instruction] = decoded
+        return decoded
 
     def SET(self, b, a):
         b.value = a.value
@@ -100,6 +384,8 @@ class Emulator(object):
     def DIV(self, b, a):
         if a.value == 0:
             b.value = 0
+            self.cpu.EX.value = 0
+            return
         bval = b.value
         b.value = bval / a.value
         self.cpu.EX.value = ((bval << 16) / a.value) & 0xffff
@@ -107,6 +393,8 @@ class Emulator(object):
     def DVI(self, b, a):
         if a.value == 0:
             b.value = 0
+            self.cpu.EX.value = 0
+            return
         b_signed = c_int16(b.value)
         a_signed = c_int16(a.value)
         b.value = b_signed.value / a_signed.value
@@ -115,10 +403,13 @@ class Emulator(object):
     def MOD(self, b, a):
         if a.value == 0:
             b.value = 0
-        b.value = b.value % a.value
+        else:
+            b.value = b.value % a.value
 
     def MDI(self, b, a):
-        if c_int16(b.value).value < 0:
+        if a.value == 0:
+            b.value = 0
+        elif c_int16(b.value).value < 0:
             b.value = b.value
         else:
             b.value = b.value % a.value
@@ -196,23 +487,68 @@ class Emulator(object):
         self.cpu.registers[REG.I].value -= 1
         self.cpu.registers[REG.J].value -= 1
 
-    def non_basic(self, instruction):
+    def non_basic(self, instruction, pc=None):
         opcode, a_val = unpack_special_instruction(instruction)
-        if(opcode != OPCODE.JSR):
-            return
-        a = value_lookup(self.cpu, a_val, as_a=True)
+        handler = self.SPECIAL_INSTRUCTIONS.get(opcode)
+        if handler is None:
+            raise InvalidOpcode(instruction, pc)
+        a = self.a_operands[a_val]()
         if self.cpu.skip_instruction:
             self.cpu.skip_instruction = False
             return
-        # Push next address to the stack
-        if self.cpu.SP.value < 0:
-            self.halt('Stack overflow')
-        self.cpu.SP.value -= 1
-        self.cpu.ram[self.cpu.SP.value].value = self.cpu.PC.value
+        self.cpu.cycles += SPECIAL_CYCLES[opcode] + VALUE_CYCLES[a_val]
+        handler(a, pc)
+
+    def JSR(self, a, pc):
+        self.push(self.cpu.PC.value, pc)
         self.cpu.PC.value = a.value
 
-    def halt(self, msg):
-        print "**** HALT *****"
-        print "what: ", msg
-        self.cpu.dump_registers()
-        exit(2)
+    def INT(self, a, pc):
+        self.bus.interrupt(a.value)
+
+    def IAG(self, a, pc):
+        # See HWN
+        if not isinstance(a, Literal):
+            a.value = self.cpu.IA.value
+
+    def IAS(self, a, pc):
+        self.cpu.IA.value = a.value
+
+    def RFI(self, a, pc):
+        self.cpu.queueing = False
+        self.cpu.registers[REG.A].value = self.pop()
+        self.cpu.PC.value = self.pop()
+        self.bus.wake()
+
+    def IAQ(self, a, pc):
+        self.cpu.queueing = a.value != 0
+        if not self.cpu.queueing:
+            self.bus.wake()
+
+    def HWN(self, a, pc):
+        # Short literals are shared, writes to literals are lost anyway
+        if not isinstance(a, Literal):
+            a.value = len(self.bus.devices)
+
+    def HWQ(self, a, pc):
+        registers = self.cpu.registers
+        devices = self.bus.devices
+        if a.value < len(devices):
+            device = devices[a.value]
+            info = (device.id & 0xffff, device.id >> 16, device.version,
+                    device.manufacturer & 0xffff, device.manufacturer >> 16)
+        else:
+            info = (0, 0, 0, 0, 0)
+        for reg, value in zip((REG.A, REG.B, REG.C, REG.X, REG.Y), info):
+            registers[reg].value = value
+
+    def HWI(self, a, pc):
+        devices = self.bus.devices
+        if a.value < len(devices):
+            self.cpu.cycles += devices[a.value].interrupt()
+
+    def halt(self, msg, instructions=0, cycles=0):
+        """ Returns the result of stopping, counting from the given counts """
+        return ExecutionResult(msg, self.cpu,
+                               self.cpu.instructions - instructions,
+                               self.cpu.cycles - cycles)
@@ -0,0 +1,264 @@
+""" Runs a fleet of DCPU-16 machines sharded across worker processes.
+
+Each worker runs the machines it holds round robin, a quantum of cycles
+at a time. A worker that runs out of machines says so and the fleet has
+the most loaded worker hand half of its machines over, shipped as
+Snapshot.dumps strings, so uneven budgets don't leave cores idle.
+"""
+import multiprocessing
+import time
+import traceback
+from collections import deque
+from Queue import Empty
+
+from cpu import ArrayCPU, Snapshot
+from emulator import Emulator, EmulatorError
+from translator import TranslatingEmulator
+
+# Cycles a machine runs before the next one gets its turn
+QUANTUM = 10000
+# Seconds between load reports of a worker
+REPORT_INTERVAL = 0.05
+
+
+class Machine(object):
+    """ A machine held by a worker, running until last or end.
+
+    started holds the instruction and cycle counts the machine was
+    added with, its result counts from them.
+    """
+    def __init__(self, id, state, last, end, started, migrations,
+                 translate):
+        self.id = id
+        self.last = last
+        self.end = end
+        self.started = started
+        self.migrations = migrations
+        cpu = ArrayCPU()
+        cpu.restore(Snapshot.loads(state))
+        if translate:
+            self.emulator = TranslatingEmulator(cpu)
+        else:
+            self.emulator = Emulator(cpu)
+
+    def pack(self):
+        """ Returns the arguments to ship the machine with """
+        return (self.id, self.emulator.cpu.snapshot().dumps(), self.last,
+                self.end, self.started, self.migrations + 1)
+
+    def run(self, quantum):
+        """ Runs a quantum, returns the reason it halted or None """
+        cpu = self.emulator.cpu
+        cycles = quantum
+        if self.end is not None:
+            cycles = min(cycles, self.end - cpu.cycles)
+        limit = None if self.last is None else self.last - cpu.instructions
+        try:
+            self.emulator.run_cycles(cycles, limit)
+        except EmulatorError, e:
+            return str(e)
+        except Exception, e:
+            return 'Error: %s: %s' % (e.__class__.__name__, e)
+        if self.last is not None and cpu.instructions >= self.last:
+            return 'Instruction limit reached'
+        if self.end is not None and cpu.cycles >= self.end:
+            return 'Cycle limit reached'
+
+    def result(self, reason, worker):
+        """ Returns the result dict of halting for reason on worker """
+        result = self.emulator.halt(reason, *self.started).as_dict()
+        result['id'] = self.id
+        result['worker'] = worker
+        result['migrations'] = self.migrations
+        return result
+
+
+def work(index, inbox, outbox, quantum, translate):
+    """ A worker process, running machines until told to stop """
+    try:
+        worker_loop(index, inbox, outbox, quantum, translate)
+    except Exception:
+        outbox.put(('crashed', index, traceback.format_exc()))
+
+
+def worker_loop(index, inbox, outbox, quantum, translate):
+    machines = deque()
+    instructions = cycles = 0
+    reported = time.time()
+    idle = False
+    while True:
+        if not machines and not idle:
+            outbox.put(('load', index, 0, instructions, cycles))
+            outbox.put(('idle', index))
+            idle = True
+            instructions = cycles = 0
+        try:
+            message = inbox.get(not machines)
+        except Empty:
+            message = None
+        if message is not None:
+            kind = message[0]
+            if kind == 'add':
+                for args in message[1]:
+                    machines.append(Machine(*(args + (translate,))))
+                idle = False
+            elif kind == 'steal':
+                stolen = [machines.pop().pack()
+                          for i in range(len(machines) // 2)]
+                outbox.put(('migrate', index, message[1], stolen))
+            elif kind == 'stop':
+                outbox.put(('load', index, len(machines), instructions,
+                            cycles))
+                outbox.put(('stopped', index))
+                return
+            continue
+
+        machine = machines.popleft()
+        cpu = machine.emulator.cpu
+        before = cpu.instructions, cpu.cycles
+        reason = machine.run(quantum)
+        instructions += cpu.instructions - before[0]
+        cycles += cpu.cycles - before[1]
+        if reason is None:
+            machines.append(machine)
+        else:
+            outbox.put(('done', index, machine.result(reason, index)))
+        now = time.time()
+        if now - reported > REPORT_INTERVAL:
+            outbox.put(('load', index, len(machines), instructions, cycles))
+            instructions = cycles = 0
+            reported = now
+
+
+class Fleet(object):
+    """ Machines to run on worker processes.
+
+    Add machines with add(), then run() them all. Afterwards metrics
+    holds the aggregate throughput.
+    """
+    def __init__(self, workers=None, quantum=QUANTUM, translate=False):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.quantum = quantum
+        self.translate = translate
+        self.machines = []
+        self.metrics = None
+
+    def add(self, cpu, limit=None, cycles=None):
+        """ Adds a copy of cpu to run for limit instructions or cycles
+        cycles, returns its id.
+        """
+        if limit is None and cycles is None:
+            raise ValueError('A machine needs an instruction or cycle limit')
+        id = len(self.machines)
+        self.machines.append((
+            id, cpu.snapshot().dumps(),
+            None if limit is None else cpu.instructions + limit,
+            None if cycles is None else cpu.cycles + cycles,
+            (cpu.instructions, cpu.cycles), 0))
+        return id
+
+    def run(self):
+        """ Runs every machine added, returns a list of their results """
+        started = time.time()
+        outbox = multiprocessing.Queue()
+        inboxes = [multiprocessing.Queue() for i in range(self.workers)]
+        processes = [multiprocessing.Process(
+            target=work, args=(index, inbox, outbox, self.quantum,
+                               self.translate))
+            for index, inbox in enumerate(inboxes)]
+        for process in processes:
+            process.daemon = True
+            process.start()
+
+        for index, inbox in enumerate(inboxes):
+            inbox.put(('add', self.machines[index::self.workers]))
+        load = [len(self.machines[index::self.workers])
+                for index in range(self.workers)]
+        stats = [{'instructions': 0, 'cycles': 0, 'finished': 0}
+                 for index in range(self.workers)]
+        idle = set()
+        stealing = set()
+        results = [None] * len(self.machines)
+        remaining = len(self.machines)
+        migrations = 0
+        try:
+            while remaining:
+                message = outbox.get()
+                kind, index = message[:2]
+                if kind == 'crashed':
+                    raise RuntimeError('Worker %d crashed:\n%s'
+                                       % (index, message[2]))
+                elif kind == 'done':
+                    result = message[2]
+                    results[result['id']] = result
+                    stats[index]['finished'] += 1
+                    remaining -= 1
+                elif kind == 'load':
+                    load[index] = message[2]
+                    stats[index]['instructions'] += message[3]
+                    stats[index]['cycles'] += message[4]
+                elif kind == 'idle':
+                    load[index] = 0
+                    idle.add(index)
+                elif kind == 'migrate':
+                    thief, machines = message[2], message[3]
+                    stealing.discard(index)
+                    stealing.discard(thief)
+                    load[index] -= len(machines)
+                    if machines:
+                        migrations += len(machines)
+                        load[thief] += len(machines)
+                        idle.discard(thief)
+                        inboxes[thief].put(('add', machines))
+                self.balance(load, idle, stealing, inboxes)
+        except:
+            for process in processes:
+                process.terminate()
+            raise
+
+        for inbox in inboxes:
+            inbox.put(('stop',))
+        # Workers report what they ran since their last report first
+        stopped = 0
+        while stopped < self.workers:
+            message = outbox.get()
+            kind, index = message[:2]
+            if kind == 'load':
+                stats[index]['instructions'] += message[3]
+                stats[index]['cycles'] += message[4]
+            elif kind == 'stopped':
+                stopped += 1
+        for process in processes:
+            process.join()
+
+        wall_time = time.time() - started
+        instructions = sum(result['instructions'] for result in results)
+        cycles = sum(result['cycles'] for result in results)
+        self.metrics = {
+            'machines': len(results),
+            'instructions': instructions,
+            'cycles': cycles,
+            'wall_time': wall_time,
+            'instructions_per_second': instructions / wall_time,
+            'cycles_per_second': cycles / wall_time,
+            'migrations': migrations,
+            'workers': stats,
+        }
+        return results
+
+    def balance(self, load, idle, stealing, inboxes):
+        """ Has the most loaded workers give machines to idle ones """
+        for thief in list(idle):
+            if thief in stealing:
+                continue
+            victims = [index for index in range(len(load))
+                       if index not in idle and index not in stealing]
+            if not victims:
+                return
+            victim = max(victims, key=lambda index: load[index])
+            if load[victim] < 2:
+                return
+            stealing.add(victim)
+            # Taken out of idle once the machines arrive
+            stealing.add(thief)
+            inboxes[victim].put(('steal', thief))
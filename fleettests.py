@@ -0,0 +1,115 @@
+import unittest
+from Queue import Queue
+
+from cpu import ArrayCPU, Snapshot
+from constants import REG, OPCODE
+from emulator import Emulator
+from fleet import Fleet, Machine, worker_loop
+from utils import pack_instruction, Value
+
+# :loop ADD A, 1 ; ADD [A], B ; SET PC, loop
+PROGRAM = [
+    pack_instruction(OPCODE.ADD, Value.reg(REG.A), Value.literal(1)),
+    pack_instruction(OPCODE.ADD, Value.addr_reg(REG.A), Value.reg(REG.B)),
+    pack_instruction(OPCODE.SET, Value.pc(), Value.literal(0)),
+]
+
+class TestFleet(unittest.TestCase):
+
+    def machine(self, seed, ran=0):
+        """ A machine that already ran ran instructions """
+        cpu = ArrayCPU()
+        cpu.load(PROGRAM)
+        cpu.registers[REG.A].value = 0x100
+        cpu.registers[REG.B].value = seed
+        Emulator(cpu).run(ran)
+        return cpu
+
+    def test_snapshot_dumps(self):
+        cpu = self.machine(3)
+        Emulator(cpu).run(100)
+        cpu.IA.value = 0x20
+        cpu.bus.interrupts.push(9)
+        snapshot = Snapshot.loads(cpu.snapshot().dumps())
+        copy = ArrayCPU()
+        copy.restore(snapshot)
+        self.assertEqual(list(copy.regfile), list(cpu.regfile))
+        self.assertEqual(copy.ram_image(), cpu.ram_image())
+        self.assertEqual((copy.IA.value, copy.cycles, copy.instructions),
+                         (0x20, cpu.cycles, cpu.instructions))
+        self.assertEqual(copy.bus.interrupts.pending(), [9])
+
+    def test_fleet(self):
+        fleet = Fleet(workers=2, quantum=500)
+        limits = {}
+        for seed in range(8):
+            # The first worker is dealt every long running machine
+            limits[seed] = 40000 if seed % 2 == 0 else 1000
+            self.assertEqual(fleet.add(self.machine(seed, 100),
+                                       limit=limits[seed]), seed)
+        results = fleet.run()
+        for seed, result in enumerate(results):
+            cpu = self.machine(seed, 100 + limits[seed])
+            self.assertEqual(result['halt'], 'Instruction limit reached')
+            self.assertEqual(result['instructions'], limits[seed])
+            self.assertEqual(result['registers']['A'],
+                             cpu.registers[REG.A].value)
+            self.assertEqual(result['PC'], cpu.PC.value)
+        metrics = fleet.metrics
+        self.assertEqual(metrics['instructions'], sum(limits.values()))
+        self.assertEqual(sum(worker['instructions']
+                             for worker in metrics['workers']),
+                         metrics['instructions'])
+        self.assertTrue(metrics['instructions_per_second'] > 0)
+
+    def test_steal(self):
+        fleet = Fleet(workers=2)
+        for seed in range(4):
+            fleet.add(self.machine(seed, 100), limit=1000)
+        inbox, outbox = Queue(), Queue()
+        # Handled in order before the worker runs anything
+        inbox.put(('add', fleet.machines))
+        inbox.put(('steal', 1))
+        inbox.put(('stop',))
+        worker_loop(0, inbox, outbox, 500, False)
+        messages = []
+        while not outbox.empty():
+            messages.append(outbox.get())
+        # Idle until the machines are added
+        self.assertEqual(messages[:2], [('load', 0, 0, 0, 0), ('idle', 0)])
+        kind, index, thief, stolen = messages[2]
+        self.assertEqual((kind, index, thief), ('migrate', 0, 1))
+        self.assertEqual([args[0] for args in stolen], [3, 2])
+        self.assertEqual(messages[3:], [('load', 0, 2, 0, 0),
+                                        ('stopped', 0)])
+        # Stolen machines carry on where they were, and count from where
+        # they were added
+        for args in stolen:
+            machine = Machine(*(args + (False,)))
+            self.assertEqual(machine.migrations, 1)
+            reason = machine.run(10000)
+            self.assertEqual(reason, 'Instruction limit reached')
+            cpu = self.machine(args[0], 1100)
+            self.assertEqual(list(machine.emulator.cpu.regfile),
+                             list(cpu.regfile))
+            result = machine.result(reason, 1)
+            self.assertEqual(result['instructions'], 1000)
+            self.assertEqual(result['cycles'],
+                             cpu.cycles - self.machine(args[0], 100).cycles)
+            self.assertEqual((result['worker'], result['migrations']),
+                             (1, 1))
+
+    def test_balance(self):
+        fleet = Fleet(workers=3)
+        inboxes = [Queue() for i in range(3)]
+        load, idle, stealing = [1, 5, 0], set([2]), set()
+        fleet.balance(load, idle, stealing, inboxes)
+        self.assertEqual(inboxes[1].get_nowait(), ('steal', 2))
+        self.assertTrue(inboxes[0].empty() and inboxes[2].empty())
+        self.assertEqual(stealing, set([1, 2]))
+        # Nothing more until the machines arrive
+        fleet.balance(load, idle, stealing, inboxes)
+        self.assertTrue(inboxes[1].empty())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,221 @@
+""" Hardware devices and the bus connecting them to a CPU """
+import threading
+from array import array
+from heapq import heapify, heappush, heappop
+
+from constants import REG
+
+# The DCPU-16 runs at 100 kHz
+CPU_HZ = 100000
+
+# next_tick of a bus nothing is scheduled on
+NEVER = float('inf')
+
+# Interrupts queued at once before the CPU catches fire
+QUEUE_SIZE = 256
+
+
+class InterruptQueue(object):
+    """ Fixed size ring buffer of interrupt messages.
+
+    push is safe to call from any thread, pop only from the one running
+    the emulator. A push to a full queue sets overflowed instead.
+    """
+    def __init__(self, size=QUEUE_SIZE):
+        self.messages = array('H', [0] * size)
+        self.lock = threading.Lock()
+        self.clear()
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+        self.overflowed = False
+
+    def push(self, message):
+        with self.lock:
+            size = len(self.messages)
+            if self.count == size:
+                self.overflowed = True
+                return
+            self.messages[(self.head + self.count) % size] = message & 0xffff
+            self.count += 1
+
+    def pop(self):
+        with self.lock:
+            message = self.messages[self.head]
+            self.head = (self.head + 1) % len(self.messages)
+            self.count -= 1
+        return message
+
+    def pending(self):
+        """ Returns the queued messages, oldest first """
+        with self.lock:
+            size = len(self.messages)
+            return [self.messages[(self.head + i) % size]
+                    for i in range(self.count)]
+
+
+class Bus(object):
+    """ The devices attached to a CPU, in HWN/HWQ/HWI order.
+
+    Devices are never polled. A device that wants to do something at a
+    later cycle count asks for it with schedule() and the emulator calls
+    tick() once cpu.cycles reached next_tick, the earliest of those, so
+    idle hardware costs a single comparison per instruction.
+
+    Queued interrupts use the same comparison: interrupt() and wake()
+    set next_tick to 0 so that the emulator services the bus before the
+    next instruction.
+    """
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.devices = []
+        self.interrupts = InterruptQueue()
+        # (cycle, order, device) heap
+        self.scheduled = []
+        self.order = 0
+        self.next_tick = NEVER
+
+    def attach(self, device):
+        """ Connects device, returns its index on the bus """
+        self.devices.append(device)
+        device.attached(self)
+        return len(self.devices) - 1
+
+    def schedule(self, device, cycle):
+        """ Has device.tick called once cpu.cycles reaches cycle """
+        self.order += 1
+        heappush(self.scheduled, (cycle, self.order, device))
+        self.reschedule()
+
+    def cancel(self, device):
+        """ Drops everything device scheduled """
+        self.scheduled = [entry for entry in self.scheduled
+                          if entry[2] is not device]
+        heapify(self.scheduled)
+        self.reschedule()
+
+    def reschedule(self):
+        """ Sets next_tick to the earliest cycle scheduled, or 0 while
+        interrupts are queued.
+
+        Holds the queue's lock, so an interrupt() from another thread
+        is either seen here or wakes the bus after.
+        """
+        interrupts = self.interrupts
+        with interrupts.lock:
+            if interrupts.count:
+                self.next_tick = 0
+            elif self.scheduled:
+                self.next_tick = self.scheduled[0][0]
+            else:
+                self.next_tick = NEVER
+
+    def interrupt(self, message):
+        """ Queues a hardware interrupt, safe to call from any thread """
+        self.interrupts.push(message)
+        self.wake()
+
+    def wake(self):
+        """ Has the emulator service the bus before the next instruction """
+        self.next_tick = 0
+
+    def tick(self, cycles):
+        """ Ticks the devices scheduled up to cycles """
+        scheduled = self.scheduled
+        while scheduled and scheduled[0][0] <= cycles:
+            heappop(scheduled)[2].tick(cycles)
+        self.next_tick = scheduled[0][0] if scheduled else NEVER
+
+    def reset(self):
+        """ Drops everything scheduled or queued and resets the devices """
+        self.scheduled = []
+        self.next_tick = NEVER
+        self.interrupts.clear()
+        for device in self.devices:
+            device.reset()
+
+
+class Device(object):
+    """ Base class of hardware.
+
+    HWQ reports id, version and manufacturer. A device only touches the
+    CPU from interrupt(), called on HWI, and tick().
+    """
+    id = 0
+    version = 0
+    manufacturer = 0
+
+    def __init__(self):
+        self.bus = None
+        self.cpu = None
+
+    def attached(self, bus):
+        self.bus = bus
+        self.cpu = bus.cpu
+
+    def interrupt(self):
+        """ Handles HWI, returns the cycles it took on top of HWI's """
+        return 0
+
+    def tick(self, cycles):
+        """ Called at the cycle count passed to schedule, or just after """
+
+    def schedule(self, cycle):
+        self.bus.schedule(self, cycle)
+
+    def cancel(self):
+        self.bus.cancel(self)
+
+    def reset(self):
+        """ Back to the state at power on """
+
+
+class Clock(Device):
+    """ Generic clock, ticking at 60 / B Hz once started.
+
+    HWI with A=0 starts it at 60 / B Hz, or stops it if B is 0, A=1
+    sets C to the ticks since it was started and A=2 has every tick
+    interrupt with message B, or turns that off if B is 0.
+    """
+    id = 0x12d0b402
+    version = 1
+
+    def __init__(self):
+        Device.__init__(self)
+        self.reset()
+
+    def reset(self):
+        self.divider = 0
+        self.ticks = 0
+        self.started = 0
+        self.message = 0
+
+    def interrupt(self):
+        registers = self.cpu.registers
+        command = registers[REG.A].value
+        if command == 0:
+            self.cancel()
+            self.divider = registers[REG.B].value
+            self.ticks = 0
+            self.started = self.cpu.cycles
+            if self.divider:
+                self.schedule_tick()
+        elif command == 1:
+            registers[REG.C].value = self.ticks
+        elif command == 2:
+            self.message = registers[REG.B].value
+        return 0
+
+    def schedule_tick(self):
+        self.schedule(self.started + ((self.ticks + 1) * CPU_HZ *
+                                      self.divider // 60))
+
+    def tick(self, cycles):
+        self.ticks += 1
+        self.schedule_tick()
+        if self.message:
+            self.bus.interrupt(self.message)
@@ -0,0 +1,270 @@
+import threading
+import unittest
+
+from cpu import CPU, ArrayCPU
+from emulator import Emulator, InterruptQueueOverflow
+from translator import TranslatingEmulator
+from constants import REG, OPCODE
+from hardware import Clock, Device, NEVER, QUEUE_SIZE
+from utils import pack_instruction, pack_special_instruction, Value
+
+class Keyboard(Device):
+    id = 0x30cf7406
+    version = 1
+    manufacturer = 0x1c6c8b36
+
+    def __init__(self):
+        Device.__init__(self)
+        self.interrupts = 0
+
+    def interrupt(self):
+        self.interrupts += 1
+        return 3
+
+# SET A, 0 ; SET B, 1 ; HWI 0 ; :loop ADD X, 1 ; SET PC, loop
+CLOCK_PROGRAM = [
+    pack_instruction(OPCODE.SET, Value.reg(REG.A), Value.literal(0)),
+    pack_instruction(OPCODE.SET, Value.reg(REG.B), Value.literal(1)),
+    pack_special_instruction(OPCODE.HWI, Value.literal(0)),
+    pack_instruction(OPCODE.ADD, Value.reg(REG.X), Value.literal(1)),
+    pack_instruction(OPCODE.SET, Value.pc(), Value.literal(3)),
+]
+
+class TestHardware(unittest.TestCase):
+
+    def test_query(self):
+        cpu = CPU()
+        keyboard = Keyboard()
+        self.assertEqual(cpu.bus.attach(Clock()), 0)
+        self.assertEqual(cpu.bus.attach(keyboard), 1)
+        cpu.load([
+            # HWN I
+            pack_special_instruction(OPCODE.HWN, Value.reg(REG.I)),
+            # HWQ 1
+            pack_special_instruction(OPCODE.HWQ, Value.literal(1)),
+            # HWI 1
+            pack_special_instruction(OPCODE.HWI, Value.literal(1)),
+            # HWQ 2
+            pack_special_instruction(OPCODE.HWQ, Value.literal(2)),
+        ])
+        emulator = Emulator(cpu)
+        for i in range(3):
+            emulator.dispatch()
+        self.assertEqual(cpu.registers[REG.I].value, 2)
+        self.assertEqual([cpu.registers[reg].value for reg in
+                          (REG.A, REG.B, REG.C, REG.X, REG.Y)],
+                         [0x7406, 0x30cf, 1, 0x8b36, 0x1c6c])
+        self.assertEqual(keyboard.interrupts, 1)
+        self.assertEqual(cpu.cycles, 2 + 4 + (4 + 3))
+        emulator.dispatch()
+        self.assertEqual([cpu.registers[reg].value for reg in
+                          (REG.A, REG.B, REG.C, REG.X, REG.Y)],
+                         [0, 0, 0, 0, 0])
+
+    def test_write_literal(self):
+        cpu = ArrayCPU()
+        cpu.bus.attach(Clock())
+        # HWN 5 ; SET A, 5 ; IAS 0x100 ; IAG 6 ; SET B, 6
+        cpu.load([
+            pack_special_instruction(OPCODE.HWN, Value.literal(5)),
+            pack_instruction(OPCODE.SET, Value.reg(REG.A), Value.literal(5)),
+            pack_special_instruction(OPCODE.IAS, Value.next_word_literal()),
+            0x100,
+            pack_special_instruction(OPCODE.IAG, Value.literal(6)),
+            pack_instruction(OPCODE.SET, Value.reg(REG.B), Value.literal(6)),
+        ])
+        emulator = Emulator(cpu)
+        emulator.run(5)
+        self.assertEqual(cpu.registers[REG.A].value, 5)
+        self.assertEqual(cpu.registers[REG.B].value, 6)
+
+    def test_clock(self):
+        for cls, emulator_cls in ((CPU, Emulator),
+                                  (ArrayCPU, TranslatingEmulator)):
+            cpu = cls()
+            clock = Clock()
+            cpu.bus.attach(clock)
+            cpu.load(CLOCK_PROGRAM)
+            emulator = emulator_cls(cpu)
+            self.assertEqual(cpu.bus.next_tick, NEVER)
+            # 60 Hz is a tick every 1666.67 cycles
+            emulator.run_cycles(10000)
+            self.assertEqual(clock.ticks, 5)
+            self.assertTrue(cpu.bus.next_tick > cpu.cycles)
+
+            # Stopping the clock unschedules it
+            cpu.reset_state()
+            self.assertEqual(clock.ticks, 0)
+            self.assertEqual(cpu.bus.next_tick, NEVER)
+
+    def test_read_ticks(self):
+        cpu = CPU()
+        clock = Clock()
+        cpu.bus.attach(clock)
+        clock.ticks = 7
+        cpu.registers[REG.A].value = 1
+        # HWI 0
+        cpu.load([pack_special_instruction(OPCODE.HWI, Value.literal(0))])
+        Emulator(cpu).dispatch()
+        self.assertEqual(cpu.registers[REG.C].value, 7)
+
+# IAS 5 ; INT 7 ; :loop SET PC, loop
+# ...
+# :handler ADD I, A ; ADD J, 1 ; RFI 0
+INTERRUPT_PROGRAM = [
+    pack_special_instruction(OPCODE.IAS, Value.literal(5)),
+    pack_special_instruction(OPCODE.INT, Value.literal(7)),
+    pack_instruction(OPCODE.SET, Value.pc(), Value.literal(2)),
+    0,
+    0,
+    pack_instruction(OPCODE.ADD, Value.reg(REG.I), Value.reg(REG.A)),
+    pack_instruction(OPCODE.ADD, Value.reg(REG.J), Value.literal(1)),
+    pack_special_instruction(OPCODE.RFI, Value.literal(0)),
+]
+
+class TestInterrupts(unittest.TestCase):
+
+    def setUp(self):
+        self.cpu = ArrayCPU()
+        self.cpu.load(INTERRUPT_PROGRAM)
+        self.cpu.registers[REG.A].value = 3
+        self.emulator = Emulator(self.cpu)
+
+    def run_for(self, instructions):
+        for i in range(instructions):
+            self.emulator.dispatch()
+
+    def test_software_interrupt(self):
+        self.run_for(2)
+        self.assertEqual(self.cpu.bus.next_tick, 0)
+        self.run_for(1)
+        # Trapped before SET PC, 2
+        self.assertEqual(self.cpu.PC.value, 6)
+        self.assertTrue(self.cpu.queueing)
+        self.assertEqual(self.cpu.registers[REG.A].value, 7)
+        self.assertEqual(list(self.cpu.memory[0xfffd:0xffff]), [3, 2])
+        self.run_for(2)
+        self.assertEqual(self.cpu.PC.value, 2)
+        self.assertEqual(self.cpu.registers[REG.A].value, 3)
+        self.assertEqual(self.cpu.registers[REG.I].value, 7)
+        self.assertEqual(self.cpu.SP.value, 0xffff)
+        self.assertFalse(self.cpu.queueing)
+        # RFI had the queue checked once more
+        self.run_for(1)
+        self.assertEqual(self.cpu.bus.next_tick, NEVER)
+
+    def test_ignored(self):
+        self.cpu.memory[0] = pack_special_instruction(OPCODE.IAS,
+                                                      Value.literal(0))
+        self.run_for(4)
+        self.assertEqual(self.cpu.PC.value, 2)
+        self.assertEqual(self.cpu.registers[REG.I].value, 0)
+        self.assertEqual(len(self.cpu.bus.interrupts), 0)
+
+    def test_ignored_queue(self):
+        self.cpu.memory[0] = pack_special_instruction(OPCODE.IAS,
+                                                      Value.literal(0))
+        messages = []
+        self.emulator.on_interrupt = messages.append
+        for message in (1, 2, 3):
+            self.cpu.bus.interrupt(message)
+        # One dropped before each instruction, no device ticks, the
+        # program's INT 7 queued behind them
+        self.run_for(4)
+        self.assertEqual(messages, [1, 2, 3, 7])
+        self.assertEqual(len(self.cpu.bus.interrupts), 0)
+        self.run_for(1)
+        self.assertEqual(self.cpu.bus.next_tick, NEVER)
+
+    def test_queueing(self):
+        self.cpu.IA.value = 5
+        self.cpu.memory[0] = pack_special_instruction(OPCODE.IAQ,
+                                                      Value.literal(1))
+        self.run_for(1)
+        self.cpu.bus.interrupt(1)
+        self.run_for(1)
+        self.cpu.bus.interrupt(2)
+        self.assertEqual(self.cpu.bus.interrupts.pending(), [1, 7, 2])
+        self.run_for(4)
+        self.assertEqual(self.cpu.registers[REG.I].value, 0)
+
+        self.cpu.queueing = False
+        self.cpu.bus.wake()
+        self.run_for(40)
+        self.assertEqual(self.cpu.registers[REG.I].value, 10)
+        self.assertEqual(self.cpu.registers[REG.J].value, 3)
+
+    def test_schedule_keeps_wake(self):
+        clock = Clock()
+        self.cpu.bus.attach(clock)
+        self.cpu.bus.interrupt(3)
+        clock.schedule(100)
+        self.assertEqual(self.cpu.bus.next_tick, 0)
+        clock.cancel()
+        self.assertEqual(self.cpu.bus.next_tick, 0)
+        self.run_for(1)
+        clock.schedule(100)
+        self.assertEqual(self.cpu.bus.next_tick, 100)
+        clock.cancel()
+        self.assertEqual(self.cpu.bus.next_tick, NEVER)
+
+    def test_overflow(self):
+        self.cpu.queueing = True
+        for i in range(QUEUE_SIZE):
+            self.cpu.bus.interrupt(i)
+        self.run_for(1)
+        self.cpu.bus.interrupt(0)
+        self.assertRaises(InterruptQueueOverflow, self.run_for, 1)
+
+    def test_threads(self):
+        self.cpu.IA.value = 5
+        count = 200
+        def inject():
+            for i in range(count):
+                self.cpu.bus.interrupt(1)
+        thread = threading.Thread(target=inject)
+        thread.start()
+        while thread.is_alive() or len(self.cpu.bus.interrupts):
+            self.run_for(100)
+        thread.join()
+        self.run_for(10)
+        # INT 7 was ignored before IAS
+        self.assertEqual(self.cpu.registers[REG.J].value, count + 1)
+        self.assertEqual(self.cpu.registers[REG.I].value, count + 7)
+
+    def test_clock_interrupts(self):
+        self.cpu.reset()
+        clock = Clock()
+        self.cpu.bus.attach(clock)
+        self.cpu.load([
+            # IAS 8
+            pack_special_instruction(OPCODE.IAS, Value.literal(8)),
+            # SET B, 1
+            pack_instruction(OPCODE.SET, Value.reg(REG.B), Value.literal(1)),
+            # HWI 0
+            pack_special_instruction(OPCODE.HWI, Value.literal(0)),
+            # SET A, 2
+            pack_instruction(OPCODE.SET, Value.reg(REG.A), Value.literal(2)),
+            # SET B, 3
+            pack_instruction(OPCODE.SET, Value.reg(REG.B), Value.literal(3)),
+            # HWI 0
+            pack_special_instruction(OPCODE.HWI, Value.literal(0)),
+            # :loop SET PC, loop
+            pack_instruction(OPCODE.SET, Value.pc(), Value.literal(6)),
+            0,
+        ] + INTERRUPT_PROGRAM[5:])
+        self.emulator.run_cycles(10000)
+        self.assertEqual(self.cpu.registers[REG.J].value, clock.ticks)
+        self.assertEqual(self.cpu.registers[REG.I].value, 3 * clock.ticks)
+
+    def test_snapshot(self):
+        self.cpu.queueing = True
+        self.cpu.bus.interrupt(4)
+        snapshot = self.cpu.snapshot()
+        self.cpu.reset_state()
+        self.cpu.restore(snapshot)
+        self.assertEqual(self.cpu.bus.interrupts.pending(), [4])
+        self.assertTrue(self.cpu.queueing)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+""" Runs an Emulator backwards.
+
+History.start() hooks the emulator's dispatch to log what every
+instruction overwrites, the registers and the memory words at the
+addresses tracing.write_addresses finds, so stepping back is applying
+the last undo entry. The log is bounded; instructions older
+than it are reached from checkpoints, snapshots taken every interval
+instructions, by restoring the last one before and running forward.
+
+Checkpoints are thinned out with age, each kept one is at least a
+DENSITY-th of its age away from the next, so a run of n instructions
+keeps about DENSITY * log(n / interval) of them and going back a
+distance d re-executes at most about d / DENSITY instructions.
+
+Devices aren't rewound, only the cpu, ram and the interrupt queue, which
+is saved whenever it's serviced and by INT and HWI.
+"""
+from bisect import bisect_right
+from collections import deque
+from ctypes import memmove
+
+from tracing import QUEUEING_INSTRUCTIONS, changed_words, write_addresses
+
+# Instructions that can be undone without a checkpoint
+HISTORY = 50000
+CHECKPOINT_INTERVAL = 10000
+DENSITY = 8
+
+
+class History(object):
+    """ The undo log and checkpoints of everything emulator runs between
+    start() and stop().
+    """
+    def __init__(self, emulator, limit=HISTORY,
+                 interval=CHECKPOINT_INTERVAL, density=DENSITY):
+        self.emulator = emulator
+        self.cpu = cpu = emulator.cpu
+        regfile = getattr(cpu, 'regfile', None)
+        self.regfile = None if regfile is None else buffer(regfile)
+        self.cells = ([cpu.registers[reg] for reg in sorted(cpu.registers)] +
+                      [cpu.SP, cpu.PC, cpu.EX])
+        self.undo = deque(maxlen=limit)
+        self.interval = interval
+        self.density = density
+        self.checkpoints = []
+        # Instruction count of every checkpoint
+        self.positions = []
+
+    def start(self):
+        emulator = self.emulator
+        emulator.history = self
+        emulator.hook(self.dispatch)
+        self.checkpoint()
+
+    def stop(self):
+        self.emulator.unhook(self.dispatch)
+        self.emulator.history = None
+
+    def registers(self):
+        if self.regfile is not None:
+            return self.regfile[:]
+        return tuple([cell.value for cell in self.cells])
+
+    def set_registers(self, registers):
+        if self.regfile is not None:
+            memmove(self.cpu.regfile, registers, len(registers))
+        else:
+            for cell, value in zip(self.cells, registers):
+                cell.value = value
+
+    def checkpoint(self):
+        cpu = self.cpu
+        if self.positions and self.positions[-1] >= cpu.instructions:
+            return
+        self.checkpoints.append(cpu.snapshot())
+        self.positions.append(cpu.instructions)
+        # The first and last are always kept
+        now = cpu.instructions
+        kept = [len(self.positions) - 1]
+        for index in range(len(self.positions) - 2, 0, -1):
+            newer = self.positions[kept[-1]]
+            if newer - self.positions[index] >= (now - newer) // self.density:
+                kept.append(index)
+        kept.append(0)
+        kept.reverse()
+        if len(kept) < len(self.positions):
+            self.checkpoints = [self.checkpoints[index] for index in kept]
+            self.positions = [self.positions[index] for index in kept]
+
+    def dispatch(self, inner):
+        cpu = self.cpu
+        emulator = self.emulator
+        if cpu.instructions - self.positions[-1] >= self.interval:
+            self.checkpoint()
+        memory = cpu.memory
+        registers = self.registers()
+        IA = cpu.IA.value
+        skip = cpu.skip_instruction
+        queueing = cpu.queueing
+        cycles = cpu.cycles
+        interrupts = None
+        writes = []
+        if cycles >= emulator.bus.next_tick:
+            # Triggering an interrupt pushes PC and A
+            interrupts = tuple(emulator.bus.interrupts.pending())
+            sp = cpu.SP.value
+            writes = [((sp - 1) & 0xffff, memory[(sp - 1) & 0xffff]),
+                      ((sp - 2) & 0xffff, memory[(sp - 2) & 0xffff])]
+            emulator.service()
+        pc = cpu.PC.value
+        instruction = memory[pc]
+        if interrupts is None and \
+                instruction & 0x3ff in QUEUEING_INSTRUCTIONS:
+            interrupts = tuple(emulator.bus.interrupts.pending())
+        addresses = write_addresses(cpu, instruction, pc)
+        image = None
+        if addresses is None:
+            image = cpu.ram_image()
+        elif addresses:
+            writes += [(address, memory[address]) for address in addresses]
+        try:
+            inner()
+        finally:
+            if image is not None:
+                writes += [(address, old) for address, old, new in
+                           changed_words(image, cpu.ram_image())]
+            self.undo.append((registers, IA, skip, queueing, cycles,
+                              interrupts, writes))
+
+    def seek(self, instructions):
+        """ Returns to the state before instruction count instructions """
+        cpu = self.cpu
+        if instructions > cpu.instructions:
+            raise ValueError('Instruction %d has not run yet' % instructions)
+        if cpu.instructions - instructions > len(self.undo):
+            index = bisect_right(self.positions, instructions) - 1
+            if index < 0:
+                raise IndexError('Instruction %d is before the history'
+                                 % instructions)
+            cpu.restore(self.checkpoints[index])
+            self.undo.clear()
+        else:
+            while cpu.instructions > instructions:
+                self.step()
+        self.forget()
+        if cpu.instructions < instructions:
+            self.emulator.run(instructions - cpu.instructions)
+
+    def forget(self):
+        """ Drops the checkpoints of a future that may not happen again """
+        index = bisect_right(self.positions, self.cpu.instructions)
+        del self.checkpoints[index:]
+        del self.positions[index:]
+
+    def step(self):
+        """ Undoes the last instruction in the log """
+        cpu = self.cpu
+        (registers, IA, skip, queueing, cycles, interrupts,
+         writes) = self.undo.pop()
+        memory = cpu.memory
+        for address, word in reversed(writes):
+            memory[address] = word
+        self.set_registers(registers)
+        cpu.IA.value = IA
+        cpu.skip_instruction = skip
+        cpu.queueing = queueing
+        cpu.cycles = cycles
+        cpu.instructions -= 1
+        if interrupts is not None:
+            queue = self.emulator.bus.interrupts
+            queue.clear()
+            for message in interrupts:
+                queue.push(message)
+            self.emulator.bus.wake()
+
+    def step_back(self, count=1):
+        self.seek(self.cpu.instructions - count)
+
+    def run_back_until(self, predicate):
+        """ Steps back until predicate(cpu) is true, returns False and
+        stops at the start of the history if it never is.
+        """
+        cpu = self.cpu
+        while self.undo:
+            self.step()
+            if predicate(cpu):
+                self.forget()
+                return True
+        # Then the windows between checkpoints, newest first
+        end = cpu.instructions
+        for index in range(bisect_right(self.positions, end) - 1, -1, -1):
+            if self.positions[index] >= end:
+                continue
+            cpu.restore(self.checkpoints[index])
+            self.undo.clear()
+            found = None
+            while cpu.instructions < end:
+                if predicate(cpu):
+                    found = cpu.instructions
+                self.emulator.dispatch()
+            if found is not None:
+                self.seek(found)
+                return True
+            end = self.positions[index]
+        cpu.restore(self.checkpoints[0])
+        self.undo.clear()
+        self.forget()
+        return False
+
@@ -0,0 +1,151 @@
+import unittest
+
+from cpu import ArrayCPU, CPU
+from constants import REG, OPCODE
+from display import LEM1802, ImageRenderer
+from emulator import Emulator, EmulatorError
+from history import History
+from tracing import Tracer, Trace
+from utils import pack_instruction, pack_special_instruction, Value
+
+# IAS 12 ; :loop ADD A, 1 ; STI [J], A ; SET PUSH, A ; SET [B+3], POP ;
+# INT 5 ; JSR sub ; SET PC, loop ; 0 ; :sub SET [0x9000], A ;
+# SET PC, POP ; 0 ; :handler HWI 0 ; RFI 0
+PROGRAM = [
+    pack_special_instruction(OPCODE.IAS, Value.literal(14)),
+    pack_instruction(OPCODE.ADD, Value.reg(REG.A), Value.literal(1)),
+    pack_instruction(OPCODE.STI, Value.addr_reg(REG.J), Value.reg(REG.A)),
+    pack_instruction(OPCODE.SET, Value.push_pop(), Value.reg(REG.A)),
+    pack_instruction(OPCODE.SET, Value.addr_reg_next_word(REG.B),
+                     Value.push_pop()), 3,
+    pack_special_instruction(OPCODE.INT, Value.literal(5)),
+    pack_special_instruction(OPCODE.JSR, Value.literal(10)),
+    pack_instruction(OPCODE.SET, Value.pc(), Value.literal(1)),
+    0,
+    pack_instruction(OPCODE.SET, Value.next_word_addr(), Value.reg(REG.A)),
+    0x9000,
+    pack_instruction(OPCODE.SET, Value.pc(), Value.push_pop()),
+    0,
+    pack_special_instruction(OPCODE.HWI, Value.literal(0)),
+    pack_special_instruction(OPCODE.RFI, Value.literal(0)),
+]
+
+class TestHistory(unittest.TestCase):
+
+    def machine(self, cpu_class=ArrayCPU):
+        cpu = cpu_class()
+        cpu.load(PROGRAM)
+        cpu.registers[REG.B].value = 0x4000
+        cpu.registers[REG.J].value = 0x5000
+        cpu.bus.attach(LEM1802(ImageRenderer()))
+        return cpu, Emulator(cpu)
+
+    def expected(self, instructions, cpu_class=ArrayCPU):
+        cpu, emulator = self.machine(cpu_class)
+        emulator.run(instructions)
+        return cpu
+
+    def assertSameState(self, cpu, expected):
+        registers = lambda cpu: ([cell.value for reg, cell in
+                                  sorted(cpu.registers.items())] +
+                                 [cpu.SP.value, cpu.PC.value, cpu.EX.value,
+                                  cpu.IA.value])
+        self.assertEqual(registers(cpu), registers(expected))
+        self.assertEqual(cpu.cycles, expected.cycles)
+        self.assertEqual(cpu.instructions, expected.instructions)
+        self.assertEqual(cpu.skip_instruction, expected.skip_instruction)
+        self.assertEqual(cpu.queueing, expected.queueing)
+        self.assertEqual(list(cpu.bus.interrupts.pending()),
+                         list(expected.bus.interrupts.pending()))
+        self.assertTrue(cpu.ram_image() == expected.ram_image(),
+                        'Memory differs')
+
+    def test_step_back(self):
+        cpu, emulator = self.machine()
+        history = History(emulator, limit=100, interval=50, density=2)
+        history.start()
+        emulator.run(1000)
+        emulator.step_back()
+        self.assertSameState(cpu, self.expected(999))
+        # Undone from the log, then from checkpoints
+        for instructions in [990, 950, 700, 123, 0]:
+            emulator.step_back(cpu.instructions - instructions)
+            self.assertSameState(cpu, self.expected(instructions))
+        self.assertRaises(IndexError, emulator.step_back)
+        emulator.run(300)
+        self.assertSameState(cpu, self.expected(300))
+        history.stop()
+        self.assertRaises(EmulatorError, emulator.step_back)
+
+    def test_int(self):
+        cpu, emulator = self.machine()
+        History(emulator).start()
+        # The 6th instruction is INT 5
+        emulator.run(6)
+        self.assertEqual(list(cpu.bus.interrupts.pending()), [5])
+        emulator.step_back()
+        self.assertSameState(cpu, self.expected(5))
+        emulator.run(201)
+        self.assertSameState(cpu, self.expected(206))
+
+    def test_cpu(self):
+        cpu, emulator = self.machine(CPU)
+        History(emulator, limit=20, interval=10).start()
+        emulator.run(60)
+        emulator.step_back(5)
+        self.assertSameState(cpu, self.expected(55, CPU))
+        emulator.step_back(30)
+        self.assertSameState(cpu, self.expected(25, CPU))
+
+    def test_run_back_until(self):
+        cpu, emulator = self.machine()
+        History(emulator, limit=100, interval=50, density=2).start()
+        emulator.run(1000)
+        # A is 20 from the 20th time around the loop until the 21st
+        twenty = lambda cpu: cpu.registers[REG.A].value == 20
+        self.assertTrue(emulator.run_back_until(twenty))
+        expected, expected_emulator = self.machine()
+        last = None
+        for i in range(1000):
+            if twenty(expected):
+                last = i
+            expected_emulator.dispatch()
+        self.assertSameState(cpu, self.expected(last))
+
+        self.assertFalse(emulator.run_back_until(lambda cpu: False))
+        self.assertSameState(cpu, self.expected(0))
+
+    def test_checkpoints(self):
+        cpu, emulator = self.machine()
+        history = History(emulator, limit=10, interval=10, density=4)
+        history.start()
+        emulator.run(20000)
+        self.assertEqual(history.positions[0], 0)
+        self.assertTrue(len(history.positions) < 40, history.positions)
+        # Spaced about a density-th of their age apart
+        for older, newer in zip(history.positions[1:],
+                                history.positions[2:]):
+            self.assertTrue(newer - older >= (20000 - newer) // 4 - 10)
+        emulator.step_back(12345)
+        self.assertSameState(cpu, self.expected(20000 - 12345))
+
+    def test_with_tracer(self):
+        cpu, emulator = self.machine()
+        tracer = Tracer(emulator, keyframe_interval=50, segments=10)
+        tracer.start()
+        history = History(emulator, interval=100)
+        history.start()
+        emulator.run(300)
+        # Unhooking the tracer, below the history, keeps the history
+        tracer.stop()
+        emulator.run(100)
+        emulator.step_back(250)
+        self.assertSameState(cpu, self.expected(150))
+        self.assertSameState(Trace(tracer.data()).state(150),
+                             self.expected(150))
+        history.stop()
+        self.assertFalse('dispatch' in emulator.__dict__)
+        self.assertEqual(emulator.hooks, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,19 +1,23 @@
 import random
+import time
 import unittest
 from ctypes import c_int16
 
-from cpu import CPU
-from emulator import Emulator
+from cpu import CPU, ArrayCPU
+from emulator import Emulator, InvalidOpcode, StackOverflow
+from translator import TranslatingEmulator
 from constants import REG, OPCODE
 from utils import (pack_instruction,
         pack_special_instruction, unpack_instruction,
         unpack_special_instruction, Value)
 
 class TestInstructions(unittest.TestCase):
+    cpu_class = CPU
+    emulator_class = Emulator
 
     def setUp(self):
-        self.cpu = CPU()
-        self.emulator = Emulator(self.cpu)
+        self.cpu = self.cpu_class()
+        self.emulator = self.emulator_class(self.cpu)
 
     def test_add(self):
         """ Sets REG.A to REG.A + REG.B """
@@ -167,6 +171,25 @@ class TestInstructions(unittest.TestCase):
         signed_result = c_int16(self.cpu.registers[REG.A].value)
         self.assertEqual(signed_result.value, -7, "MDI failed")
 
+    def test_divide_by_zero(self):
+        """ Sets REG.A, and EX for DIV and DVI, to 0 when REG.B is 0 """
+        for op_code in (OPCODE.DIV, OPCODE.DVI, OPCODE.MOD, OPCODE.MDI):
+            self.setUp()
+            self.cpu.registers[REG.A].value = -7
+            self.cpu.EX.value = 0x1234
+
+            # DIV/DVI/MOD/MDI A,B
+            self.cpu.ram[0].value = pack_instruction(op_code=op_code,
+                                                     a=Value.reg(REG.A),
+                                                     b=Value.reg(REG.B))
+            self.emulator.dispatch()
+
+            self.assertEqual(self.cpu.registers[REG.A].value, 0)
+            self.assertEqual(self.cpu.EX.value,
+                             0 if op_code in (OPCODE.DIV, OPCODE.DVI)
+                             else 0x1234)
+            self.assertEqual(self.cpu.PC.value, 1)
+
     def test_shl(self):
         """ Sets REG.A to REG.A << REG.B """
         self.cpu.registers[REG.A].value = 0x0008
@@ -460,6 +483,110 @@ class TestInstructions(unittest.TestCase):
         self.assertEqual(self.cpu.PC.value, 0x2323, "PC not right")
         self.assertEqual(self.cpu.ram[self.cpu.SP.value].value, 0x1, "Stack not right")
 
+    def test_decode_cache_self_modifying(self):
+        """ Rewriting a cached instruction takes effect """
+        # ADD A, 1
+        self.cpu.ram[0].value = pack_instruction(op_code=OPCODE.ADD,
+                                                 a=Value.reg(REG.A),
+                                                 b=Value.literal(1))
+        self.emulator.dispatch()
+
+        # SUB A, 1
+        self.cpu.ram[0].value = pack_instruction(op_code=OPCODE.SUB,
+                                                 a=Value.reg(REG.A),
+                                                 b=Value.literal(1))
+        self.cpu.PC.value = 0
+        self.emulator.dispatch()
+        self.assertEqual(self.cpu.registers[REG.A].value, 0, "Stale decode")
+
+    def test_cycles(self):
+        """ Counts opcode and next word cycles """
+        # ADD A, [0x1000]
+        self.cpu.ram[0].value = pack_instruction(op_code=OPCODE.ADD,
+                                                 a=Value.reg(REG.A),
+                                                 b=Value.next_word_addr())
+        self.cpu.ram[1].value = 0x1000
+        # JSR 0x10
+        self.cpu.ram[2].value = pack_special_instruction(op_code=OPCODE.JSR,
+                                                         a=Value.literal(0x10))
+        self.emulator.dispatch()
+        self.assertEqual(self.cpu.cycles, 3)
+        self.emulator.dispatch()
+        self.assertEqual(self.cpu.cycles, 6)
+
+    def test_cycles_failed_branch(self):
+        """ Failed branches and skipped IFs take a cycle more """
+        # IFE A, 1
+        self.cpu.ram[0].value = pack_instruction(op_code=OPCODE.IFE,
+                                                 a=Value.reg(REG.A),
+                                                 b=Value.literal(1))
+        # IFN A, 0
+        self.cpu.ram[1].value = pack_instruction(op_code=OPCODE.IFN,
+                                                 a=Value.reg(REG.A),
+                                                 b=Value.literal(0))
+        # SET A, 5
+        self.cpu.ram[2].value = pack_instruction(op_code=OPCODE.SET,
+                                                 a=Value.reg(REG.A),
+                                                 b=Value.literal(5))
+        for i in range(3):
+            self.emulator.dispatch()
+
+        self.assertEqual(self.cpu.cycles, 4, "Cycles not counted")
+        self.assertEqual(self.cpu.registers[REG.A].value, 0, "Chained IF not skipped")
+        self.assertEqual(self.cpu.skip_instruction, False, "Skip error")
+
+    def test_run_cycles(self):
+        # SET PC, 0
+        self.cpu.ram[0].value = pack_instruction(op_code=OPCODE.SET,
+                                                 a=Value.pc(),
+                                                 b=Value.literal(0))
+        self.emulator.run_cycles(100)
+        self.assertEqual(self.cpu.cycles, 100)
+
+    def test_run_timed(self):
+        # SET PC, 0
+        self.cpu.ram[0].value = pack_instruction(op_code=OPCODE.SET,
+                                                 a=Value.pc(),
+                                                 b=Value.literal(0))
+        started = time.time()
+        self.emulator.run_timed(cycles=300, rate=3000)
+        self.assertEqual(self.cpu.cycles, 300)
+        self.assertTrue(time.time() - started >= 0.09, "Not throttled")
+
+    def test_execute_result(self):
+        # SET PC, 0
+        self.cpu.ram[0].value = pack_instruction(op_code=OPCODE.SET,
+                                                 a=Value.pc(),
+                                                 b=Value.literal(0))
+        result = self.emulator.execute(0, limit=40, cycles=100)
+        self.assertEqual(result.reason, 'Instruction limit reached')
+        self.assertEqual(result.instructions, 40)
+        self.assertEqual(result.cycles, 40)
+        self.assertEqual(result.PC, 0)
+
+        result = self.emulator.execute(0, limit=100, cycles=30)
+        self.assertEqual(result.reason, 'Cycle limit reached')
+        self.assertEqual(result.cycles, 30)
+        self.assertEqual(result.as_dict()['instructions'], 30)
+
+    def test_invalid_opcode(self):
+        self.cpu.ram[3].value = 0x18
+        self.cpu.PC.value = 3
+        try:
+            self.emulator.dispatch()
+        except InvalidOpcode, e:
+            self.assertEqual(e.pc, 3)
+            self.assertEqual(e.instruction, 0x18)
+        else:
+            self.fail("No InvalidOpcode raised")
+
+    def test_stack_overflow(self):
+        # JSR 0x10
+        self.cpu.ram[0].value = pack_special_instruction(op_code=OPCODE.JSR,
+                                                         a=Value.literal(0x10))
+        self.cpu.SP.value = 0
+        self.assertRaises(StackOverflow, self.emulator.dispatch)
+
     def test_pack_unpack(self):
         packed = pack_instruction(op_code=OPCODE.IFG,
                                   a=Value.reg(REG.A),
@@ -478,6 +605,13 @@ class TestInstructions(unittest.TestCase):
         self.assertEqual(op_code, OPCODE.JSR)
         self.assertEqual(a, Value.reg(REG.A))
 
+class TestInstructionsArrayCPU(TestInstructions):
+    cpu_class = ArrayCPU
+
+class TestInstructionsTranslated(TestInstructions):
+    cpu_class = ArrayCPU
+    emulator_class = TranslatingEmulator
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -1,9 +1,14 @@
-import struct
 import sys
 import optparse
 
-from cpu import CPU
-from emulator import Emulator
+from cpu import ArrayCPU
+from debugger import Debugger
+from display import LEM1802, TerminalRenderer, ROWS
+from emulator import Emulator, EmulatorError
+from profiler import Profiler
+from tracing import Tracer
+from translator import TranslatingEmulator
+from utils import load_program, save_image
 
 optparser = optparse.OptionParser()
 optparser.add_option('-f', '--file', dest="file", help="Program file")
@@ -11,21 +16,120 @@ optparser.add_option('-l',
                      '--limit',
                      dest="limit",
                      help="Max number of instructions to execute")
+optparser.add_option('-c',
+                     '--cycles',
+                     dest="cycles",
+                     help="Max number of cycles to execute")
+optparser.add_option('-r',
+                     '--rate',
+                     dest="rate",
+                     help="Cycles per second to run at, e.g. 100000")
+optparser.add_option('-d',
+                     '--dump',
+                     dest="dump",
+                     help="File to write the ram image to when halted")
+optparser.add_option('-t',
+                     '--translate',
+                     action="store_true",
+                     dest="translate",
+                     help="Compile basic blocks to Python functions")
+optparser.add_option('-s',
+                     '--screen',
+                     action="store_true",
+                     dest="screen",
+                     help="Attach a display drawn on the terminal")
+optparser.add_option('-m',
+                     '--shared',
+                     dest="shared",
+                     help="File to keep registers and ram in for other "
+                          "processes to attach to, e.g. /dev/shm/dcpu")
+optparser.add_option('-p',
+                     '--profile',
+                     dest="profile",
+                     help="Print a profile and write its collapsed stacks, "
+                          "for flamegraph.pl, to this file")
+optparser.add_option('-x',
+                     '--trace',
+                     dest="trace",
+                     help="File to record every instruction executed to, "
+                          "see tracing.py")
+optparser.add_option('-b',
+                     '--break',
+                     action="append",
+                     dest="breakpoints",
+                     default=[],
+                     help="Halt before the instruction at this address, "
+                          "can be given more than once")
+optparser.add_option('-w',
+                     '--watch',
+                     action="append",
+                     dest="watches",
+                     default=[],
+                     help="Halt after a write to this address, can be "
+                          "given more than once")
 (options, args) = optparser.parse_args(sys.argv)
 
 if not options.file:
     optparser.print_help()
     exit(1)
+if options.profile and options.trace:
+    optparser.error('Profiling and tracing can not be combined')
 
-cpu = CPU()
+if options.shared:
+    cpu = ArrayCPU.create_shared(options.shared)
+else:
+    cpu = ArrayCPU()
 limit = None
 if options.limit:
     limit = int(options.limit, 0)  # Guess base
-f = open(options.file)
-data = f.read()
-words = struct.unpack('>%dH' % (len(data) / 2), data)
-for word, idx in zip(words, range(len(words))):
-    cpu.ram[idx] = word
+cycles = None
+if options.cycles:
+    cycles = int(options.cycles, 0)
+rate = None
+if options.rate:
+    rate = int(options.rate, 0)
+load_program(cpu, options.file)
+if options.screen:
+    display = LEM1802(TerminalRenderer())
+    cpu.bus.attach(display)
+    display.start()
 
-emulator = Emulator(cpu)
-emulator.execute(0, limit)
+if options.translate:
+    emulator = TranslatingEmulator(cpu)
+else:
+    emulator = Emulator(cpu)
+if options.profile:
+    profiler = Profiler(emulator)
+    profiler.start()
+if options.breakpoints or options.watches:
+    debugger = Debugger(emulator)
+    for address in options.breakpoints:
+        debugger.add_breakpoint(int(address, 0))
+    for address in options.watches:
+        debugger.watch(int(address, 0))
+if options.trace:
+    tracer = Tracer(emulator, open(options.trace, 'wb'))
+    tracer.start()
+try:
+    reason = emulator.execute(0, limit, cycles, rate).reason
+except EmulatorError, e:
+    reason = str(e)
+if options.trace:
+    tracer.stop()
+    tracer.f.close()
+if options.screen:
+    display.stop()
+    display.frame()
+    sys.stdout.write('\x1b[%dH' % (ROWS + 1))
+print "**** HALT *****"
+print "what: ", reason
+cpu.dump_registers()
+if options.profile:
+    print
+    print profiler.report()
+    f = open(options.profile, 'w')
+    f.write(profiler.collapsed())
+    f.close()
+if options.dump:
+    save_image(cpu, options.dump)
+exit(2)
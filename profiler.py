@@ -0,0 +1,152 @@
+""" Profiles the program an Emulator runs.
+
+Profiler.start() hooks the emulator's dispatch to record every
+instruction, see Emulator.hook, and stop() unhooks it, so an emulator
+that isn't being profiled runs exactly the code it always did. A
+TranslatingEmulator is interpreted while profiled, blocks hide the
+instructions they run.
+
+Calls are JSR and triggered interrupts, returns SET PC, POP and RFI.
+"""
+from bisect import bisect_right
+from collections import defaultdict
+
+from constants import OPCODE
+from utils import pack_instruction, Value
+
+SPECIAL_OPCODES = ('JSR', 'INT', 'IAG', 'IAS', 'RFI', 'IAQ', 'HWN', 'HWQ',
+                   'HWI')
+SPECIAL_NAMES = dict((getattr(OPCODE, name), name)
+                     for name in SPECIAL_OPCODES)
+BASIC_NAMES = dict((getattr(OPCODE, name), name) for name in dir(OPCODE)
+                   if not name.startswith('_') and
+                   name not in SPECIAL_OPCODES)
+RETURN = pack_instruction(OPCODE.SET, Value.pc(), Value.push_pop())
+# Special opcodes are shifted past the zero basic opcode
+JSR = OPCODE.JSR << 5
+RFI = OPCODE.RFI << 5
+
+
+def opcode_name(instruction):
+    if instruction & 0x1f:
+        return BASIC_NAMES.get(instruction & 0x1f, 'invalid')
+    return SPECIAL_NAMES.get((instruction >> 5) & 0x1f, 'invalid')
+
+
+class Profiler(object):
+    """ Execution counts and cycles per address, opcode and call stack.
+
+    addresses and opcodes map to [count, cycles], calls maps a call
+    target to [count, cycles including callees] and edges (caller,
+    callee) to a count. stacks maps tuples of call targets, outermost
+    first, to the cycles spent with that stack.
+    """
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.addresses = defaultdict(lambda: [0, 0])
+        self.opcodes = defaultdict(lambda: [0, 0])
+        self.calls = defaultdict(lambda: [0, 0])
+        self.edges = defaultdict(int)
+        self.stacks = defaultdict(int)
+        self.frames = []
+        self.stack = ()
+
+    def start(self):
+        """ Profiles everything the emulator runs until stop() """
+        emulator = self.emulator
+        if not self.stack:
+            self.stack = (emulator.cpu.PC.value,)
+        emulator.hook(self.dispatch)
+
+    def stop(self):
+        self.emulator.unhook(self.dispatch)
+
+    def dispatch(self, inner):
+        emulator = self.emulator
+        cpu = emulator.cpu
+        if cpu.cycles >= emulator.bus.next_tick:
+            queueing = cpu.queueing
+            emulator.service()
+            if cpu.queueing and not queueing:
+                self.call(cpu.PC.value)
+        pc = cpu.PC.value
+        instruction = cpu.memory[pc]
+        skipped = cpu.skip_instruction
+        cycles = cpu.cycles
+        try:
+            inner()
+        finally:
+            spent = cpu.cycles - cycles
+            counts = self.addresses[pc]
+            counts[0] += 1
+            counts[1] += spent
+            counts = self.opcodes[opcode_name(instruction)]
+            counts[0] += 1
+            counts[1] += spent
+            self.stacks[self.stack] += spent
+        if skipped:
+            return
+        if instruction & 0x3ff == JSR:
+            self.call(cpu.PC.value)
+        elif instruction == RETURN or instruction & 0x3ff == RFI:
+            self.ret()
+
+    def call(self, target):
+        self.calls[target][0] += 1
+        self.edges[(self.stack[-1], target)] += 1
+        self.frames.append((target, self.emulator.cpu.cycles))
+        self.stack += (target,)
+
+    def ret(self):
+        # Returns past where profiling started are ignored
+        if self.frames:
+            target, entered = self.frames.pop()
+            self.calls[target][1] += self.emulator.cpu.cycles - entered
+            self.stack = self.stack[:-1]
+
+    def namer(self, symbols):
+        """ Returns a function naming addresses after the labels in
+        symbols, label: address, as label+offset.
+        """
+        labels = sorted((address, name)
+                        for name, address in (symbols or {}).iteritems())
+        addresses = [address for address, name in labels]
+        def name(address):
+            index = bisect_right(addresses, address) - 1
+            if index < 0:
+                return '0x%04x' % address
+            label_address, label = labels[index]
+            if address == label_address:
+                return label
+            return '%s+%d' % (label, address - label_address)
+        return name
+
+    def report(self, symbols=None, top=20):
+        """ Returns the hottest addresses, opcodes and calls as text """
+        name = self.namer(symbols)
+        total = sum(self.stacks.itervalues()) or 1
+        lines = []
+        def table(title, rows, header):
+            lines.append('%-20s %10s %12s %7s' % ((title,) + header))
+            for key, (count, cycles) in rows[:top]:
+                lines.append('%-20s %10d %12d %6.2f%%'
+                             % (key, count, cycles, 100.0 * cycles / total))
+            lines.append('')
+        def hottest(counts):
+            return sorted(counts.iteritems(), key=lambda item: -item[1][1])
+        table('Address', [(name(pc), counts) for pc, counts in
+                          hottest(self.addresses)],
+              ('count', 'cycles', '%'))
+        table('Opcode', hottest(self.opcodes), ('count', 'cycles', '%'))
+        table('Call', [(name(target), counts) for target, counts in
+                       hottest(self.calls)],
+              ('calls', 'cycles', '%'))
+        return '\n'.join(lines)
+
+    def collapsed(self, symbols=None):
+        """ Returns the stacks in the collapsed format of flamegraph.pl """
+        name = self.namer(symbols)
+        return ''.join('%s %d\n' % (';'.join(name(frame) for frame in stack),
+                                    cycles)
+                       for stack, cycles in sorted(self.stacks.iteritems())
+                       if cycles)
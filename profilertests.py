@@ -0,0 +1,73 @@
+import unittest
+
+from cpu import ArrayCPU
+from constants import REG, OPCODE
+from emulator import Emulator
+from translator import TranslatingEmulator
+from profiler import Profiler
+from utils import pack_instruction, pack_special_instruction, Value
+
+# JSR sub ; JSR sub ; :end SET PC, end
+# :sub SET A, 3 ; :loop SUB A, 1 ; IFN A, 0 ; SET PC, loop ; SET PC, POP
+PROGRAM = [
+    pack_special_instruction(OPCODE.JSR, Value.literal(3)),
+    pack_special_instruction(OPCODE.JSR, Value.literal(3)),
+    pack_instruction(OPCODE.SET, Value.pc(), Value.literal(2)),
+    pack_instruction(OPCODE.SET, Value.reg(REG.A), Value.literal(3)),
+    pack_instruction(OPCODE.SUB, Value.reg(REG.A), Value.literal(1)),
+    pack_instruction(OPCODE.IFN, Value.reg(REG.A), Value.literal(0)),
+    pack_instruction(OPCODE.SET, Value.pc(), Value.literal(4)),
+    pack_instruction(OPCODE.SET, Value.pc(), Value.push_pop()),
+]
+SYMBOLS = {'start': 0, 'end': 2, 'sub': 3, 'loop': 4}
+
+class TestProfiler(unittest.TestCase):
+
+    def profile(self, emulator_class, instructions):
+        cpu = ArrayCPU()
+        cpu.load(PROGRAM)
+        emulator = emulator_class(cpu)
+        profiler = Profiler(emulator)
+        profiler.start()
+        emulator.run(instructions)
+        profiler.stop()
+        return emulator, profiler
+
+    def test_counts(self):
+        emulator, profiler = self.profile(Emulator, 30)
+        # Each call runs the loop 3 times and skips its last jump
+        self.assertEqual(profiler.addresses[4][0], 6)
+        self.assertEqual(profiler.addresses[6][0], 6)
+        self.assertEqual(profiler.opcodes['JSR'][0], 2)
+        self.assertEqual(profiler.opcodes['IFN'][0], 6)
+        self.assertEqual(profiler.calls[3][0], 2)
+        self.assertEqual(profiler.edges[(0, 3)], 2)
+        self.assertEqual(sum(cycles for count, cycles in
+                             profiler.addresses.itervalues()),
+                         emulator.cpu.cycles)
+        self.assertEqual(sum(profiler.stacks.itervalues()),
+                         emulator.cpu.cycles)
+        self.assertEqual(profiler.stack, (0,))
+
+        # The profiled loop is gone
+        emulator.run(10)
+        self.assertEqual(sum(count for count, cycles in
+                             profiler.addresses.itervalues()), 30)
+
+    def test_translated(self):
+        emulator, profiler = self.profile(TranslatingEmulator, 30)
+        self.assertEqual(profiler.addresses[4][0], 6)
+
+    def test_output(self):
+        emulator, profiler = self.profile(Emulator, 30)
+        lines = profiler.collapsed(SYMBOLS).splitlines()
+        stacks = dict(line.rsplit(' ', 1) for line in lines)
+        self.assertEqual(sorted(stacks), ['start', 'start;sub'])
+        self.assertEqual(sum(int(cycles) for cycles in stacks.values()),
+                         emulator.cpu.cycles)
+        report = profiler.report(SYMBOLS)
+        self.assertTrue('loop+2' in report)
+        self.assertTrue('IFN' in report)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,406 @@
+#!/usr/bin/python
+""" Records what a program does, instruction by instruction, and replays it.
+
+A trace starts with MAGIC and alternates two kinds of records:
+
+    'K' index, length, Snapshot.dumps    keyframe, the state before
+                                         instruction index
+    'S' index, count, length, zlib data  the count instructions after it
+
+Each instruction of a segment is a RECORD header with its pc, word,
+flags, cycles and IA, the register file after it and the memory words
+it wrote. Registers are stored whole rather than diffed, which is a
+single copy per instruction, and left for zlib to squeeze once per
+segment, where they compress to about the changed words. Instructions
+that can change the interrupt queue, INT, HWI and the ones the bus was
+serviced before, are flagged INTERRUPTS and followed by the queue
+after them.
+
+A trace written to a file ends with an index of its keyframes so that
+replay seeks straight to the one before the instruction asked for. One
+kept in memory only holds the last few segments.
+"""
+import optparse
+import struct
+import sys
+import zlib
+from array import array
+from bisect import bisect_right
+from collections import deque
+
+from constants import OPCODE, regidx_to_name
+from cpu import ArrayCPU, Snapshot, PAGE_BYTES, REGFILE_WORDS
+
+MAGIC = 'DCPUTRC2'
+END = 'DCPUTEND'
+KEYFRAME_INTERVAL = 10000
+
+KEYFRAME = struct.Struct('<cQI')
+SEGMENT = struct.Struct('<cQII')
+RECORD = struct.Struct('=HHBHHB')
+REGFILE = struct.Struct('=%dH' % REGFILE_WORDS)
+MEMORY_WRITE = struct.Struct('=HH')
+QUEUE_LENGTH = struct.Struct('=H')
+INDEX_ENTRY = struct.Struct('<QQ')
+INDEX = struct.Struct('<cI')
+FOOTER = struct.Struct('<Q8s')
+
+# Instruction flags, the state after the instruction
+SKIP = 1
+QUEUEING = 2
+INTERRUPTS = 4
+
+REGFILE_NAMES = [regidx_to_name[reg] for reg in range(8)] + \
+    ['SP', 'PC', 'EX']
+
+HWI = OPCODE.HWI << 5
+JSR = OPCODE.JSR << 5
+
+# Special instructions that can queue interrupts themselves
+QUEUEING_INSTRUCTIONS = (OPCODE.INT << 5, HWI)
+
+
+def write_addresses(cpu, instruction, pc):
+    """ Returns the addresses instruction at pc of cpu can write to, or
+    None if it could write anywhere.
+    """
+    if instruction & 0x1f:
+        # b, resolved first, uses the first next word
+        value = (instruction >> 5) & 0x1f
+        addresses = []
+    elif instruction & 0x3ff == HWI:
+        return None
+    else:
+        value = instruction >> 10
+        addresses = ([(cpu.SP.value - 1) & 0xffff]
+                     if instruction & 0x3ff == JSR else [])
+    if value < 0x08:
+        return addresses
+    memory = cpu.memory
+    if value <= 0x0f:
+        addresses.append(cpu.registers[value - 0x08].value)
+    elif value <= 0x17:
+        addresses.append((cpu.registers[value - 0x10].value +
+                          memory[(pc + 1) & 0xffff]) & 0xffff)
+    elif value == 0x18 and instruction & 0x1f:
+        # PUSH as b, POP as a
+        addresses.append((cpu.SP.value - 1) & 0xffff)
+    elif value <= 0x19:
+        addresses.append(cpu.SP.value)
+    elif value == 0x1a:
+        addresses.append((cpu.SP.value + memory[(pc + 1) & 0xffff])
+                         & 0xffff)
+    elif value == 0x1e:
+        addresses.append(memory[(pc + 1) & 0xffff])
+    elif value == 0x1f:
+        addresses.append((pc + 1) & 0xffff)
+    return addresses
+
+
+def changed_words(before, after):
+    """ Returns (address, old, new) of every word that differs between
+    two ram images, comparing them a page at a time.
+    """
+    changed = []
+    for start in range(0, len(before), PAGE_BYTES):
+        end = start + PAGE_BYTES
+        if before[start:end] == after[start:end]:
+            continue
+        old = array('H')
+        old.fromstring(before[start:end])
+        new = array('H')
+        new.fromstring(after[start:end])
+        changed += [(start // 2 + offset, word, new[offset])
+                    for offset, word in enumerate(old)
+                    if word != new[offset]]
+    return changed
+
+
+class Tracer(object):
+    """ Traces everything emulator runs between start() and stop().
+
+    With a file f, a segment is written to it as soon as it's complete.
+    Without one the last segments are kept in memory, see data().
+    """
+    def __init__(self, emulator, f=None, keyframe_interval=KEYFRAME_INTERVAL,
+                 segments=4):
+        self.emulator = emulator
+        self.cpu = cpu = emulator.cpu
+        regfile = getattr(cpu, 'regfile', None)
+        # Slicing the buffer copies the registers without a call
+        self.regfile = None if regfile is None else buffer(regfile)
+        if regfile is None:
+            cells = [cpu.registers[reg] for reg in range(8)] + \
+                [cpu.SP, cpu.PC, cpu.EX]
+            self.registers = lambda: REGFILE.pack(*[cell.value
+                                                    for cell in cells])
+        self.f = f
+        self.keyframe_interval = keyframe_interval
+        self.segments = deque(maxlen=segments)
+        self.keyframes = []
+        self.keyframe_data = None
+        self.records = []
+        self.first = 0
+        self.count = 0
+        self.written = 0
+        if f is not None:
+            f.write(MAGIC)
+            self.written = len(MAGIC)
+
+    def start(self):
+        self.emulator.hook(self.dispatch)
+
+    def stop(self):
+        """ Stops tracing, writes the last segment and the keyframe index """
+        self.emulator.unhook(self.dispatch)
+        self.end_segment()
+        if self.f is not None:
+            index = (INDEX.pack('X', len(self.keyframes)) +
+                     ''.join(INDEX_ENTRY.pack(*keyframe)
+                             for keyframe in self.keyframes))
+            self.f.write(index + FOOTER.pack(self.written, END))
+            self.f.flush()
+
+    def data(self):
+        """ Returns the last segments kept in memory as a trace """
+        return MAGIC + ''.join(self.segments)
+
+    def keyframe(self):
+        self.end_segment()
+        snapshot = self.cpu.snapshot().dumps()
+        self.keyframe_data = (KEYFRAME.pack('K', self.count, len(snapshot)) +
+                              snapshot)
+        self.first = self.count
+
+    def end_segment(self):
+        if self.keyframe_data is None:
+            return
+        data = zlib.compress(''.join(self.records), 1)
+        segment = (self.keyframe_data +
+                   SEGMENT.pack('S', self.first, len(self.records),
+                                len(data)) + data)
+        self.records = []
+        self.keyframe_data = None
+        if self.f is None:
+            self.segments.append(segment)
+            return
+        self.keyframes.append((self.first, self.written))
+        self.f.write(segment)
+        self.written += len(segment)
+
+    def dispatch(self, inner):
+        cpu = self.cpu
+        emulator = self.emulator
+        if self.keyframe_data is None or \
+                self.count - self.first == self.keyframe_interval:
+            self.keyframe()
+        memory = cpu.memory
+        cycles = cpu.cycles
+        sp = cpu.SP.value
+        serviced = cycles >= emulator.bus.next_tick
+        if serviced:
+            emulator.service()
+        pc = cpu.PC.value
+        instruction = memory[pc]
+        queue = serviced or instruction & 0x3ff in QUEUEING_INSTRUCTIONS
+        addresses = write_addresses(cpu, instruction, pc)
+        # Interrupts entered while servicing pushed from here to sp
+        pushed = cpu.SP.value
+        if addresses is None:
+            image = cpu.ram_image()
+        elif addresses:
+            old = [memory[address] for address in addresses]
+        try:
+            inner()
+        finally:
+            self.count += 1
+            if addresses is None:
+                written = [(address, new) for address, old, new in
+                           changed_words(image, cpu.ram_image())]
+            elif addresses:
+                written = [(address, memory[address])
+                           for address, word in zip(addresses, old)
+                           if memory[address] != word]
+            else:
+                written = []
+            if pushed != sp:
+                written += [(address, memory[address])
+                            for address in range(pushed, sp)]
+            if self.regfile is not None:
+                registers = self.regfile[:]
+            else:
+                registers = self.registers()
+            interrupts = ''
+            if queue:
+                pending = emulator.bus.interrupts.pending()
+                interrupts = (QUEUE_LENGTH.pack(len(pending)) +
+                              array('H', pending).tostring())
+            self.records.append(
+                RECORD.pack(pc, instruction,
+                            ((SKIP if cpu.skip_instruction else 0) |
+                             (QUEUEING if cpu.queueing else 0) |
+                             (INTERRUPTS if queue else 0)),
+                            min(cpu.cycles - cycles, 0xffff), cpu.IA.value,
+                            len(written)) +
+                registers +
+                ''.join([MEMORY_WRITE.pack(*write) for write in written]) +
+                interrupts)
+
+
+class Record(object):
+    """ An executed instruction read back from a trace """
+    __slots__ = ('index', 'pc', 'instruction', 'flags', 'cycles', 'IA',
+                 'regfile', 'memory', 'interrupts')
+
+    def __repr__(self):
+        return '<Record %d pc 0x%04x 0x%04x>' % (self.index, self.pc,
+                                                 self.instruction)
+
+
+def segment_records(data, first):
+    """ Yields the Records of the uncompressed segment data """
+    offset = 0
+    index = first
+    while offset < len(data):
+        record = Record()
+        (record.pc, record.instruction, record.flags, record.cycles,
+         record.IA, writes) = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        record.regfile = REGFILE.unpack_from(data, offset)
+        offset += REGFILE.size
+        record.memory = [MEMORY_WRITE.unpack_from(data, offset + i * 4)
+                         for i in range(writes)]
+        offset += writes * MEMORY_WRITE.size
+        # The interrupt queue after the instruction, None if unchanged
+        record.interrupts = None
+        if record.flags & INTERRUPTS:
+            count, = QUEUE_LENGTH.unpack_from(data, offset)
+            offset += QUEUE_LENGTH.size
+            interrupts = array('H')
+            interrupts.fromstring(data[offset:offset + count * 2])
+            record.interrupts = list(interrupts)
+            offset += count * 2
+        record.index = index
+        index += 1
+        yield record
+
+
+class Trace(object):
+    """ Reads a trace from data, a string or an mmap, and rebuilds the
+    state of the machine before any instruction it recorded.
+    """
+    def __init__(self, data):
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError('Not a trace')
+        self.data = data
+        self.end = len(data)
+        if data[-len(END):] == END:
+            start, magic = FOOTER.unpack(data[-FOOTER.size:])
+            kind, count = INDEX.unpack_from(data, start)
+            self.keyframes = [
+                INDEX_ENTRY.unpack_from(data, start + INDEX.size +
+                                        i * INDEX_ENTRY.size)
+                for i in range(count)]
+            self.end = start
+        else:
+            self.keyframes = []
+            offset = len(MAGIC)
+            while offset < self.end:
+                kind, index, length = KEYFRAME.unpack_from(data, offset)
+                self.keyframes.append((index, offset))
+                offset += KEYFRAME.size + length
+                kind, index, count, length = SEGMENT.unpack_from(data,
+                                                                 offset)
+                offset += SEGMENT.size + length
+        if not self.keyframes:
+            raise ValueError('Trace has no keyframe')
+        self.positions = [index for index, offset in self.keyframes]
+
+    def segment(self, offset):
+        """ Returns the (Snapshot, first index, records data) at offset """
+        data = self.data
+        kind, index, length = KEYFRAME.unpack_from(data, offset)
+        offset += KEYFRAME.size
+        snapshot = Snapshot.loads(data[offset:offset + length])
+        offset += length
+        kind, first, count, length = SEGMENT.unpack_from(data, offset)
+        offset += SEGMENT.size
+        return (snapshot, first,
+                zlib.decompress(data[offset:offset + length]))
+
+    def keyframe(self, index):
+        """ Returns (index, offset) of the last keyframe up to index """
+        position = bisect_right(self.positions, index) - 1
+        if position < 0:
+            raise IndexError('Instruction %d is before the trace' % index)
+        return self.keyframes[position]
+
+    def records(self, start=0):
+        """ Yields the Records from instruction start on """
+        first = self.keyframe(start)[0]
+        for index, offset in self.keyframes:
+            if index >= first:
+                snapshot, index, data = self.segment(offset)
+                for record in segment_records(data, index):
+                    if record.index >= start:
+                        yield record
+
+    def state(self, index):
+        """ Returns an ArrayCPU in the state before instruction index, or
+        after the last one recorded if index is past it.
+        """
+        first, offset = self.keyframe(index)
+        snapshot, first, data = self.segment(offset)
+        cpu = ArrayCPU()
+        cpu.restore(snapshot)
+        last = None
+        interrupts = None
+        for record in segment_records(data, first):
+            if record.index >= index:
+                break
+            for address, value in record.memory:
+                cpu.memory[address] = value
+            cpu.cycles += record.cycles
+            if record.interrupts is not None:
+                interrupts = record.interrupts
+            last = record
+        if interrupts is not None:
+            queue = cpu.bus.interrupts
+            queue.clear()
+            for message in interrupts:
+                queue.push(message)
+            if queue:
+                cpu.bus.wake()
+        if last is not None:
+            cpu.regfile[:] = last.regfile
+            cpu.IA.value = last.IA
+            cpu.skip_instruction = bool(last.flags & SKIP)
+            cpu.queueing = bool(last.flags & QUEUEING)
+            cpu.instructions += last.index + 1 - first
+        return cpu
+
+
+if __name__ == '__main__':
+    optparser = optparse.OptionParser(
+        usage='%prog [options] trace [instruction]')
+    optparser.add_option('-n', '--records', dest="records", type="int",
+                         default=0,
+                         help="Also list this many records from instruction")
+    (options, args) = optparser.parse_args(sys.argv[1:])
+    if not 1 <= len(args) <= 2:
+        optparser.print_help()
+        exit(1)
+
+    trace = Trace(open(args[0], 'rb').read())
+    index = int(args[1], 0) if len(args) > 1 else 0
+    cpu = trace.state(index)
+    print 'Before instruction %d, after %d cycles' % (index, cpu.cycles)
+    print ', '.join('%s: 0x%04x' % (name, value) for name, value in
+                    zip(REGFILE_NAMES + ['IA'],
+                        list(cpu.regfile) + [cpu.IA.value]))
+    for record, i in zip(trace.records(index), range(options.records)):
+        print '%8d 0x%04x: 0x%04x %s %s' % (
+            record.index, record.pc, record.instruction,
+            ' '.join('%s=0x%04x' % (name, value) for name, value in
+                     zip(REGFILE_NAMES, record.regfile)),
+            ' '.join('[0x%04x]=0x%04x' % write for write in record.memory))
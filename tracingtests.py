@@ -0,0 +1,98 @@
+import random
+import unittest
+from StringIO import StringIO
+
+from cpu import ArrayCPU
+from constants import REG, OPCODE
+from display import LEM1802, ImageRenderer
+from emulator import Emulator
+from tracing import Tracer, Trace
+from utils import pack_instruction, pack_special_instruction, Value
+
+# IAS 12 ; :loop ADD A, 1 ; STI [J], A ; SET PUSH, A ; SET [B+3], POP ;
+# INT 5 ; JSR sub ; SET PC, loop ; 0 ; :sub SET [0x9000], A ;
+# ... :handler HWI 0 ; RFI 0
+PROGRAM = [
+    pack_special_instruction(OPCODE.IAS, Value.literal(14)),
+    pack_instruction(OPCODE.ADD, Value.reg(REG.A), Value.literal(1)),
+    pack_instruction(OPCODE.STI, Value.addr_reg(REG.J), Value.reg(REG.A)),
+    pack_instruction(OPCODE.SET, Value.push_pop(), Value.reg(REG.A)),
+    pack_instruction(OPCODE.SET, Value.addr_reg_next_word(REG.B),
+                     Value.push_pop()), 3,
+    pack_special_instruction(OPCODE.INT, Value.literal(5)),
+    pack_special_instruction(OPCODE.JSR, Value.literal(10)),
+    pack_instruction(OPCODE.SET, Value.pc(), Value.literal(1)),
+    0,
+    pack_instruction(OPCODE.SET, Value.next_word_addr(), Value.reg(REG.A)),
+    0x9000,
+    pack_instruction(OPCODE.SET, Value.pc(), Value.push_pop()),
+    0,
+    pack_special_instruction(OPCODE.HWI, Value.literal(0)),
+    pack_special_instruction(OPCODE.RFI, Value.literal(0)),
+]
+
+class TestTracing(unittest.TestCase):
+
+    def machine(self):
+        cpu = ArrayCPU()
+        cpu.load(PROGRAM)
+        cpu.registers[REG.B].value = 0x4000
+        cpu.registers[REG.J].value = 0x5000
+        cpu.bus.attach(LEM1802(ImageRenderer()))
+        return cpu, Emulator(cpu)
+
+    def assertSameState(self, cpu, expected):
+        self.assertEqual(list(cpu.regfile), list(expected.regfile))
+        self.assertEqual(cpu.IA.value, expected.IA.value)
+        self.assertEqual(cpu.cycles, expected.cycles)
+        self.assertEqual(cpu.instructions, expected.instructions)
+        self.assertEqual(cpu.skip_instruction, expected.skip_instruction)
+        self.assertEqual(cpu.queueing, expected.queueing)
+        self.assertEqual(cpu.bus.interrupts.pending(),
+                         expected.bus.interrupts.pending())
+        self.assertTrue(cpu.ram_image() == expected.ram_image(),
+                        'Memory differs')
+
+    def test_replay(self):
+        cpu, emulator = self.machine()
+        out = StringIO()
+        tracer = Tracer(emulator, out, keyframe_interval=50)
+        tracer.start()
+        # The interrupt handler's HWI dumps the palette at B
+        cpu.registers[REG.A].value = 5
+        emulator.run(500)
+        tracer.stop()
+        trace = Trace(out.getvalue())
+        self.assertEqual([index for index, offset in trace.keyframes],
+                         range(0, 500, 50))
+
+        rand = random.Random(1)
+        for index in [0, 1, 49, 50, 51, 499, 500] + rand.sample(range(500),
+                                                                20):
+            expected, expected_emulator = self.machine()
+            expected.registers[REG.A].value = 5
+            expected_emulator.run(index)
+            self.assertSameState(trace.state(index), expected)
+
+        # INT 5 is queued behind the handler it runs in
+        self.assertEqual(trace.state(6).bus.interrupts.pending(), [5])
+
+        records = list(trace.records(498))
+        self.assertEqual([record.index for record in records], [498, 499])
+
+    def test_ring(self):
+        cpu, emulator = self.machine()
+        tracer = Tracer(emulator, keyframe_interval=20, segments=2)
+        tracer.start()
+        emulator.run(110)
+        tracer.stop()
+        trace = Trace(tracer.data())
+        self.assertEqual([index for index, offset in trace.keyframes],
+                         [80, 100])
+        self.assertRaises(IndexError, trace.state, 79)
+        expected, expected_emulator = self.machine()
+        expected_emulator.run(105)
+        self.assertSameState(trace.state(105), expected)
+
+if __name__ == '__main__':
+    unittest.main()
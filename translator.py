@@ -0,0 +1,420 @@
+from ctypes import c_uint16
+
+from cpu import PAGE_SHIFT, RAM_WORDS, REGFILE_SP, REGFILE_PC, REGFILE_EX
+from constants import OPCODE, BASIC_CYCLES, VALUE_CYCLES
+from emulator import Emulator
+from values import Literal, LITERALS
+from utils import unpack_instruction
+
+MAX_BLOCK_INSTRUCTIONS = 32
+
+# Opcodes ending a basic block, the following instruction may be skipped
+BRANCHES = (OPCODE.IFB, OPCODE.IFC, OPCODE.IFE, OPCODE.IFN,
+            OPCODE.IFG, OPCODE.IFA, OPCODE.IFL, OPCODE.IFU)
+
+# Generated code for opcodes translated inline, given the BlockWriter and
+# the locations of the operands.
+INLINE = {
+    OPCODE.SET: lambda w, b, a: [b.store(a.read())],
+    OPCODE.ADD: lambda w, b, a: [
+        'r = %s + %s' % (a.read(), b.read()),
+        w.store(REGFILE_EX, '0xffff if r > 0xffff else 0'),
+        b.store('r & 0xffff')],
+    OPCODE.SUB: lambda w, b, a: [
+        'r = %s - %s' % (b.read(), a.read()),
+        w.store(REGFILE_EX, '0xffff if r < 0 else 0'),
+        b.store('-r if r < 0 else r')],
+    OPCODE.AND: lambda w, b, a: [b.store('%s & %s' % (b.read(), a.read()))],
+    OPCODE.BOR: lambda w, b, a: [b.store('%s | %s' % (b.read(), a.read()))],
+    OPCODE.XOR: lambda w, b, a: [b.store('%s ^ %s' % (b.read(), a.read()))],
+    OPCODE.IFB: lambda w, b, a: [
+        'cpu.skip_instruction = (%s & %s) == 0' % (a.read(), b.read())],
+    OPCODE.IFC: lambda w, b, a: [
+        'cpu.skip_instruction = (%s & %s) != 0' % (a.read(), b.read())],
+    OPCODE.IFE: lambda w, b, a: [
+        'cpu.skip_instruction = %s != %s' % (a.read(), b.read())],
+    OPCODE.IFN: lambda w, b, a: [
+        'cpu.skip_instruction = %s == %s' % (a.read(), b.read())],
+    OPCODE.IFG: lambda w, b, a: [
+        'cpu.skip_instruction = %s <= %s' % (b.read(), a.read())],
+    OPCODE.IFL: lambda w, b, a: [
+        'cpu.skip_instruction = %s >= %s' % (b.read(), a.read())],
+}
+
+
+class Block(object):
+    """ A translated run of instructions in ram[start:end].
+
+    words holds the raw bytes of the translated code, to check the
+    block against ram before running it. cycles is the most cycles
+    running the block can take.
+    """
+    __slots__ = ('start', 'end', 'words', 'count', 'cycles', 'run',
+                 'source')
+
+    def __init__(self, start, end, words, count, cycles, run, source):
+        self.start = start
+        self.end = end
+        self.words = words
+        self.count = count
+        self.cycles = cycles
+        self.run = run
+        self.source = source
+
+
+class TranslatingEmulator(Emulator):
+    """ Emulator compiling basic blocks to Python functions.
+
+    A block starts at a PC and ends after a branch (IF*), a write to PC
+    or before anything that can't be translated (special opcodes, an
+    instruction that's being skipped). Each block becomes one generated
+    function working directly on the ArrayCPU buffers, which is cached
+    and validated against ram whenever it's entered. Anything else runs
+    through Emulator.dispatch, as does everything on a CPU that isn't
+    backed by flat buffers.
+    """
+    def __init__(self, cpu):
+        Emulator.__init__(self, cpu)
+        self.regfile = getattr(cpu, 'regfile', None)
+        if self.regfile is not None:
+            self.code = buffer(cpu.memory)
+            # Blocks write ram through a plain view and mark the dirty
+            # pages themselves, which is cheaper than cpu.memory does
+            self.words = (c_uint16 * RAM_WORDS).from_buffer(cpu.memory)
+        # start pc -> Block, for whole blocks and single instructions
+        self.blocks = {}
+        self.single_blocks = {}
+
+    def run(self, count):
+        """ Executes count instructions from PC """
+        if self.regfile is None:
+            for i in range(count):
+                Emulator.dispatch(self)
+            return
+        cpu, regfile, code, blocks, bus = (self.cpu, self.regfile, self.code,
+                                           self.blocks, self.bus)
+        executed = 0
+        # Chain cached blocks while a whole block fits in the budget
+        while count - executed >= MAX_BLOCK_INSTRUCTIONS:
+            if cpu.cycles >= bus.next_tick:
+                self.service()
+            pc = regfile[REGFILE_PC]
+            block = blocks.get(pc)
+            if (block is None or block.run is None or cpu.skip_instruction
+                    or block.words != code[pc << 1:block.end << 1]):
+                executed += self.step()
+            else:
+                executed += block.run()
+        while executed < count:
+            executed += self.step(count - executed)
+
+    def run_cycles(self, cycles, limit=None):
+        """ Executes instructions until at least cycles cycles passed.
+
+        Stops early after limit instructions.
+        """
+        if self.regfile is None:
+            Emulator.run_cycles(self, cycles, limit)
+            return
+        cpu, bus = self.cpu, self.bus
+        end = cpu.cycles + cycles
+        last = None if limit is None else cpu.instructions + limit
+        while cpu.cycles < end:
+            if cpu.cycles >= bus.next_tick:
+                self.service()
+            if last is not None:
+                budget = last - cpu.instructions
+                if budget <= 0:
+                    break
+                if budget < MAX_BLOCK_INSTRUCTIONS:
+                    self.step(1)
+                    continue
+            if cpu.skip_instruction:
+                Emulator.dispatch(self)
+                continue
+            block = self.block_at(self.blocks, self.regfile[REGFILE_PC],
+                                  MAX_BLOCK_INSTRUCTIONS)
+            if block.run is None:
+                Emulator.dispatch(self)
+            elif cpu.cycles + block.cycles <= end:
+                block.run()
+            else:
+                self.step(1)
+
+    def dispatch(self):
+        """ Execute instruction at [PC] """
+        self.step(1)
+
+    def step(self, budget=MAX_BLOCK_INSTRUCTIONS):
+        """ Executes at most budget instructions from PC.
+
+        Returns the number of instructions executed.
+        """
+        if self.regfile is None or self.cpu.skip_instruction:
+            Emulator.dispatch(self)
+            return 1
+        if self.cpu.cycles >= self.bus.next_tick:
+            self.service()
+        pc = self.regfile[REGFILE_PC]
+        if budget >= MAX_BLOCK_INSTRUCTIONS:
+            block = self.block_at(self.blocks, pc, MAX_BLOCK_INSTRUCTIONS)
+        else:
+            block = None
+        if block is None or block.count > budget:
+            block = self.block_at(self.single_blocks, pc, 1)
+        if block.run is None:
+            Emulator.dispatch(self)
+            return 1
+        return block.run()
+
+    def block_at(self, cache, pc, max_instructions):
+        block = cache.get(pc)
+        if block is None or block.words != self.code[pc << 1:block.end << 1]:
+            block = cache[pc] = self.translate(pc, max_instructions)
+        return block
+
+    def translate(self, start, max_instructions):
+        """ Returns a Block for the code at start """
+        memory = self.cpu.memory
+        instructions = []
+        pc = start
+        while len(instructions) < max_instructions:
+            instruction = memory[pc]
+            op_code, b_val, a_val = unpack_instruction(instruction)
+            if op_code not in self.BASIC_INSTRUCTIONS:
+                break
+            length = 1 + operand_words(b_val) + operand_words(a_val)
+            if pc + length > 0x10000:
+                break
+            instructions.append((pc, op_code, b_val, a_val))
+            pc += length
+            if op_code in BRANCHES or b_val == 0x1c:
+                break
+        if not instructions:
+            end = start + 1
+            return Block(start, end, self.code[start << 1:end << 1], 0, 0,
+                         None, None)
+
+        source, cycles = self.generate(instructions, start, pc)
+        namespace = {
+            'rf': self.regfile,
+            'mem': self.words,
+            'dirty': self.cpu.dirty,
+            'cpu': self.cpu,
+            'ram': self.cpu.ram,
+            'registers': self.cpu.registers,
+            'Literal': Literal,
+            'LITERALS': LITERALS,
+        }
+        for op_code in set(i[1] for i in instructions):
+            namespace['op_%d' % op_code] = self.BASIC_INSTRUCTIONS[op_code]
+        exec(compile(source, '<block 0x%04x>' % start, 'exec'), namespace)
+        return Block(start, pc, self.code[start << 1:pc << 1],
+                     len(instructions), cycles, namespace['block'], source)
+
+    def generate(self, instructions, start, end):
+        """ Returns (source, most cycles) of a block running instructions """
+        writer = BlockWriter()
+        count = 0
+        cycles = 0
+        for pc, op_code, b_val, a_val in instructions:
+            count += 1
+            cycles += (BASIC_CYCLES[op_code] + VALUE_CYCLES[b_val] +
+                       VALUE_CYCLES[a_val])
+            after = pc + 1 + operand_words(b_val) + operand_words(a_val)
+            writer.emit('# 0x%04x' % pc)
+            if 0x1c in (b_val, a_val):
+                writer.assign(REGFILE_PC, str(after & 0xffff))
+            b, next_pc = operand(writer, 'b', b_val, False, pc + 1)
+            a, next_pc = operand(writer, 'a', a_val, True, next_pc)
+
+            if op_code in INLINE:
+                for line in INLINE[op_code](writer, b, a):
+                    writer.emit(line)
+            else:
+                # Handlers work on cells, which see the register file
+                writer.sync()
+                writer.emit('op_%d(%s, %s)' % (op_code, b.cell(), a.cell()))
+                writer.forget()
+
+            if (b.address is None or op_code in BRANCHES or
+                    count == len(instructions)):
+                continue
+            # Writing to the block itself, leave before running stale code
+            bail = ('%s; cpu.cycles += %d; cpu.instructions += %d; '
+                    'return %d' % (writer.flush(after), cycles, count, count))
+            if b.address.isdigit():
+                if start <= int(b.address) < end:
+                    writer.emit(bail)
+            else:
+                writer.emit('if %d <= %s < %d: %s'
+                            % (start, b.address, end, bail))
+
+        if b_val == 0x1c:
+            writer.emit(writer.flush())
+        else:
+            writer.emit(writer.flush(end & 0xffff))
+        if op_code in BRANCHES:
+            # A branch failing takes a cycle more
+            cycles += 1
+            writer.emit('cpu.cycles += %d if cpu.skip_instruction else %d'
+                        % (cycles, cycles - 1))
+        else:
+            writer.emit('cpu.cycles += %d' % cycles)
+        writer.emit('cpu.instructions += %d' % count)
+        writer.emit('return %d' % count)
+        return writer.source(), cycles
+
+
+class BlockWriter(object):
+    """ Collects the source of a block function.
+
+    Register file entries are kept in locals (r0 to r10) from their
+    first use and only written back to rf when the block exits or calls
+    an opcode handler.
+    """
+    def __init__(self):
+        self.lines = []
+        self.loaded = set()
+        self.dirty = set()
+
+    def emit(self, line):
+        self.lines.append('    ' + line)
+
+    def register(self, index):
+        """ Returns the local holding the register file entry index """
+        if index not in self.loaded:
+            self.emit('r%d = rf[%d]' % (index, index))
+            self.loaded.add(index)
+        return 'r%d' % index
+
+    def assign(self, index, expr):
+        self.emit(self.store(index, expr))
+
+    def store(self, index, expr):
+        """ Returns a statement writing the register file entry index """
+        self.loaded.add(index)
+        self.dirty.add(index)
+        return 'r%d = %s' % (index, expr)
+
+    def flush(self, pc=None):
+        """ Returns a statement writing back modified registers """
+        writes = ['rf[%d] = r%d' % (index, index)
+                  for index in sorted(self.dirty) if index != REGFILE_PC]
+        if pc is not None:
+            writes.append('rf[%d] = %d' % (REGFILE_PC, pc))
+        elif REGFILE_PC in self.dirty:
+            writes.append('rf[%d] = r%d' % (REGFILE_PC, REGFILE_PC))
+        return '; '.join(writes) or 'pass'
+
+    def sync(self):
+        if self.dirty:
+            self.emit(self.flush())
+            self.dirty.clear()
+
+    def forget(self):
+        self.loaded.clear()
+
+    def source(self):
+        # Bound as defaults so the block reads them as fast locals
+        return '\n'.join(['def block(rf=rf, mem=mem, dirty=dirty, cpu=cpu, '
+                          'ram=ram, registers=registers, Literal=Literal, '
+                          'LITERALS=LITERALS):'] +
+                         self.lines) + '\n'
+
+
+class RegisterLocation(object):
+    """ Operand in the register file """
+    def __init__(self, writer, index, cell):
+        self.writer = writer
+        self.index = index
+        self.address = None
+        self.cell = lambda: cell
+
+    def read(self):
+        return self.writer.register(self.index)
+
+    def store(self, expr):
+        return self.writer.store(self.index, expr)
+
+
+class MemoryLocation(object):
+    """ Operand in ram, address is a constant or a local """
+    def __init__(self, address):
+        self.address = address
+
+    def read(self):
+        return 'mem[%s]' % self.address
+
+    def store(self, expr):
+        return 'mem[%s] = %s; dirty[%s >> %d] = 1' % (
+            self.address, expr, self.address, PAGE_SHIFT)
+
+    def cell(self):
+        return 'ram[%s]' % self.address
+
+
+class LiteralLocation(object):
+    """ Short literal, writes are ignored """
+    def __init__(self, value, as_a):
+        self.value = value
+        self.as_a = as_a
+        self.address = None
+
+    def read(self):
+        return str(self.value)
+
+    def store(self, expr):
+        return 'pass'
+
+    def cell(self):
+        if self.as_a:
+            return 'LITERALS[%d]' % self.value
+        return 'Literal(%d)' % self.value
+
+
+def operand_words(val):
+    """ Number of next words used by the value val """
+    if 0x10 <= val <= 0x17 or val in (0x1a, 0x1e, 0x1f):
+        return 1
+    return 0
+
+
+def operand(writer, name, val, as_a, pc):
+    """ Emits code resolving val, returns (location, pc after operand) """
+    if 0x0 <= val <= 0x7:
+        return RegisterLocation(writer, val, 'registers[%d]' % val), pc
+    if 0x8 <= val <= 0xf:
+        writer.emit('%s = %s' % (name, writer.register(val - 0x8)))
+        return MemoryLocation(name), pc
+    if 0x10 <= val <= 0x17:
+        writer.emit('%s = (%s + mem[%d]) & 0xffff'
+                    % (name, writer.register(val - 0x10), pc))
+        return MemoryLocation(name), pc + 1
+    if val == 0x18:
+        sp = writer.register(REGFILE_SP)
+        if as_a: #POP
+            writer.emit('%s = %s' % (name, sp))
+            writer.assign(REGFILE_SP, '(%s + 1) & 0xffff' % name)
+        else: #PUSH
+            writer.assign(REGFILE_SP, '%s = (%s - 1) & 0xffff' % (name, sp))
+        return MemoryLocation(name), pc
+    if val == 0x19:
+        writer.emit('%s = %s' % (name, writer.register(REGFILE_SP)))
+        return MemoryLocation(name), pc
+    if val == 0x1a:
+        writer.emit('%s = (%s + mem[%d]) & 0xffff'
+                    % (name, writer.register(REGFILE_SP), pc))
+        return MemoryLocation(name), pc + 1
+    if val == 0x1b:
+        return RegisterLocation(writer, REGFILE_SP, 'cpu.SP'), pc
+    if val == 0x1c:
+        return RegisterLocation(writer, REGFILE_PC, 'cpu.PC'), pc
+    if val == 0x1d:
+        return RegisterLocation(writer, REGFILE_EX, 'cpu.EX'), pc
+    if val == 0x1e:
+        writer.emit('%s = mem[%d]' % (name, pc))
+        return MemoryLocation(name), pc + 1
+    if val == 0x1f:
+        return MemoryLocation(str(pc)), pc + 1
+    return LiteralLocation(val - 0x20, as_a), pc
@@ -0,0 +1,127 @@
+import random
+import unittest
+
+from cpu import ArrayCPU
+from emulator import Emulator, EmulatorError
+from translator import TranslatingEmulator
+from constants import REG, OPCODE
+from utils import pack_instruction, pack_special_instruction, Value
+
+FUZZ_OPCODES = (OPCODE.SET, OPCODE.ADD, OPCODE.SUB, OPCODE.MUL, OPCODE.AND,
+                OPCODE.BOR, OPCODE.XOR, OPCODE.SHR, OPCODE.IFB, OPCODE.IFC,
+                OPCODE.IFE, OPCODE.IFN, OPCODE.IFG, OPCODE.IFA, OPCODE.IFL,
+                OPCODE.IFU, OPCODE.STI, OPCODE.STD, OPCODE.DIV,
+                OPCODE.DVI, OPCODE.MOD, OPCODE.MDI)
+
+class TestTranslator(unittest.TestCase):
+
+    def run_both(self, program, steps):
+        """ Runs program on the interpreter and the translator.
+
+        Stops before the first instruction raising in the interpreter.
+        """
+        cpu = ArrayCPU()
+        cpu.load(program)
+        emulator = Emulator(cpu)
+        for i in range(steps):
+            try:
+                emulator.dispatch()
+            except EmulatorError:
+                steps = i
+                break
+
+        cpus = []
+        for emulator_class in (Emulator, TranslatingEmulator):
+            cpu = ArrayCPU()
+            cpu.load(program)
+            emulator = emulator_class(cpu)
+            if emulator_class is Emulator:
+                for i in range(steps):
+                    emulator.dispatch()
+            else:
+                executed = 0
+                while executed < steps:
+                    executed += emulator.step(steps - executed)
+            cpus.append(cpu)
+        return cpus
+
+    def assertSameState(self, interpreted, translated):
+        self.assertEqual(list(interpreted.regfile), list(translated.regfile))
+        self.assertEqual(interpreted.skip_instruction,
+                         translated.skip_instruction)
+        self.assertEqual(interpreted.cycles, translated.cycles)
+        self.assertEqual(interpreted.instructions, translated.instructions)
+        self.assertTrue(list(interpreted.memory) == list(translated.memory),
+                        "Memory differs")
+
+    def test_loop(self):
+        program = [
+            # SET I, 10
+            pack_instruction(OPCODE.SET, Value.reg(REG.I), Value.literal(10)),
+            # :loop SET [0x2000+I], I
+            pack_instruction(OPCODE.SET, Value.addr_reg_next_word(REG.I),
+                             Value.reg(REG.I)), 0x2000,
+            # SET PUSH, I
+            pack_instruction(OPCODE.SET, Value.push_pop(), Value.reg(REG.I)),
+            # SUB I, 1
+            pack_instruction(OPCODE.SUB, Value.reg(REG.I), Value.literal(1)),
+            # IFN I, 0
+            pack_instruction(OPCODE.IFN, Value.reg(REG.I), Value.literal(0)),
+            # SET PC, loop
+            pack_instruction(OPCODE.SET, Value.pc(), Value.literal(1)),
+            # JSR 0x10
+            pack_special_instruction(OPCODE.JSR, Value.literal(0x10)),
+        ]
+        interpreted, translated = self.run_both(program, 52)
+        self.assertSameState(interpreted, translated)
+        self.assertEqual(translated.memory[0x2005], 5)
+        self.assertEqual(translated.registers[REG.I].value, 0)
+        self.assertEqual(translated.PC.value, 0x10)
+
+    def test_self_modifying(self):
+        # Overwrites the ADD below with a SUB, in the same block
+        sub = pack_instruction(OPCODE.SUB, Value.reg(REG.A), Value.literal(1))
+        program = [
+            pack_instruction(OPCODE.SET, Value.next_word_addr(),
+                             Value.next_word_literal()), 3, sub,
+            pack_instruction(OPCODE.ADD, Value.reg(REG.A), Value.literal(2)),
+        ]
+        interpreted, translated = self.run_both(program, 2)
+        self.assertSameState(interpreted, translated)
+        self.assertEqual(translated.EX.value, 0xffff)
+
+    def test_divide_by_zero(self):
+        program = [
+            # SET EX, 7
+            pack_instruction(OPCODE.SET, Value.ex(), Value.literal(7)),
+            # DIV A, B
+            pack_instruction(OPCODE.DIV, Value.reg(REG.A), Value.reg(REG.B)),
+            # SET X, EX
+            pack_instruction(OPCODE.SET, Value.reg(REG.X), Value.ex()),
+            # MOD [0x1000], B
+            pack_instruction(OPCODE.MOD, Value.next_word_addr(),
+                             Value.reg(REG.B)), 0x1000,
+            # MDI I, 0
+            pack_instruction(OPCODE.MDI, Value.reg(REG.I), Value.literal(0)),
+            # DVI J, 0
+            pack_instruction(OPCODE.DVI, Value.reg(REG.J), Value.literal(0)),
+        ]
+        program += [0] * (0x1000 - len(program)) + [5]
+        interpreted, translated = self.run_both(program, 6)
+        self.assertSameState(interpreted, translated)
+        self.assertEqual(translated.instructions, 6)
+        self.assertEqual(translated.registers[REG.X].value, 0)
+        self.assertEqual(translated.memory[0x1000], 0)
+
+    def test_fuzz(self):
+        rand = random.Random(1)
+        for i in range(50):
+            program = [pack_instruction(rand.choice(FUZZ_OPCODES),
+                                        rand.randint(0, 0x1f),
+                                        rand.randint(0, 0x3f))
+                       for j in range(128)]
+            interpreted, translated = self.run_both(program, 300)
+            self.assertSameState(interpreted, translated)
+
+if __name__ == '__main__':
+    unittest.main()
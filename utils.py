@@ -1,3 +1,25 @@
+import mmap
+import os
+
+def load_program(cpu, filename, offset=0):
+    """ Maps a binary or ram image and copies it into cpu's ram """
+    f = open(filename, 'rb')
+    try:
+        if not os.fstat(f.fileno()).st_size:
+            return
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    try:
+        cpu.load_binary(data, offset)
+    finally:
+        data.close()
+
+def save_image(cpu, filename):
+    """ Writes cpu's ram to filename, for loading with load_program """
+    f = open(filename, 'wb')
+    f.write(cpu.dump_binary())
+    f.close()
 
 def pack_instruction(op_code, a, b):
     return op_code | (a << 5) | (b << 10)
@@ -1,69 +1,139 @@
+from weakref import WeakKeyDictionary
+
 from constants import REG
 
 class Literal(object):
     def __init__(self, value):
         self.value = value
 
+# Short literals read as a. a is never written so these can be shared.
+LITERALS = [Literal(val) for val in range(0x20)]
+
+
+# cpu -> its (b, a) operand tables, built on the first value_lookup
+TABLES = WeakKeyDictionary()
+
 
 def value_lookup(cpu, val, as_a):
-    # register value
-    if 0x0 <= val <= 0x7:
-        return cpu.registers[val]
-
-    # RAM at address of register value
-    if 0x8 <= val <= 0xf:
-        return cpu.ram[cpu.registers[val - 0x8].value]
-
-    # RAM at address of register value + next word
-    if 0x10 <= val <= 0x17:
-        value = cpu.ram[cpu.registers[val - 0x10].value +
-                        cpu.ram[cpu.PC.value].value]
-        cpu.PC.value += 1
-        return value
-
-    # Stack push/pop depending on if it's first or second value
-    if val == 0x18:
-        if as_a: #POP
-            value = cpu.ram[cpu.SP.value]
-            cpu.SP.value += 1
-            return value
-        else: #PUSH
-            cpu.SP.value -= 1
-            return cpu.ram[cpu.SP.value]
-
-    if val == 0x19:
-        return cpu.ram[cpu.SP.value]
-
-    # Ram at address of stack value + next word
-    if val == 0x1a:
-        value =  cpu.ram[cpu.SP.value + cpu.ram[cpu.PC.value].value]
-        cpu.PC.value += 1
-        return value
-
-    # SP
-    if val == 0x1b:
-        return cpu.SP
-
-    # PC
-    if val == 0x1c:
-        return cpu.PC
-
-    # EX
-    if val == 0x1d:
-        return cpu.PC
-
-    # Ram at address of next word
-    if val == 0x1e:
-        value = cpu.ram[cpu.ram[cpu.PC.value].value]
-        cpu.PC.value += 1
-        return value
-
-    # Next word as literal
-    if val == 0x1f:
-        val = cpu.ram[cpu.PC.value]
-        cpu.PC.value += 1
-        return val
-
-    # Literal value
-    if 0x20 <= val <= 0x3f:
-        return Literal(val - 0x20)
+    tables = TABLES.get(cpu)
+    if tables is None:
+        tables = TABLES[cpu] = (operand_table(cpu, as_a=False),
+                                operand_table(cpu, as_a=True))
+    return tables[as_a][val]()
+
+
+def operand_table(cpu, as_a):
+    """ Returns a list of 64 accessors, one per value, bound to cpu.
+
+    Calling entry val resolves val just like value_lookup, but all the
+    work of picking the addressing mode and looking up cells on the cpu
+    is already done.
+    """
+    operands = A_OPERANDS if as_a else B_OPERANDS
+    return [make_accessor(cpu) for make_accessor in operands]
+
+
+def next_word_reader(cpu):
+    PC, memory = cpu.PC, cpu.memory
+    def next_word():
+        pc = PC.value
+        PC.value = pc + 1
+        return memory[pc]
+    return next_word
+
+# Each of the functions below returns a function creating the accessor
+# of one value for a cpu.
+
+def register(reg):
+    def make_accessor(cpu):
+        cell = cpu.registers[reg]
+        return lambda: cell
+    return make_accessor
+
+def cpu_cell(name):
+    """ SP, PC or EX """
+    def make_accessor(cpu):
+        cell = getattr(cpu, name)
+        return lambda: cell
+    return make_accessor
+
+def addr_register(reg):
+    """ RAM at address of register value """
+    def make_accessor(cpu):
+        cell, ram = cpu.registers[reg], cpu.ram
+        return lambda: ram[cell.value]
+    return make_accessor
+
+def addr_register_next_word(reg):
+    """ RAM at address of register value + next word """
+    def make_accessor(cpu):
+        cell, ram = cpu.registers[reg], cpu.ram
+        next_word = next_word_reader(cpu)
+        return lambda: ram[cell.value + next_word()]
+    return make_accessor
+
+def pop(cpu):
+    SP, ram = cpu.SP, cpu.ram
+    def accessor():
+        sp = SP.value
+        SP.value = sp + 1
+        return ram[sp]
+    return accessor
+
+def push(cpu):
+    SP, ram = cpu.SP, cpu.ram
+    def accessor():
+        SP.value -= 1
+        return ram[SP.value]
+    return accessor
+
+def peek(cpu):
+    SP, ram = cpu.SP, cpu.ram
+    return lambda: ram[SP.value]
+
+def pick(cpu):
+    """ RAM at address of stack value + next word """
+    SP, ram, next_word = cpu.SP, cpu.ram, next_word_reader(cpu)
+    return lambda: ram[SP.value + next_word()]
+
+def next_word_addr(cpu):
+    """ RAM at address of next word """
+    ram, next_word = cpu.ram, next_word_reader(cpu)
+    return lambda: ram[next_word()]
+
+def next_word_literal(cpu):
+    """ Next word as literal, the cell in RAM holding it """
+    PC, ram = cpu.PC, cpu.ram
+    def accessor():
+        pc = PC.value
+        PC.value = pc + 1
+        return ram[pc]
+    return accessor
+
+def shared_literal(val):
+    literal = LITERALS[val]
+    return lambda cpu: lambda: literal
+
+def new_literal(val):
+    """ Literal as b, a new one for each use so writes to it are lost """
+    return lambda cpu: lambda: Literal(val)
+
+
+def operands(as_a):
+    return ([register(reg) for reg in range(0x8)] +
+            [addr_register(reg) for reg in range(0x8)] +
+            [addr_register_next_word(reg) for reg in range(0x8)] +
+            [pop if as_a else push,
+             peek,
+             pick,
+             cpu_cell('SP'),
+             cpu_cell('PC'),
+             cpu_cell('EX'),
+             next_word_addr,
+             next_word_literal] +
+            [(shared_literal if as_a else new_literal)(val)
+             for val in range(0x20)])
+
+# Indexed by value, 0x00-0x3f
+A_OPERANDS = operands(as_a=True)
+B_OPERANDS = operands(as_a=False)
@@ -1,16 +1,20 @@
 import random
 import unittest
 
-from cpu import CPU
+from cpu import CPU, ArrayCPU
 from emulator import Emulator
+from translator import TranslatingEmulator
 from constants import REG, OPCODE
 from utils import pack_instruction, Value
+from values import value_lookup, TABLES
 
 class TestValues(unittest.TestCase):
+    cpu_class = CPU
+    emulator_class = Emulator
 
     def setUp(self):
-        self.cpu = CPU()
-        self.emulator = Emulator(self.cpu)
+        self.cpu = self.cpu_class()
+        self.emulator = self.emulator_class(self.cpu)
 
     def test_set_reg_to_literal(self):
         """ Sets a register to a literal """
@@ -161,5 +165,49 @@ class TestValues(unittest.TestCase):
 
         self.assertTrue(self.cpu.registers[REG.A].value == 0x1234, "Next word as literal error")
 
+    def test_set_literal_ignored(self):
+        """ Writing to a literal leaves the literal alone """
+        self.cpu.registers[REG.A].value = 0x7
+
+        # SET 0x5, A
+        self.cpu.ram[0].value = pack_instruction(op_code=OPCODE.SET,
+                                                 a=Value.literal(0x5),
+                                                 b=Value.reg(REG.A))
+        # SET B, 0x5
+        self.cpu.ram[1].value = pack_instruction(op_code=OPCODE.SET,
+                                                 a=Value.reg(REG.B),
+                                                 b=Value.literal(0x5))
+        self.emulator.dispatch()
+        self.emulator.dispatch()
+
+        self.assertEqual(self.cpu.registers[REG.B].value, 0x5, "Literal changed")
+        self.assertEqual(value_lookup(self.cpu, Value.literal(0x5), True).value, 0x5)
+
+    def test_value_lookup(self):
+        """ Looks up values without an emulator """
+        self.cpu.registers[REG.C].value = 0x30
+        self.cpu.ram[0x30].value = 0xcafe
+
+        self.assertEqual(value_lookup(self.cpu, Value.addr_reg(REG.C), True).value, 0xcafe)
+        self.assertTrue(value_lookup(self.cpu, Value.ex(), True) is self.cpu.EX)
+
+    def test_value_lookup_table(self):
+        """ Reuses the accessors built by the first lookup """
+        self.cpu.registers[REG.C].value = 0x30
+        self.cpu.ram[0x31].value = 0xbeef
+        value_lookup(self.cpu, Value.addr_reg(REG.C), True)
+        tables = TABLES[self.cpu]
+        self.cpu.registers[REG.C].value = 0x31
+
+        self.assertEqual(value_lookup(self.cpu, Value.addr_reg(REG.C), True).value, 0xbeef)
+        self.assertTrue(TABLES[self.cpu] is tables)
+
+class TestValuesArrayCPU(TestValues):
+    cpu_class = ArrayCPU
+
+class TestValuesTranslated(TestValues):
+    cpu_class = ArrayCPU
+    emulator_class = TranslatingEmulator
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,463 @@
+""" Runs many DCPU-16 machines in lockstep on NumPy arrays.
+
+Every lane is a whole machine with its own ram and registers, typically
+all running the same program from different initial states. Each step
+executes one instruction on every lane: lanes are grouped by the
+instruction word at their PC and a group runs as a handful of array
+operations, so lanes that branched apart just end up in different
+groups.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from cpu import ArrayCPU, RAM_WORDS, REGFILE_WORDS, REGFILE_SP, REGFILE_PC, \
+    REGFILE_EX
+from constants import OPCODE, REG, BASIC_CYCLES, SPECIAL_CYCLES, VALUE_CYCLES
+from emulator import InvalidOpcode, StackOverflow
+from utils import unpack_instruction, unpack_special_instruction
+
+
+def signed(values):
+    """ The int16 value of each uint16 """
+    return (values ^ 0x8000) - 0x8000
+
+
+class Group(object):
+    """ Lanes executing the same instruction word in a step.
+
+    ok marks the lanes the instruction still acts on, it's cleared for
+    lanes skipping the instruction and lanes that fault halfway.
+    """
+    def __init__(self, emulator, lanes, pc):
+        self.emulator = emulator
+        self.lanes = lanes
+        self.pc = pc
+        self.ok = numpy.ones(len(lanes), bool)
+
+    def register(self, index):
+        return Cell(self, self.emulator.regfile, index)
+
+    def fault(self, mask, error):
+        """ Halts the lanes in mask, error(pc) is what stopped each """
+        mask = mask & self.ok
+        for lane, pc in zip(self.lanes[mask], self.pc[mask]):
+            self.emulator.fault(lane, error(int(pc)))
+        self.ok &= ~mask
+
+    def skip(self, mask):
+        self.emulator.skip[self.lanes[mask & self.ok]] = True
+
+
+class Cell(object):
+    """ The same location on each lane of a group.
+
+    index is a column of array, the same for every lane or one per lane.
+    Like the cells of a CPU, the value is read and written on access,
+    so instructions whose operands alias see their own writes.
+    """
+    def __init__(self, group, array, index):
+        self.group = group
+        self.array = array
+        self.index = index
+
+    @property
+    def value(self):
+        return self.array[self.group.lanes, self.index].astype(numpy.int64)
+
+    @value.setter
+    def value(self, value):
+        ok = self.group.ok
+        value = numpy.asarray(value) & 0xffff
+        if value.ndim:
+            value = value[ok]
+        index = self.index
+        if not isinstance(index, int):
+            index = index[ok]
+        self.array[self.group.lanes[ok], index] = value
+
+
+class LiteralCell(object):
+    """ A literal, writes to it are lost """
+    def __init__(self, group, literal):
+        self.literal = numpy.empty(len(group.lanes), numpy.int64)
+        self.literal.fill(literal)
+
+    @property
+    def value(self):
+        return self.literal
+
+    @value.setter
+    def value(self, value):
+        pass
+
+
+class VectorEmulator(object):
+    """ lanes machines stepping in lockstep.
+
+    regfile holds the registers followed by SP, PC and EX of each lane,
+    laid out like ArrayCPU.regfile, and ram the memory of each lane.
+    registers, SP, PC and EX are views into regfile. A lane that hits
+    an instruction Emulator raises on is halted, its error is kept in
+    faults, while the other lanes go on. Lanes have no hardware and no
+    interrupts, the interrupt opcodes fault as invalid.
+    """
+    def __init__(self, lanes):
+        if numpy is None:
+            raise ImportError('VectorEmulator needs NumPy')
+        self.lanes = lanes
+        self.ram = numpy.zeros((lanes, RAM_WORDS), numpy.uint16)
+        self.regfile = numpy.zeros((lanes, REGFILE_WORDS), numpy.uint16)
+        self.registers = self.regfile[:, :REGFILE_SP]
+        self.SP = self.regfile[:, REGFILE_SP]
+        self.PC = self.regfile[:, REGFILE_PC]
+        self.EX = self.regfile[:, REGFILE_EX]
+        self.SP[:] = 0xffff
+        self.skip = numpy.zeros(lanes, bool)
+        self.cycles = numpy.zeros(lanes, numpy.int64)
+        self.instructions = numpy.zeros(lanes, numpy.int64)
+        self.halted = numpy.zeros(lanes, bool)
+        # lane -> EmulatorError
+        self.faults = {}
+
+        self.BASIC_INSTRUCTIONS = {
+            OPCODE.SET: self.SET,
+            OPCODE.ADD: self.ADD,
+            OPCODE.SUB: self.SUB,
+            OPCODE.MUL: self.MUL,
+            OPCODE.MLI: self.MLI,
+            OPCODE.DIV: self.DIV,
+            OPCODE.DVI: self.DVI,
+            OPCODE.MOD: self.MOD,
+            OPCODE.MDI: self.MDI,
+            OPCODE.AND: self.AND,
+            OPCODE.BOR: self.BOR,
+            OPCODE.XOR: self.XOR,
+            OPCODE.SHR: self.SHR,
+            OPCODE.ASR: self.ASR,
+            OPCODE.SHL: self.SHL,
+
+            OPCODE.IFB: self.IFB,
+            OPCODE.IFC: self.IFC,
+            OPCODE.IFE: self.IFE,
+            OPCODE.IFN: self.IFN,
+            OPCODE.IFG: self.IFG,
+            OPCODE.IFA: self.IFA,
+            OPCODE.IFL: self.IFL,
+            OPCODE.IFU: self.IFU,
+
+            OPCODE.ADX: self.ADX,
+            OPCODE.SBX: self.SBX,
+
+            OPCODE.STI: self.STI,
+            OPCODE.STD: self.STD,
+        }
+
+        self.SPECIAL_INSTRUCTIONS = {
+            OPCODE.JSR: self.JSR,
+            OPCODE.HWN: self.HWN,
+            OPCODE.HWQ: self.HWQ,
+            OPCODE.HWI: self.HWI,
+        }
+
+    def load(self, words, offset=0):
+        """ Copies a sequence of words into the ram of every lane """
+        words = numpy.asarray(words, numpy.uint16)
+        self.ram[:, offset:offset + len(words)] = words
+
+    def set_lane(self, lane, cpu):
+        """ Copies the state of an ArrayCPU into lane """
+        self.ram[lane] = numpy.frombuffer(cpu.memory, numpy.uint16)
+        self.regfile[lane] = numpy.frombuffer(cpu.regfile, numpy.uint16)
+        self.skip[lane] = cpu.skip_instruction
+        self.cycles[lane] = cpu.cycles
+        self.instructions[lane] = cpu.instructions
+        self.halted[lane] = False
+        self.faults.pop(lane, None)
+
+    def lane_cpu(self, lane):
+        """ Returns an ArrayCPU with the state of lane """
+        cpu = ArrayCPU()
+        numpy.frombuffer(cpu.memory, numpy.uint16)[:] = self.ram[lane]
+        numpy.frombuffer(cpu.regfile, numpy.uint16)[:] = self.regfile[lane]
+        cpu.skip_instruction = bool(self.skip[lane])
+        cpu.cycles = int(self.cycles[lane])
+        cpu.instructions = int(self.instructions[lane])
+        return cpu
+
+    def fault(self, lane, error):
+        self.halted[lane] = True
+        self.faults[lane] = error
+
+    def run(self, count):
+        """ Executes count steps, stops early once every lane halted """
+        for i in range(count):
+            if not self.step():
+                break
+
+    def step(self):
+        """ Executes an instruction on every running lane.
+
+        Returns the number of lanes that ran.
+        """
+        lanes = numpy.flatnonzero(~self.halted)
+        if not len(lanes):
+            return 0
+        pcs = self.PC[lanes]
+        words = self.ram[lanes, pcs]
+        self.PC[lanes] = pcs + 1
+        self.instructions[lanes] += 1
+        if len(lanes) > 1:
+            instructions, groups = numpy.unique(words, return_inverse=True)
+        else:
+            instructions, groups = words, numpy.zeros(1, int)
+        for group_index, instruction in enumerate(instructions):
+            members = groups == group_index
+            self.dispatch(int(instruction),
+                          Group(self, lanes[members], pcs[members]))
+        return len(lanes)
+
+    def dispatch(self, instruction, group):
+        """ Executes instruction on the lanes of group """
+        op_code, b_val, a_val = unpack_instruction(instruction)
+        if op_code == 0x00:
+            self.non_basic(instruction, group)
+            return
+        handler = self.BASIC_INSTRUCTIONS.get(op_code)
+        if handler is None:
+            group.fault(group.ok,
+                        lambda pc: InvalidOpcode(instruction, pc))
+            return
+        b = self.operand(group, b_val, as_a=False)
+        a = self.operand(group, a_val, as_a=True)
+        lanes = group.lanes
+        skipping = self.skip[lanes]
+        if skipping.any():
+            # A skipped IF skips the next one too
+            if OPCODE.IFB <= op_code <= OPCODE.IFU:
+                self.cycles[lanes[skipping]] += 1
+            else:
+                self.skip[lanes[skipping]] = False
+            group.ok &= ~skipping
+        handler(group, b, a)
+        ran = lanes[group.ok]
+        self.cycles[ran] += (BASIC_CYCLES[op_code] + VALUE_CYCLES[b_val] +
+                             VALUE_CYCLES[a_val])
+        # A branch failed
+        self.cycles[ran[self.skip[ran]]] += 1
+
+    def non_basic(self, instruction, group):
+        opcode, a_val = unpack_special_instruction(instruction)
+        handler = self.SPECIAL_INSTRUCTIONS.get(opcode)
+        if handler is None:
+            group.fault(group.ok,
+                        lambda pc: InvalidOpcode(instruction, pc))
+            return
+        a = self.operand(group, a_val, as_a=True)
+        lanes = group.lanes
+        skipping = self.skip[lanes]
+        self.skip[lanes[skipping]] = False
+        group.ok &= ~skipping
+        self.cycles[lanes[group.ok]] += (SPECIAL_CYCLES[opcode] +
+                                         VALUE_CYCLES[a_val])
+        handler(group, a)
+
+    def JSR(self, g, a):
+        # Push next address to the stack, an empty stack has SP 0xffff
+        SP = g.register(REGFILE_SP)
+        g.fault(SP.value == 0, StackOverflow)
+        SP.value = SP.value - 1
+        Cell(g, self.ram, self.SP[g.lanes]).value = self.PC[g.lanes]
+        g.register(REGFILE_PC).value = a.value
+
+    def HWN(self, g, a):
+        a.value = 0
+
+    def HWQ(self, g, a):
+        for reg in (REG.A, REG.B, REG.C, REG.X, REG.Y):
+            g.register(reg).value = 0
+
+    def HWI(self, g, a):
+        pass
+
+    def next_word(self, group):
+        lanes = group.lanes
+        pc = self.PC[lanes]
+        self.PC[lanes] = pc + 1
+        return self.ram[lanes, pc]
+
+    def operand(self, group, val, as_a):
+        """ The Cell of value val on the lanes of group.
+
+        Resolves just like values.py does for a single CPU, including
+        the side effects on PC and SP, which happen on skipped lanes too.
+        """
+        lanes, ram = group.lanes, self.ram
+        if val < 0x08:
+            return group.register(val)
+        if val < 0x10:
+            return Cell(group, ram, self.registers[lanes, val - 0x08])
+        if val < 0x18:
+            address = (self.registers[lanes, val - 0x10] +
+                       self.next_word(group).astype(numpy.int64)) & 0xffff
+            return Cell(group, ram, address)
+        if val == 0x18:
+            sp = self.SP[lanes]
+            if as_a:
+                # POP
+                self.SP[lanes] = sp + 1
+                return Cell(group, ram, sp)
+            # PUSH
+            sp = sp - 1
+            self.SP[lanes] = sp
+            return Cell(group, ram, sp)
+        if val == 0x19:
+            return Cell(group, ram, self.SP[lanes])
+        if val == 0x1a:
+            address = (self.SP[lanes].astype(numpy.int64) +
+                       self.next_word(group)) & 0xffff
+            return Cell(group, ram, address)
+        if val == 0x1b:
+            return group.register(REGFILE_SP)
+        if val == 0x1c:
+            return group.register(REGFILE_PC)
+        if val == 0x1d:
+            return group.register(REGFILE_EX)
+        if val == 0x1e:
+            return Cell(group, ram, self.next_word(group))
+        if val == 0x1f:
+            # The word after the instruction, as the cell holding it
+            pc = self.PC[lanes]
+            self.PC[lanes] = pc + 1
+            return Cell(group, ram, pc)
+        return LiteralCell(group, val - 0x20)
+
+    # The handlers below mirror the ones of Emulator, on whole groups.
+    # Conditions become masks.
+
+    def divide(self, dividend, divisor):
+        """ dividend / divisor, 0 where divisor is 0 like in Emulator """
+        zero = divisor == 0
+        return numpy.where(zero, 0, dividend // numpy.where(zero, 1, divisor))
+
+    def modulo(self, dividend, divisor):
+        zero = divisor == 0
+        return numpy.where(zero, 0, dividend % numpy.where(zero, 1, divisor))
+
+    def SET(self, g, b, a):
+        b.value = a.value
+
+    def ADD(self, g, b, a):
+        sum = a.value + b.value
+        g.register(REGFILE_EX).value = numpy.where(sum > 0xffff, 0xffff, 0)
+        b.value = sum & 0xffff
+
+    def SUB(self, g, b, a):
+        res = b.value - a.value
+        g.register(REGFILE_EX).value = numpy.where(res < 0, 0xffff, 0)
+        b.value = numpy.abs(res)
+
+    def MUL(self, g, b, a):
+        res = b.value * a.value
+        g.register(REGFILE_EX).value = (res >> 16) & 0xffff
+        b.value = res
+
+    def MLI(self, g, b, a):
+        res = (signed(b.value) * signed(a.value)) & 0xffff
+        g.register(REGFILE_EX).value = 0
+        b.value = res
+
+    def DIV(self, g, b, a):
+        bval = b.value
+        b.value = self.divide(bval, a.value)
+        g.register(REGFILE_EX).value = self.divide(bval << 16,
+                                                   a.value) & 0xffff
+
+    def DVI(self, g, b, a):
+        b_signed = signed(b.value)
+        b.value = self.divide(b_signed, signed(a.value))
+        g.register(REGFILE_EX).value = self.divide(b_signed << 16,
+                                                   a.value) & 0xffff
+
+    def MOD(self, g, b, a):
+        b.value = self.modulo(b.value, a.value)
+
+    def MDI(self, g, b, a):
+        divisor = a.value
+        keep = (signed(b.value) < 0) & (divisor != 0)
+        b.value = numpy.where(keep, b.value, self.modulo(b.value, divisor))
+
+    def AND(self, g, b, a):
+        b.value = b.value & a.value
+
+    def BOR(self, g, b, a):
+        b.value = b.value | a.value
+
+    def XOR(self, g, b, a):
+        b.value = b.value ^ a.value
+
+    def SHR(self, g, b, a):
+        b.value = b.value >> numpy.minimum(a.value, 63)
+        g.register(REGFILE_EX).value = ((b.value << 16) >>
+                                        numpy.minimum(a.value, 63)) & 0xffff
+
+    def ASR(self, g, b, a):
+        b_signed = signed(b.value)
+        b.value = b_signed >> numpy.minimum(a.value, 63)
+        g.register(REGFILE_EX).value = ((b_signed << 16) >>
+                                        numpy.minimum(a.value, 63)) & 0xffff
+
+    def SHL(self, g, b, a):
+        # Emulator.SHL never writes EX
+        shift = a.value
+        b.value = numpy.where(shift < 16,
+                              b.value << numpy.minimum(shift, 16), 0)
+
+    def IFB(self, g, b, a):
+        g.skip((a.value & b.value) == 0)
+
+    def IFC(self, g, b, a):
+        g.skip((a.value & b.value) != 0)
+
+    def IFE(self, g, b, a):
+        g.skip(a.value != b.value)
+
+    def IFN(self, g, b, a):
+        g.skip(a.value == b.value)
+
+    def IFG(self, g, b, a):
+        g.skip(b.value <= a.value)
+
+    def IFA(self, g, b, a):
+        g.skip(signed(b.value) <= signed(a.value))
+
+    def IFL(self, g, b, a):
+        g.skip(b.value >= a.value)
+
+    def IFU(self, g, b, a):
+        g.skip(signed(b.value) >= signed(a.value))
+
+    def ADX(self, g, b, a):
+        EX = g.register(REGFILE_EX)
+        res = b.value + a.value + EX.value
+        b.value = res
+        EX.value = numpy.where(res >= 0xffff, 1, 0)
+
+    def SBX(self, g, b, a):
+        EX = g.register(REGFILE_EX)
+        res = b.value - a.value + EX.value
+        b.value = res
+        EX.value = numpy.where(res <= 0, 1, 0)
+
+    def STI(self, g, b, a):
+        b.value = b.value + a.value
+        I, J = g.register(REG.I), g.register(REG.J)
+        I.value = I.value + 1
+        J.value = J.value + 1
+
+    def STD(self, g, b, a):
+        b.value = b.value + a.value
+        I, J = g.register(REG.I), g.register(REG.J)
+        I.value = I.value - 1
+        J.value = J.value - 1
@@ -0,0 +1,163 @@
+import random
+import unittest
+
+from cpu import ArrayCPU
+from emulator import Emulator, EmulatorError, InvalidOpcode, StackOverflow
+from constants import REG, OPCODE
+from utils import pack_instruction, pack_special_instruction, Value
+from vector import numpy, VectorEmulator
+
+# Every basic opcode, unlike translatortests some of these raise
+FUZZ_OPCODES = [op for op in range(0x01, 0x20)
+                if op not in (0x18, 0x19, 0x1c, 0x1d)]
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestVectorEmulator(unittest.TestCase):
+
+    def random_cpu(self, rand, program):
+        cpu = ArrayCPU()
+        cpu.load(program)
+        for reg in range(8):
+            cpu.registers[reg].value = rand.choice(
+                (0, 1, 0x8000, 0xffff, rand.randint(0, 0xffff)))
+        cpu.EX.value = rand.randint(0, 0xffff)
+        cpu.SP.value = rand.choice((0xffff, 0, rand.randint(0, 0xffff)))
+        return cpu
+
+    def run_lanes(self, cpus, steps):
+        """ Runs cpus as lanes, returns the final lane state and errors """
+        vector = VectorEmulator(len(cpus))
+        for lane, cpu in enumerate(cpus):
+            vector.set_lane(lane, cpu)
+        vector.run(steps)
+        return vector
+
+    def assertSameLane(self, vector, lane, cpu, steps):
+        """ Checks lane against running cpu on Emulator """
+        emulator = Emulator(cpu)
+        # Lanes have no interrupts, their opcodes are invalid
+        for op_code in (set(emulator.SPECIAL_INSTRUCTIONS) -
+                        set(vector.SPECIAL_INSTRUCTIONS)):
+            del emulator.SPECIAL_INSTRUCTIONS[op_code]
+        error = None
+        try:
+            for i in range(steps):
+                emulator.dispatch()
+        except EmulatorError, e:
+            error = e
+        self.assertEqual(vector.faults.get(lane).__class__, error.__class__)
+        lane_cpu = vector.lane_cpu(lane)
+        self.assertEqual(list(lane_cpu.regfile), list(cpu.regfile))
+        self.assertEqual(lane_cpu.skip_instruction, cpu.skip_instruction)
+        self.assertEqual(lane_cpu.cycles, cpu.cycles)
+        self.assertEqual(lane_cpu.instructions, cpu.instructions)
+        self.assertTrue(list(lane_cpu.memory) == list(cpu.memory),
+                        "Memory differs")
+
+    def test_divergent_branches(self):
+        program = [
+            # IFG A, 10
+            pack_instruction(OPCODE.IFG, Value.reg(REG.A), Value.literal(10)),
+            # SET PC, 4
+            pack_instruction(OPCODE.SET, Value.pc(), Value.literal(4)),
+            # ADD B, 1
+            pack_instruction(OPCODE.ADD, Value.reg(REG.B), Value.literal(1)),
+            # SET PC, 5
+            pack_instruction(OPCODE.SET, Value.pc(), Value.literal(5)),
+            # SUB B, 1
+            pack_instruction(OPCODE.SUB, Value.reg(REG.B), Value.literal(1)),
+            # SET PC, 5
+            pack_instruction(OPCODE.SET, Value.pc(), Value.literal(5)),
+        ]
+        vector = VectorEmulator(3)
+        vector.load(program)
+        vector.registers[:, REG.A] = [5, 10, 20]
+        vector.registers[:, REG.B] = 5
+        vector.run(4)
+        self.assertEqual(list(vector.registers[:, REG.B]), [6, 6, 4])
+        self.assertEqual(list(vector.PC), [5, 5, 5])
+
+    def test_faults(self):
+        program = [
+            # DIV A, B
+            pack_instruction(OPCODE.DIV, Value.reg(REG.A), Value.reg(REG.B)),
+            # JSR 0x10
+            pack_special_instruction(OPCODE.JSR, Value.literal(0x10)),
+            0x18,
+        ]
+        vector = VectorEmulator(3)
+        vector.load(program)
+        vector.registers[:, REG.B] = [0, 1, 1]
+        vector.SP[:] = [0xffff, 0, 0xffff]
+        vector.PC[2] = 2
+        vector.run(3)
+        self.assertTrue(vector.halted.all())
+        # Dividing by zero goes on, to the zero word after the JSR
+        self.assertTrue(isinstance(vector.faults[0], InvalidOpcode))
+        self.assertEqual(vector.faults[0].pc, 0x10)
+        self.assertTrue(isinstance(vector.faults[1], StackOverflow))
+        self.assertEqual(vector.faults[1].pc, 1)
+        self.assertTrue(isinstance(vector.faults[2], InvalidOpcode))
+        self.assertEqual(vector.faults[2].pc, 2)
+
+    def test_divide_by_zero(self):
+        program = [
+            # DIV A, B
+            pack_instruction(OPCODE.DIV, Value.reg(REG.A), Value.reg(REG.B)),
+            # SET X, EX
+            pack_instruction(OPCODE.SET, Value.reg(REG.X), Value.ex()),
+            # DVI C, B
+            pack_instruction(OPCODE.DVI, Value.reg(REG.C), Value.reg(REG.B)),
+            # MOD I, B
+            pack_instruction(OPCODE.MOD, Value.reg(REG.I), Value.reg(REG.B)),
+            # MDI J, B
+            pack_instruction(OPCODE.MDI, Value.reg(REG.J), Value.reg(REG.B)),
+        ]
+        cpus = []
+        for divisor in (0, 3):
+            cpu = ArrayCPU()
+            cpu.load(program)
+            for reg in (REG.A, REG.C, REG.I, REG.J):
+                cpu.registers[reg].value = -7
+            cpu.registers[REG.B].value = divisor
+            cpus.append(cpu)
+        vector = self.run_lanes(cpus, 5)
+        self.assertFalse(vector.faults)
+        self.assertEqual(list(vector.registers[0]), [0, 0, 0, 0, 0, 0, 0, 0])
+        for lane, cpu in enumerate(cpus):
+            self.assertSameLane(vector, lane, cpu, 5)
+
+    def test_no_hardware(self):
+        program = [
+            # HWN A
+            pack_special_instruction(OPCODE.HWN, Value.reg(REG.A)),
+            # HWQ 0
+            pack_special_instruction(OPCODE.HWQ, Value.literal(0)),
+            # HWI 0
+            pack_special_instruction(OPCODE.HWI, Value.literal(0)),
+        ]
+        cpus = []
+        for lane in range(2):
+            cpu = ArrayCPU()
+            cpu.load(program)
+            cpu.registers[REG.A].value = 5
+            cpu.registers[REG.Y].value = lane
+            cpus.append(cpu)
+        vector = self.run_lanes(cpus, 3)
+        for lane, cpu in enumerate(cpus):
+            self.assertSameLane(vector, lane, cpu, 3)
+
+    def test_fuzz(self):
+        rand = random.Random(2)
+        for i in range(20):
+            program = [pack_instruction(rand.choice(FUZZ_OPCODES),
+                                        rand.randint(0, 0x1f),
+                                        rand.randint(0, 0x3f))
+                       for j in range(128)]
+            cpus = [self.random_cpu(rand, program) for lane in range(16)]
+            vector = self.run_lanes(cpus, 200)
+            for lane, cpu in enumerate(cpus):
+                self.assertSameLane(vector, lane, cpu, 200)
+
+if __name__ == '__main__':
+    unittest.main()